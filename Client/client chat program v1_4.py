@@ -3,37 +3,545 @@ import threading
 import tkinter as tk
 from tkinter import simpledialog, Toplevel, filedialog, messagebox
 import io
-from PIL import Image, ImageGrab, ImageTk, ImageDraw 
+from PIL import Image, ImageGrab, ImageTk, ImageDraw, features
 import os
 import tempfile
 import subprocess
 import platform
+import ssl
+import select
+import argparse
+import random
+import time
+import queue
+import itertools
+import collections
+import tarfile
+import json
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime 
 
 # Client settings
 FORMAT = 'utf-8'
 DISCONNECT_MESSAGE = "!DISCONNECT"
+RESUME_MESSAGE = "!RESUME"    # Sent after the name to ask for a resumable session
+SESSION_MESSAGE = "!SESSION"  # Server's answer with a new session token
+RESUMED_MESSAGE = "!RESUMED"  # Server's answer when an earlier session was picked up again
+PING_MESSAGE = "!PING"        # Heartbeat, sent as a line of its own; the server answers with a PONG_MESSAGE line
+PONG_MESSAGE = "!PONG"
+ERROR_MESSAGE = "!ERROR"      # Protocol error from the server, e.g. "!ERROR rate_limited: ..."
+DATA_MESSAGE = "!DATA"        # Opens the data connection for file/image bodies: "!DATA token"
+DATA_FRAME = struct.Struct('!II')  # Server to client on the data connection: stream id, chunk length, then the chunk
+DIGEST_MESSAGE = "!DIGEST"    # Ahead of a file/image from the server: "!DIGEST algorithm hex" of its body as uploaded
+RECONNECT_MIN_DELAY = 0.5     # Seconds; the backoff doubles up to the maximum
+RECONNECT_MAX_DELAY = 30
+HEARTBEAT_MISSES = 3          # Heartbeat intervals of silence before the server is considered gone
+SEND_CHUNK_SIZE = 1024 * 1024 # Files are streamed from disk in pieces this size
+SEND_COALESCE_BYTES = 64 * 1024 # Small chunks (a file's header) go out in one send with what follows them
+TCP_NODELAY_ON = True         # Each message goes out at once instead of waiting for an ACK (Nagle)
+SEND_BUFFER_BYTES = 0         # SO_SNDBUF (0: the OS default)
+RECEIVE_BUFFER_BYTES = 0      # SO_RCVBUF (0: the OS default)
+SEND_WAIT_FOR_CONNECTION = 60 # Seconds a queued message waits for a reconnect before it fails
+UI_FRAME_MS = 33              # Received messages are drawn in batches at most ~30 times a second
+UI_MAX_EVENTS_PER_FRAME = 500 # A bigger backlog is drawn over several frames so the window stays responsive
+THUMBNAIL_SIZE = (200, 200)   # Preview size of received images in the chat log
+IMAGE_DECODE_WORKERS = min(4, os.cpu_count() or 1) # Pillow releases the GIL while decoding
+VIEWER_SETTLE_MS = 150        # Image viewer: quiet time after a resize/zoom/pan before the sharp redraw
+VIEWER_ZOOM_STEP = 1.25       # Per mouse wheel notch or +/- key
+VIEWER_MAX_ZOOM = 16          # Relative to fit-to-window
+
+# Encoding of pasted screenshots: longest side in pixels (0 = keep), format and quality
+IMAGE_PRESETS = {
+    "Fast": {'max_dimension': 1600, 'format': 'JPEG', 'quality': 65},
+    "Balanced": {'max_dimension': 2560, 'format': 'JPEG', 'quality': 80},
+    "High quality": {'max_dimension': 0, 'format': 'JPEG', 'quality': 92},
+    "Small (WebP)": {'max_dimension': 2560, 'format': 'WEBP', 'quality': 75},
+    "Text (lossless PNG)": {'max_dimension': 0, 'format': 'PNG', 'quality': None},
+}
+DEFAULT_IMAGE_PRESET = "Balanced"
+ARCHIVE_MANIFEST = "MANIFEST.json" # First member of a folder/multi-file send: where each file sits in the tar
+
+def read_file_chunks(path, size):
+    """Yields exactly `size` bytes of a file; the header promised that many."""
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(SEND_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise IOError(f"{os.path.basename(path)} got shorter while it was being sent")
+            remaining -= len(chunk)
+            yield chunk
+
+# --- Folder / Multi-file Archives ---
+# Several files go out as one plain tar written on the fly: every header is
+# built up front from os.stat, so the size for the FILE header is known and
+# the contents are streamed from disk like a single file. The first member
+# is a JSON manifest with the offset of each file inside the archive, so the
+# receiver can open one file without unpacking the rest.
+
+def collect_archive_entries(paths):
+    """Returns [(member name, path)] for the chosen files and every file under the chosen folders."""
+    entries = []
+    for path in paths:
+        path = os.path.abspath(path)
+        base = os.path.dirname(path)
+        if os.path.isdir(path):
+            for folder, subfolders, files in os.walk(path):
+                subfolders.sort()
+                for name in sorted(files):
+                    full_path = os.path.join(folder, name)
+                    if os.path.isfile(full_path) and not os.path.islink(full_path):
+                        entries.append((os.path.relpath(full_path, base).replace(os.sep, '/'), full_path))
+        else:
+            entries.append((os.path.basename(path), path))
+    return entries
+
+def tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, FORMAT, 'surrogateescape')
+
+def tar_padding(size):
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+def plan_archive(entries):
+    """Stats every file and lays the archive out. Returns (total size, chunk generator factory)."""
+    members = []
+    for name, path in entries:
+        stat = os.stat(path)
+        members.append((tar_header(name, stat.st_size, stat.st_mtime), path, name, stat.st_size))
+    
+    # The manifest is padded with spaces to whole blocks, so the offsets it lists
+    # only depend on how many blocks it takes; grow that until it fits.
+    blocks = 1
+    while True:
+        manifest_size = blocks * tarfile.BLOCKSIZE
+        manifest_header = tar_header(ARCHIVE_MANIFEST, manifest_size, time.time())
+        offset = len(manifest_header) + manifest_size
+        listing = []
+        for header, path, name, size in members:
+            listing.append({'name': name, 'size': size, 'offset': offset + len(header)})
+            offset += len(header) + size + len(tar_padding(size))
+        manifest = json.dumps({'files': listing}).encode(FORMAT)
+        if len(manifest) <= manifest_size:
+            manifest = manifest.ljust(manifest_size)
+            break
+        blocks = -(-len(manifest) // tarfile.BLOCKSIZE)
+    total_size = offset + 2 * tarfile.BLOCKSIZE # End-of-archive marker
+    
+    def chunks():
+        yield manifest_header + manifest
+        for header, path, name, size in members:
+            yield header
+            yield from read_file_chunks(path, size)
+            padding = tar_padding(size)
+            if padding:
+                yield padding
+        yield b"\0" * (2 * tarfile.BLOCKSIZE)
+    return total_size, chunks
+
+def read_archive_manifest(data):
+    """Returns the file list of an archive made by plan_archive, or None for any other file."""
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as archive:
+            first = archive.next() # Only the first header is parsed
+            if first is None or first.name != ARCHIVE_MANIFEST:
+                return None
+            files = json.loads(archive.extractfile(first).read())['files']
+    except (tarfile.TarError, ValueError, KeyError):
+        return None
+    return [f for f in files if 0 <= f['offset'] and f['offset'] + f['size'] <= len(data)]
+
+def decode_thumbnail(image_data, size=THUMBNAIL_SIZE):
+    """Returns (thumbnail, original) for received image bytes. Runs on a worker thread.
+
+    The thumbnail is decoded at reduced resolution (JPEG draft mode scales by 1/2..1/8
+    inside the decoder, other formats are reduced by whole factors before the final
+    LANCZOS pass), so a 4K screenshot never gets decoded in full just for a preview.
+    The original is opened separately and left undecoded until the viewer needs it."""
+    thumb = Image.open(io.BytesIO(image_data))
+    thumb.draft(thumb.mode, size) # No-op for formats other than JPEG
+    thumb.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    original = Image.open(io.BytesIO(image_data))
+    return thumb, original
+
+def encode_screenshot(img, settings):
+    """Returns (image bytes, description) for a pasted image. Runs on a worker thread.
+
+    WebP falls back to JPEG if this Pillow was built without it."""
+    started = time.perf_counter()
+    image_format = settings['format']
+    quality = settings['quality']
+    if image_format == 'WEBP' and not features.check('webp'):
+        image_format = 'JPEG'
+    
+    if image_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB') # Clipboard images are often RGBA; one channel less to scale too
+    max_dimension = settings['max_dimension']
+    if max_dimension and max(img.size) > max_dimension:
+        ratio = max_dimension / max(img.size)
+        img = img.resize((max(1, round(img.width * ratio)), max(1, round(img.height * ratio))),
+                         Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
+    byte_arr = io.BytesIO()
+    if image_format == 'PNG':
+        img.save(byte_arr, format='PNG', compress_level=6)
+        detail = "PNG lossless"
+    else:
+        img.save(byte_arr, format=image_format, quality=quality)
+        detail = f"{image_format} q{quality}"
+    image_bytes = byte_arr.getvalue()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    return image_bytes, f"{img.width}x{img.height} {detail}, {len(image_bytes) // 1024} KB, encoded in {elapsed_ms:.0f} ms"
+
+def upload_header_end(data, start=0):
+    """Index just past an IMAGE|size| or FILE|name|size| header at start, or -1 while it is incomplete."""
+    end = start - 1
+    for _ in range(2 if data.startswith(b"IMAGE|", start) else 3):
+        end = data.find(b"|", end + 1)
+        if end == -1:
+            return -1
+    return end + 1
+
+def digest_line_end(data):
+    """Index just past a leading "!DIGEST algorithm hex" line: 0 if data has none, -1 while it is incomplete."""
+    if not data.startswith(DIGEST_MESSAGE.encode(FORMAT)):
+        return 0
+    end = data.find(b"\n")
+    return end + 1 if end != -1 else -1
+
+def start_digest(line):
+    """The hasher and expected hex digest for a "!DIGEST algorithm hex" line."""
+    _, algorithm, expected = bytes(line).decode(FORMAT).split()
+    return hashlib.new(algorithm), expected
+
+def close_socket(sock):
+    """Closes a connection so that a thread blocked reading it wakes up."""
+    try:
+        if not isinstance(sock, TLSConnection): # TLSConnection.close() shuts the socket down itself
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    try:
+        sock.close()
+    except OSError:
+        pass
+
+def configure_keepalive(sock, interval):
+    """Lets TCP itself notice a server that vanished, as a backstop to the heartbeats."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(interval)))
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(interval) // 3))
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, HEARTBEAT_MISSES)
+    except OSError:
+        pass
+
+def tune_socket(sock):
+    """Applies TCP_NODELAY and the buffer sizes."""
+    try:
+        if SEND_BUFFER_BYTES:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+        if RECEIVE_BUFFER_BYTES:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+        if TCP_NODELAY_ON:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+def gather_chunks(chunks):
+    """Groups a message's chunks so that small ones are sent together with the next: yields lists."""
+    group, size = [], 0
+    for chunk in chunks:
+        group.append(chunk)
+        size += len(chunk)
+        if size >= SEND_COALESCE_BYTES:
+            yield group
+            group, size = [], 0
+    if group:
+        yield group
+
+def send_parts(sock, parts):
+    """Writes several buffers with one call (sendmsg() where there is one; joined over TLS)."""
+    if len(parts) == 1:
+        sock.sendall(parts[0])
+        return
+    if isinstance(sock, TLSConnection) or not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(parts))
+        return
+    views = [memoryview(part) for part in parts]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if views:
+            views[0] = views[0][sent:]
+
+class TLSConnection:
+    """Lets the receive thread and the sending code share one SSLSocket.
+
+    OpenSSL does not allow an SSL object to be read and written at the same
+    time, so every SSL call is made under a lock while waiting for the
+    network happens outside it.
+    """
+    def __init__(self, tls_sock):
+        self.sock = tls_sock
+        self.lock = threading.Lock()
+        self.closed = False
+        tls_sock.setblocking(False)
+
+    def _wait(self, for_write):
+        if for_write:
+            select.select([], [self.sock], [])
+        else:
+            select.select([self.sock], [], [])
+
+    def recv(self, size):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return b""
+                try:
+                    return self.sock.recv(size)
+                except ssl.SSLWantReadError:
+                    want_write = False
+                except ssl.SSLWantWriteError:
+                    want_write = True
+            self._wait(want_write)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        with self.lock:
+            while view:
+                if self.closed:
+                    raise OSError("connection closed")
+                try:
+                    view = view[self.sock.send(view):]
+                except ssl.SSLWantWriteError:
+                    self._wait(True)
+                except ssl.SSLWantReadError:
+                    self._wait(False)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            socket.socket.shutdown(self.sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self.lock:
+            self.sock.close()
+
+    def __getattr__(self, attribute):
+        return getattr(self.sock, attribute)
+
+class ImagePyramid:
+    """Pre-scaled copies of one image at 1/2, 1/4, ... size, made the first time they are needed.
+
+    Rescaling always starts from the smallest copy that still has at least as many
+    pixels as the target, so fitting a 4K image into a small window never reads
+    the full-resolution original.
+    """
+    MIN_SIZE = 64 # Stop halving below this many pixels on the short side
+
+    def __init__(self, original):
+        if original.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            original = original.convert('RGBA') # reduce() and LANCZOS need a non-palette mode
+        self.levels = [original]
+
+    @property
+    def size(self):
+        return self.levels[0].size
+
+    def level_for(self, scale):
+        """Returns (image, factor) where image is the original reduced by `factor` and factor <= 1/scale."""
+        level = 0
+        while 2 ** (level + 1) <= 1 / scale:
+            if level + 1 == len(self.levels):
+                smaller = self.levels[level]
+                if min(smaller.size) // 2 < self.MIN_SIZE:
+                    break
+                self.levels.append(smaller.reduce(2))
+            level += 1
+        return self.levels[level], 2 ** level
+
+class ImageViewer:
+    """Toplevel showing one received image, with zoom (wheel, +/-, 0 to fit) and pan (drag).
+
+    Resizes, zooms and pans are drawn straight away with a cheap filter from the
+    image pyramid and redrawn with LANCZOS once they stop for VIEWER_SETTLE_MS.
+    Only the visible part of the image is ever scaled.
+    """
+    def __init__(self, master, pyramid):
+        self.pyramid = pyramid
+        width, height = pyramid.size
+        self.zoom = 1.0 # Relative to fit-to-window
+        self.center = (width / 2, height / 2) # Image point shown in the middle of the window
+        self.drag_start = None
+        self.preview_job = None
+        self.settle_job = None
+        self.photo = None
+
+        self.window = Toplevel(master)
+        self.window.title(f"Full Image View ({width}x{height})")
+        initial_width = min(width, self.window.winfo_screenwidth() - 100)
+        initial_height = min(height, self.window.winfo_screenheight() - 100)
+        self.window.geometry(f"{initial_width}x{initial_height}")
+
+        self.canvas = tk.Canvas(self.window, bg='gray', highlightthickness=0)
+        self.canvas.pack(expand=True, fill='both')
+        self.canvas.bind('<Configure>', lambda e: self.schedule_render())
+        self.canvas.bind('<ButtonPress-1>', self.on_drag_start)
+        self.canvas.bind('<B1-Motion>', self.on_drag)
+        self.canvas.bind('<Double-Button-1>', lambda e: self.set_zoom(1.0))
+        self.canvas.bind('<MouseWheel>', lambda e: self.zoom_at(e, VIEWER_ZOOM_STEP if e.delta > 0 else 1 / VIEWER_ZOOM_STEP))
+        self.canvas.bind('<Button-4>', lambda e: self.zoom_at(e, VIEWER_ZOOM_STEP)) # X11 wheel
+        self.canvas.bind('<Button-5>', lambda e: self.zoom_at(e, 1 / VIEWER_ZOOM_STEP))
+        self.window.bind('<plus>', lambda e: self.set_zoom(self.zoom * VIEWER_ZOOM_STEP))
+        self.window.bind('<equal>', lambda e: self.set_zoom(self.zoom * VIEWER_ZOOM_STEP))
+        self.window.bind('<minus>', lambda e: self.set_zoom(self.zoom / VIEWER_ZOOM_STEP))
+        self.window.bind('<Key-0>', lambda e: self.set_zoom(1.0))
+
+    def view_size(self):
+        return max(1, self.canvas.winfo_width()), max(1, self.canvas.winfo_height())
+
+    def scale(self):
+        """Screen pixels per image pixel at the current zoom."""
+        view_width, view_height = self.view_size()
+        width, height = self.pyramid.size
+        return min(view_width / width, view_height / height) * self.zoom
+
+    def clamp_center(self):
+        """Keeps the image from being panned out of the window."""
+        view_width, view_height = self.view_size()
+        scale = self.scale()
+        center = []
+        for value, length, view in zip(self.center, self.pyramid.size, (view_width, view_height)):
+            half = view / (2 * scale)
+            center.append(length / 2 if half * 2 >= length else min(max(value, half), length - half))
+        self.center = tuple(center)
+
+    def set_zoom(self, zoom, anchor=None):
+        """Zooms keeping the image point under `anchor` (window coordinates) where it is."""
+        view_width, view_height = self.view_size()
+        if anchor is None:
+            anchor = (view_width / 2, view_height / 2)
+        old_scale = self.scale()
+        self.zoom = min(max(zoom, 1.0), VIEWER_MAX_ZOOM)
+        new_scale = self.scale()
+        point = [c + (a - v / 2) / old_scale for c, a, v in zip(self.center, anchor, (view_width, view_height))]
+        self.center = tuple(p - (a - v / 2) / new_scale for p, a, v in zip(point, anchor, (view_width, view_height)))
+        self.schedule_render()
+
+    def zoom_at(self, event, factor):
+        self.set_zoom(self.zoom * factor, (event.x, event.y))
+
+    def on_drag_start(self, event):
+        self.drag_start = (event.x, event.y, self.center)
+
+    def on_drag(self, event):
+        if self.drag_start is None:
+            return
+        x, y, (center_x, center_y) = self.drag_start
+        scale = self.scale()
+        self.center = (center_x - (event.x - x) / scale, center_y - (event.y - y) / scale)
+        self.schedule_render()
+
+    def schedule_render(self):
+        """Coalesces a burst of events into one quick frame, then one sharp frame when they stop."""
+        if self.preview_job is None:
+            self.preview_job = self.canvas.after_idle(self.render_preview)
+        if self.settle_job is not None:
+            self.canvas.after_cancel(self.settle_job)
+        self.settle_job = self.canvas.after(VIEWER_SETTLE_MS, self.render_final)
+
+    def render_preview(self):
+        self.preview_job = None
+        self.render(Image.Resampling.BILINEAR)
+
+    def render_final(self):
+        self.settle_job = None
+        self.render(Image.Resampling.LANCZOS)
+
+    def render(self, resample):
+        self.clamp_center()
+        view_width, view_height = self.view_size()
+        width, height = self.pyramid.size
+        scale = self.scale()
+        center_x, center_y = self.center
+        
+        # Visible part of the image, in original pixels
+        left = max(0, center_x - view_width / (2 * scale))
+        right = min(width, center_x + view_width / (2 * scale))
+        top = max(0, center_y - view_height / (2 * scale))
+        bottom = min(height, center_y + view_height / (2 * scale))
+        out_size = (max(1, round((right - left) * scale)), max(1, round((bottom - top) * scale)))
+        
+        level, factor = self.pyramid.level_for(scale)
+        visible = level.resize(out_size, resample, box=(left / factor, top / factor, right / factor, bottom / factor))
+        
+        self.photo = ImageTk.PhotoImage(visible) # Keep a reference or Tk drops the image
+        self.canvas.delete('all')
+        self.canvas.create_image(view_width / 2 + (left - center_x) * scale,
+                                 view_height / 2 + (top - center_y) * scale,
+                                 image=self.photo, anchor='nw')
+        self.window.title(f"Full Image View ({width}x{height}) - {scale * 100:.0f}%")
 
 class ChatClient:
     # Default settings
     DEFAULT_HOST = '127.0.0.1'
     DEFAULT_PORT = 57001
     
-    def __init__(self, master):
+    def __init__(self, master, host=None, port=None, use_tls=False, tls_ca=None, image_preset=DEFAULT_IMAGE_PRESET):
         self.master = master
         master.title("Python Incident Recorder Chat Client")
         
         self.client = None
-        self.current_host = self.DEFAULT_HOST
-        self.current_port = self.DEFAULT_PORT
+        self.current_host = host or self.DEFAULT_HOST
+        self.current_port = port or self.DEFAULT_PORT
+        self.use_tls = use_tls
+        self.tls_ca = tls_ca # CA or the server's own certificate; None uses the system store
+        self.tls_context = None # Reused for every connection; sessions only resume within one context
+        self.tls_session = None # Last TLS session, offered on reconnect to skip a full handshake
         self.name = None
         self.running = False 
+        self.session_token = None # Lets the server reattach us after a drop and replay what we missed
+        self.stream_offset = 0 # Bytes read from the session so far
+        self.resume_offset = 0 # Bytes read up to the end of the last complete message
+        self.leftover = b"" # Bytes read during the handshake that belong to the first message
+        self.reconnect_now = threading.Event() # Skips the backoff wait (set by Setup and on exit)
+        self.heartbeat_interval = None # Seconds, announced by the server; None if it does not answer pings
+        self.connected = False
+        self.last_received = time.time()
+        self.last_sent = time.time()
+        self.last_progress = 0 # When the sender last got a chunk of an upload out; proves the server is alive
+        self.send_lock = threading.Lock() # Keeps a heartbeat from landing in the middle of a file
+        self.outbox = queue.Queue() # (chunks, on_done, on_error) waiting for the sender thread
+        self.bulk_outbox = queue.Queue() # Files and images, written by their own sender thread
+        self.data_token = None # Offered by the server for a second connection that carries files and images
+        self.data_sock = None # That connection, while it is up; chat text never waits behind a transfer on it
+        self.ui_events = queue.Queue() # (kind, payload) from background threads, drawn by the Tk thread
+        self.ui_batch = collections.deque() # Events taken off ui_events but not drawn yet
+        self.image_pool = ThreadPoolExecutor(max_workers=IMAGE_DECODE_WORKERS, thread_name_prefix="image-decode")
+        self.image_preset = image_preset
+        self.image_settings = dict(IMAGE_PRESETS[image_preset]) # Used to encode pasted screenshots
 
         # --- Connection Logic ---
         try:
             # 1. Attempt connection immediately
-            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client.connect((self.DEFAULT_HOST, self.DEFAULT_PORT))
+            self.client = self.open_connection()
             
             # 2. Prompt for Name
             self.name = simpledialog.askstring("Name", "Please enter your chat name:", parent=self.master)
@@ -42,22 +550,327 @@ class ChatClient:
                 return
 
             # 3. Send Name and Start Setup
-            self.client.send(self.name.encode(FORMAT))
+            self.start_session()
             self.setup_gui()
             self.start_threads()
 
         except ConnectionRefusedError:
             messagebox.showerror(
                 "Connection Error", 
-                f"Could not connect to server at {self.DEFAULT_HOST}:{self.DEFAULT_PORT}. Ensure the server is running."
+                f"Could not connect to server at {self.current_host}:{self.current_port}. Ensure the server is running."
             )
             self.on_closing()
+        except PermissionError as e:
+            messagebox.showerror("Connection Error", str(e))
+            self.on_closing()
         except Exception as e:
             messagebox.showerror("Error", f"An unexpected error occurred during initialization: {e}")
             self.on_closing()
         # ------------------------
 
 
+    def open_connection(self):
+        """Connects to the current host/port, wrapping the socket in TLS when enabled."""
+        sock = socket.create_connection((self.current_host, self.current_port))
+        configure_keepalive(sock, self.heartbeat_interval or 15)
+        tune_socket(sock)
+        if not self.use_tls:
+            return sock
+        
+        if self.tls_context is None:
+            self.tls_context = ssl.create_default_context(cafile=self.tls_ca)
+            if self.tls_ca:
+                # A pinned CA/self-signed certificate is trusted by itself; servers are often reached by IP
+                self.tls_context.check_hostname = False
+        context = self.tls_context
+        try:
+            tls_sock = context.wrap_socket(sock, server_hostname=self.current_host, session=self.tls_session)
+        except (ssl.SSLError, ValueError):
+            # A stale session is refused by some servers; retry with a full handshake
+            sock = socket.create_connection((self.current_host, self.current_port))
+            tls_sock = context.wrap_socket(sock, server_hostname=self.current_host)
+        return TLSConnection(tls_sock)
+
+    def remember_tls_session(self):
+        """Keeps the current TLS session so the next connection can resume it."""
+        if isinstance(self.client, TLSConnection):
+            try:
+                if self.client.session is not None:
+                    self.tls_session = self.client.session
+            except Exception:
+                pass
+
+    def start_session(self):
+        """Sends our name and resume request on a new connection and reads the server's answer.
+        Returns True if the server picked up our earlier session."""
+        request = f"{self.name}\n{RESUME_MESSAGE}"
+        if self.session_token:
+            request += f" {self.session_token} {self.resume_offset}"
+        self.client.sendall(request.encode(FORMAT))
+        
+        data = b""
+        while data.startswith(b"!") or not data:
+            chunk = self.client.recv(1024)
+            if not chunk:
+                raise ConnectionError("Server closed the connection.")
+            data += chunk
+            if b"\n" in data:
+                break
+        if data.startswith(b"unauthorized connection"):
+            self.session_token = None
+            raise PermissionError("The server refused this name (not authorized, or already connected from another IP).")
+        
+        resumed = False
+        if data.startswith(b"!"):
+            line, _, data = data.partition(b"\n")
+            parts = line.decode(FORMAT).split()
+            if parts[0] == RESUMED_MESSAGE:
+                # The server replays from this offset, so anything half-read before the drop comes again
+                self.stream_offset = self.resume_offset = int(parts[1])
+                resumed = True
+            elif parts[0] == SESSION_MESSAGE:
+                self.session_token = parts[1]
+                self.stream_offset = self.resume_offset = 0
+                if len(parts) > 2:
+                    self.heartbeat_interval = float(parts[2])
+                self.data_token = parts[3] if len(parts) > 3 else None
+        self.leftover = data
+        self.last_received = self.last_sent = time.time()
+        self.connected = True
+        return resumed
+
+    def open_data_channel(self):
+        """Opens the data connection the server offered. Without it (older server, or it
+        fails) files and images simply go over the main connection."""
+        self.close_data_channel()
+        if not self.data_token:
+            return
+        sock = None
+        try:
+            sock = self.open_connection()
+            sock.sendall(f"{DATA_MESSAGE} {self.data_token}\n".encode(FORMAT))
+            data = b""
+            while b"\n" not in data and len(data) < 1024:
+                chunk = sock.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+            line, _, data = data.partition(b"\n")
+            if line != f"{DATA_MESSAGE} ready".encode(FORMAT):
+                raise ConnectionError("the server did not accept the data connection")
+        except Exception as e:
+            if sock is not None:
+                close_socket(sock)
+            self.post_message(f"[INFO] No separate file connection ({e}); files share the chat connection.")
+            return
+        self.data_sock = sock
+        data_thread = threading.Thread(target=self.data_receive_loop, args=(sock, data), name="data-receive")
+        data_thread.daemon = True
+        data_thread.start()
+
+    def close_data_channel(self, sock=None):
+        sock = sock or self.data_sock
+        if sock is None:
+            return
+        if self.data_sock is sock:
+            self.data_sock = None
+        close_socket(sock)
+
+    def data_receive_loop(self, sock, data):
+        """Receives the file/image bodies the server sends on the data connection.
+        They arrive in frames, and frames of several bodies can interleave: the
+        server lets an image through while a large file is still going out."""
+        buffer = bytearray(data)
+        streams = {}  # Stream id -> bytes of that body so far, header included
+        digests = {}  # Stream id -> [hasher, expected digest, bytes hashed so far]
+        try:
+            while True:
+                while len(buffer) < DATA_FRAME.size or len(buffer) < DATA_FRAME.size + DATA_FRAME.unpack_from(buffer)[1]:
+                    chunk = sock.recv(262144)
+                    if not chunk:
+                        return
+                    buffer += chunk
+                    self.last_progress = time.time()
+                stream, length = DATA_FRAME.unpack_from(buffer)
+                message = streams.setdefault(stream, bytearray())
+                message += buffer[DATA_FRAME.size:DATA_FRAME.size + length]
+                del buffer[:DATA_FRAME.size + length]
+                line_end = digest_line_end(message)
+                header_end = upload_header_end(message, line_end) if line_end != -1 else -1
+                if header_end == -1:
+                    if len(message) > 4096:
+                        raise ValueError("bad header on the data connection")
+                    continue
+                fields = bytes(message[line_end:header_end]).decode(FORMAT).split("|")
+                content_size = int(fields[-2])
+                body_end = min(len(message), header_end + content_size)
+                if line_end:
+                    # Hash each frame as it arrives, while it is still in cache
+                    if stream not in digests:
+                        digests[stream] = [*start_digest(message[:line_end]), header_end]
+                    check = digests[stream]
+                    with memoryview(message)[check[2]:body_end] as view:
+                        check[0].update(view)
+                    check[2] = body_end
+                if len(message) < header_end + content_size:
+                    continue
+                del streams[stream]
+                content_data = bytes(memoryview(message)[header_end:header_end + content_size])
+                label = "An image" if fields[0] == "IMAGE" else fields[1]
+                if stream in digests:
+                    self.verify_digest(*digests.pop(stream)[:2], label)
+                if fields[0] == "IMAGE":
+                    self.ui_events.put(('image', self.image_pool.submit(decode_thumbnail, content_data)))
+                else:
+                    self.ui_events.put(('file', (fields[1], content_data)))
+        except Exception as e:
+            if self.data_sock is sock:
+                self.post_message(f"[INFO] File connection closed ({e}).")
+        finally:
+            self.close_data_channel(sock)
+
+    def verify_digest(self, hasher, expected, label):
+        """Warns if a received body does not hash to the digest the server computed as it arrived there."""
+        if hasher.hexdigest() != expected:
+            self.ui_events.put(('text', f"[WARNING] {label} failed its integrity check ({hasher.name} mismatch); "
+                                        f"it may have been corrupted in transit."))
+
+    def read(self, size):
+        """Reads from the connection, handing out bytes left over from the handshake first."""
+        if self.leftover:
+            data, self.leftover = self.leftover[:size], self.leftover[size:]
+        else:
+            data = self.client.recv(size)
+        self.stream_offset += len(data)
+        self.last_received = time.time()
+        return data
+
+    def send_bytes(self, data, blocking=True):
+        """Sends one whole message unless another is being written; returns False if skipped."""
+        if not self.send_lock.acquire(blocking):
+            return False
+        try:
+            self.client.sendall(data)
+            self.last_sent = time.time()
+        finally:
+            self.send_lock.release()
+        return True
+
+    def queue_send(self, chunks, on_done=None, on_error=None, bulk=False):
+        """Hands a message (a list or generator of byte strings) to the sender thread.
+        on_done() or on_error(exception) is called later on the Tk thread. bulk marks
+        files and images, which have their own thread and use the data connection."""
+        (self.bulk_outbox if bulk else self.outbox).put((chunks, on_done, on_error))
+
+    def send_on_data_channel(self, chunks):
+        """Writes a file/image on the data connection. Returns None when it is all sent, or
+        the chunks to send on the main connection instead if the data connection failed first."""
+        sock = self.data_sock
+        started = False
+        for group in gather_chunks(chunks):
+            try:
+                send_parts(sock, group)
+            except OSError:
+                self.close_data_channel(sock)
+                if started:
+                    raise
+                return itertools.chain(group, chunks)
+            started = True
+            self.last_progress = time.time()
+        return None
+
+    def sender_loop(self, bulk=False):
+        """Writes queued messages one at a time so the Tk thread never waits on the network."""
+        outbox = self.bulk_outbox if bulk else self.outbox
+        while True:
+            item = outbox.get()
+            if item is None:
+                break
+            chunks, on_done, on_error = item
+            waited = 0
+            while not self.connected and self.running and waited < SEND_WAIT_FOR_CONNECTION:
+                time.sleep(0.1) # Give a reconnect the chance to finish first
+                waited += 0.1
+            try:
+                if not self.connected:
+                    raise ConnectionError("not connected to the server")
+                chunks = iter(chunks)
+                if bulk and self.data_sock is not None:
+                    chunks = self.send_on_data_channel(chunks)
+                    if chunks is None:
+                        if on_done:
+                            self.ui_events.put(('call', (on_done,)))
+                        continue
+                with self.send_lock:
+                    started = False
+                    try:
+                        for group in gather_chunks(chunks):
+                            send_parts(self.client, group)
+                            started = True
+                            self.last_sent = self.last_progress = time.time()
+                    except Exception:
+                        if started:
+                            # Half a message would corrupt everything after it; start over on a new connection
+                            self.drop_connection()
+                        raise
+            except Exception as e:
+                if on_error:
+                    self.ui_events.put(('call', (on_error, e)))
+                continue
+            if on_done:
+                self.ui_events.put(('call', (on_done,)))
+
+    def drop_connection(self):
+        """Closes the socket so the receive thread wakes up; safe to call from any thread."""
+        if self.client is not None:
+            close_socket(self.client)
+
+    def post_message(self, message):
+        """insert_message for background threads; the widget is only touched on the Tk thread."""
+        self.ui_events.put(('text', message))
+
+    def drain_ui_events(self):
+        """Runs on the Tk thread: draws everything received since the last frame in one batch,
+        with one state toggle and one scroll instead of one per message."""
+        try:
+            while len(self.ui_batch) < UI_MAX_EVENTS_PER_FRAME:
+                self.ui_batch.append(self.ui_events.get_nowait())
+        except queue.Empty:
+            pass
+        
+        stalled = False
+        if self.ui_batch:
+            self.chat_log.config(state='normal')
+            text_run = []
+            while self.ui_batch:
+                kind, payload = self.ui_batch[0]
+                if kind == 'image' and not payload.done():
+                    # Keep arrival order: later messages wait until the decode worker is done
+                    stalled = True
+                    break
+                self.ui_batch.popleft()
+                if kind == 'text':
+                    text_run.append(payload + '\n')
+                    continue
+                if text_run:
+                    self.chat_log.insert(tk.END, "".join(text_run))
+                    text_run = []
+                if kind == 'image':
+                    self.display_image(payload)
+                elif kind == 'file':
+                    self.display_received_file(*payload)
+                elif kind == 'call':
+                    payload[0](*payload[1:])
+                self.chat_log.config(state='normal') # insert_message in a callback or error path disables it
+            if text_run:
+                self.chat_log.insert(tk.END, "".join(text_run))
+            self.chat_log.yview(tk.END)
+            self.chat_log.config(state='disabled')
+        
+        # Come straight back if a burst is still waiting
+        backlog = not stalled and (self.ui_batch or not self.ui_events.empty())
+        self.master.after(1 if backlog else UI_FRAME_MS, self.drain_ui_events)
+
     def setup_gui(self):
         """Initializes all Tkinter widgets after a successful connection."""
         
@@ -94,10 +907,16 @@ class ChatClient:
         # Data storage and references
         self.image_references = [] # Holds Tkinter PhotoImage objects to prevent garbage collection
         self.original_images = {} # Stores original PIL Image objects for full-screen viewer
+        self.image_pyramids = {} # Scaled copies of images that have been opened in the viewer
         self.received_files = {} # Stores received file data and names by a unique tag ID
-        self.pending_file_data = None 
+        self.received_manifests = {} # File lists of received archives, by the same tag ID
+        self.pending_archive = None # (archive name, size, chunk generator factory)
+        self.pending_file_path = None 
         self.pending_file_name = None 
+        self.pending_file_size = 0
         self.pending_image_bytes = None
+        self.pending_image_source = None # Pasted image, kept to re-encode if the image settings change
+        self.pending_image_encode = None # Future of the encode in progress
         self.file_icon = self._create_file_icon()
 
         self.chat_log = tk.Text(self.master, state='disabled', wrap='word', height=20, width=50, font=('Arial', 10))
@@ -121,8 +940,10 @@ class ChatClient:
         self.input_field.grid(row=0, column=0, sticky="ew") 
         
         # --- SEND FILE BUTTON ---
-        self.file_button = tk.Button(button_frame, text="Select & Send File", command=self.open_file_dialog)
+        self.file_button = tk.Button(button_frame, text="Select & Send File(s)", command=self.open_file_dialog)
         self.file_button.grid(row=0, column=0, sticky="ew", padx=(0, 5))
+        self.folder_button = tk.Button(button_frame, text="Send Folder", command=self.open_folder_dialog)
+        self.folder_button.grid(row=0, column=1, sticky="ew", padx=(5, 0))
 
         # --- KEY BINDINGS ---
         self.input_field.bind("<Key-Return>", self.send_smart_message_event) 
@@ -132,15 +953,93 @@ class ChatClient:
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
         
         self.insert_message(f"[INFO] Connected to {self.current_host}:{self.current_port}.")
-        self.insert_message("[INFO] Use the 'Select & Send File' button for file transfer, or paste an image (Ctrl+V) and hit Enter to send.")
+        self.insert_message("[INFO] Use the 'Select & Send File(s)' or 'Send Folder' button for file transfer, or paste an image (Ctrl+V) and hit Enter to send.")
         self.insert_message("[INFO] Click a received file icon to open it in your default application.")
+        self.master.after(UI_FRAME_MS, self.drain_ui_events)
 
     def start_threads(self):
-        # 3. Start Receiving Thread
+        # 3. Start Receiving Thread (it also reconnects when the connection drops)
         self.running = True
-        receive_thread = threading.Thread(target=self.receive_messages)
+        receive_thread = threading.Thread(target=self.connection_loop, name="receive")
         receive_thread.daemon = True
         receive_thread.start()
+        heartbeat_thread = threading.Thread(target=self.heartbeat_loop, name="heartbeat")
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+        sender_thread = threading.Thread(target=self.sender_loop, name="sender")
+        sender_thread.daemon = True
+        sender_thread.start()
+        bulk_sender_thread = threading.Thread(target=self.sender_loop, args=(True,), name="bulk-sender")
+        bulk_sender_thread.daemon = True
+        bulk_sender_thread.start()
+
+    def heartbeat_loop(self):
+        """Pings an idle connection and drops it when the server stops answering,
+        so a dead server is noticed within a few intervals instead of never."""
+        while self.running:
+            time.sleep(1)
+            interval = self.heartbeat_interval
+            if not interval or not self.connected:
+                continue
+            now = time.time()
+            # An upload that keeps moving means the server is reading, even if it has nothing to say
+            last_heard = max(self.last_received, self.last_progress)
+            if now - last_heard > interval * HEARTBEAT_MISSES:
+                self.post_message(f"[INFO] No reply from the server for {now - last_heard:.0f}s.")
+                self.connected = False
+                self.drop_connection()
+            elif now - self.last_sent >= interval:
+                try:
+                    self.send_bytes(f"{PING_MESSAGE}\n".encode(FORMAT), blocking=False)
+                except OSError:
+                    pass
+
+    def connection_loop(self):
+        """Receives until the connection drops, then reconnects in the background.
+        Attempts are spaced with exponential backoff and full jitter so that many
+        clients cut off at once do not all come back in the same instant."""
+        self.open_data_channel()
+        while self.running:
+            if self.receive_messages():
+                self.post_message("[DISCONNECTED] The server ended the session.")
+                break
+            if not self.running:
+                break
+            self.connected = False
+            self.remember_tls_session()
+            self.drop_connection()
+            self.post_message("[DISCONNECTED] Lost connection to the server. Reconnecting...")
+            
+            delay = RECONNECT_MIN_DELAY
+            attempt = 0
+            while self.running:
+                if not self.reconnect_now.is_set():
+                    self.reconnect_now.wait(random.uniform(0, delay))
+                self.reconnect_now.clear()
+                if not self.running:
+                    break
+                attempt += 1
+                try:
+                    self.client = self.open_connection()
+                    resumed = self.start_session()
+                except PermissionError as e:
+                    self.post_message(f"[ERROR] Reconnection refused: {e}")
+                    self.running = False
+                    break
+                except Exception as e:
+                    self.drop_connection()
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                    if attempt in (1, 5) or attempt % 20 == 0:
+                        self.post_message(f"[INFO] Still reconnecting to {self.current_host}:{self.current_port} ({e}).")
+                    continue
+                
+                self.open_data_channel()
+                tls_note = " (TLS session resumed)" if getattr(self.client, "session_reused", False) else ""
+                if resumed:
+                    self.post_message(f"[INFO] Reconnected to {self.current_host}:{self.current_port}{tls_note}; missed messages follow.")
+                else:
+                    self.post_message(f"[INFO] Reconnected to {self.current_host}:{self.current_port}{tls_note} as a new session; messages sent while away may be missing.")
+                break
 
     def _create_file_icon(self):
         """Creates a simple file icon (64x64) for display in the chat log."""
@@ -176,23 +1075,73 @@ class ChatClient:
         port_entry = tk.Entry(setup_window, textvariable=port_var, width=20)
         port_entry.grid(row=1, column=1, padx=10, pady=10)
         
+        tls_var = tk.IntVar(value=1 if self.use_tls else 0)
+        tk.Checkbutton(setup_window, text="Use TLS", variable=tls_var).grid(row=2, column=0, padx=10, sticky='w')
+        
+        tk.Label(setup_window, text="TLS CA / server cert:").grid(row=3, column=0, padx=10, pady=10, sticky='w')
+        ca_var = tk.StringVar(value=self.tls_ca or "")
+        ca_entry = tk.Entry(setup_window, textvariable=ca_var, width=20)
+        ca_entry.grid(row=3, column=1, padx=10, pady=10)
+        tk.Button(setup_window, text="Browse...", 
+                  command=lambda: ca_var.set(filedialog.askopenfilename(title="Select CA certificate") or ca_var.get())
+                  ).grid(row=3, column=2, padx=(0, 10))
+        
+        tk.Label(setup_window, text="Pasted images:").grid(row=4, column=0, padx=10, pady=10, sticky='w')
+        preset_var = tk.StringVar(value=self.image_preset)
+        tk.OptionMenu(setup_window, preset_var, *IMAGE_PRESETS).grid(row=4, column=1, padx=10, sticky='ew')
+        
+        tk.Label(setup_window, text="Max size (px, 0 = full):").grid(row=5, column=0, padx=10, pady=10, sticky='w')
+        max_size_var = tk.StringVar(value=str(self.image_settings['max_dimension']))
+        tk.Entry(setup_window, textvariable=max_size_var, width=20).grid(row=5, column=1, padx=10, pady=10)
+        
+        tk.Label(setup_window, text="Quality (1-100):").grid(row=6, column=0, padx=10, pady=10, sticky='w')
+        quality_var = tk.StringVar(value=str(self.image_settings['quality'] or ""))
+        tk.Entry(setup_window, textvariable=quality_var, width=20).grid(row=6, column=1, padx=10, pady=10)
+        
+        def apply_preset(*_):
+            preset = IMAGE_PRESETS[preset_var.get()]
+            max_size_var.set(str(preset['max_dimension']))
+            quality_var.set(str(preset['quality'] or ""))
+        preset_var.trace_add('write', apply_preset)
+        
+        def save_image_settings():
+            settings = dict(IMAGE_PRESETS[preset_var.get()])
+            settings['max_dimension'] = max(0, int(max_size_var.get() or 0))
+            if settings['quality'] is not None:
+                settings['quality'] = min(100, max(1, int(quality_var.get())))
+            if settings != self.image_settings:
+                self.image_preset = preset_var.get()
+                self.image_settings = settings
+                if self.pending_image_source is not None:
+                    self.encode_pending_image() # Show the new size/time before it is sent
+        
         def save_and_reconnect():
             new_ip = ip_var.get()
             new_port = port_var.get()
+            new_tls = bool(tls_var.get())
+            new_ca = ca_var.get().strip() or None
             
             try:
                 new_port_int = int(new_port)
+                save_image_settings()
                 # Only update and reconnect if values changed
-                if new_ip != self.current_host or new_port_int != self.current_port:
+                if (new_ip != self.current_host or new_port_int != self.current_port
+                        or new_tls != self.use_tls or new_ca != self.tls_ca):
+                    if new_ip != self.current_host or new_port_int != self.current_port or new_ca != self.tls_ca:
+                        self.tls_session = None # A session only resumes against the same server
+                        self.tls_context = None
+                        self.session_token = None
                     self.current_host = new_ip
                     self.current_port = new_port_int
+                    self.use_tls = new_tls
+                    self.tls_ca = new_ca
                     self.insert_message(f"[INFO] Configuration saved. Attempting reconnect to {new_ip}:{new_port_int}...")
                     self.reconnect_to_server()
                 setup_window.destroy()
             except ValueError:
-                messagebox.showerror("Input Error", "Port must be a valid integer.")
+                messagebox.showerror("Input Error", "Port, max size and quality must be whole numbers.")
                 
-        tk.Button(setup_window, text="Save & Reconnect", command=save_and_reconnect).grid(row=2, column=0, columnspan=2, pady=10)
+        tk.Button(setup_window, text="Save & Reconnect", command=save_and_reconnect).grid(row=7, column=0, columnspan=3, pady=10)
         setup_window.transient(self.master)
         setup_window.grab_set()
         self.master.wait_window(setup_window)
@@ -244,36 +1193,10 @@ SOFTWARE.
         self.master.wait_window(about_window)
 
     def reconnect_to_server(self):
-        """Closes current connection and attempts to reconnect with new settings."""
-        self.running = False
-        try:
-            if self.client:
-                self.client.close()
-        except:
-            pass
-        
-        # Give thread a moment to stop
-        import time
-        time.sleep(0.1)
-
-        try:
-            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client.connect((self.current_host, self.current_port))
-            
-            # Re-send Name
-            self.client.send(self.name.encode(FORMAT))
-            
-            self.insert_message(f"[INFO] Successfully reconnected to {self.current_host}:{self.current_port}.")
-            
-            # Restart receiver thread
-            self.start_threads()
-            
-        except Exception as e:
-            messagebox.showerror(
-                "Reconnection Failed", 
-                f"Could not reconnect to server at {self.current_host}:{self.current_port}. Error: {e}"
-            )
-            self.insert_message("[ERROR] Reconnection failed. Client is currently disconnected.")
+        """Drops the current connection; the receive thread reconnects with the new settings right away."""
+        self.remember_tls_session()
+        self.reconnect_now.set()
+        self.drop_connection()
 
 
     # --- FILE ICON CLICK HANDLER ---
@@ -288,7 +1211,10 @@ SOFTWARE.
             if file_id_tag and file_id_tag in self.received_files:
                 filename, file_data = self.received_files[file_id_tag]
                 
-                self.master.after(0, lambda: self.open_received_file_in_app(filename, file_data))
+                if file_id_tag in self.received_manifests:
+                    self.open_archive_browser(filename, file_data, self.received_manifests[file_id_tag])
+                else:
+                    self.master.after(0, lambda: self.open_received_file_in_app(filename, file_data))
                 
             else:
                 self.insert_message("[ERROR] Could not find file data associated with this icon.")
@@ -321,29 +1247,86 @@ SOFTWARE.
             self.insert_message(f"[ERROR] Failed to open file {filename}: {e}")
             self.insert_message(f"[HINT] If the file failed to open, it may have been saved to the temp folder.")
 
+    def open_archive_browser(self, filename, file_data, files):
+        """Lists the files of a received archive; each one opens straight from the archive bytes."""
+        browser = Toplevel(self.master)
+        browser.title(f"{filename} ({len(files)} files)")
+        
+        listbox = tk.Listbox(browser, width=70, height=20)
+        listbox.pack(expand=True, fill='both', padx=10, pady=(10, 0))
+        for entry in files:
+            listbox.insert(tk.END, f"{entry['name']}  ({entry['size']} bytes)")
+        
+        def open_selected(event=None):
+            for index in listbox.curselection():
+                entry = files[index]
+                member = memoryview(file_data)[entry['offset']:entry['offset'] + entry['size']]
+                self.open_received_file_in_app(os.path.basename(entry['name']), member)
+        listbox.bind("<Double-Button-1>", open_selected)
+        
+        buttons = tk.Frame(browser)
+        buttons.pack(fill='x', padx=10, pady=10)
+        tk.Button(buttons, text="Open Selected", command=open_selected).pack(side='left')
+        tk.Button(buttons, text="Open Whole Archive",
+                  command=lambda: self.open_received_file_in_app(filename, file_data)).pack(side='right')
+
     # --- FILE DIALOG HANDLER ---
     def open_file_dialog(self):
-        file_path = filedialog.askopenfilename(
-            title="Select a file to send"
+        file_paths = filedialog.askopenfilenames(
+            title="Select file(s) to send"
         )
-        if file_path:
-            self.prepare_file_for_sending(file_path)
+        if len(file_paths) == 1:
+            self.prepare_file_for_sending(file_paths[0])
+        elif file_paths:
+            self.prepare_archive_for_sending(file_paths, f"files-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.tar")
+
+    def open_folder_dialog(self):
+        folder = filedialog.askdirectory(title="Select a folder to send")
+        if folder:
+            self.prepare_archive_for_sending([folder], os.path.basename(os.path.normpath(folder)) + ".tar")
+
+    def prepare_archive_for_sending(self, paths, archive_name):
+        try:
+            entries = collect_archive_entries(paths)
+            if not entries:
+                self.insert_message("[INFO] Nothing to send: no files found.")
+                return
+            # Headers and sizes only; the contents are read while sending
+            archive_size, chunks = plan_archive(entries)
+            
+            self.pending_image_bytes = None
+            self.pending_image_source = None
+            self.pending_image_encode = None
+            self.pending_file_path = None
+            self.pending_file_name = None
+            self.pending_archive = (archive_name.replace("|", "_"), archive_size, chunks)
+            
+            self.clear_input_field()
+            self.insert_input_text(f"[Archive Ready: {archive_name}, {len(entries)} files, {archive_size} bytes - Press Enter to Send]")
+
+        except Exception as e:
+            self.pending_archive = None
+            self.insert_message(f"[ERROR] Could not prepare {archive_name}: {e}")
 
     def prepare_file_for_sending(self, path):
         try:
-            with open(path, 'rb') as f:
-                file_bytes = f.read()
+            # Only the size is read now; the sender thread streams the contents from disk
+            file_size = os.path.getsize(path)
             
             self.pending_image_bytes = None
+            self.pending_image_source = None
+            self.pending_image_encode = None
+            self.pending_archive = None
             
-            self.pending_file_data = file_bytes
+            self.pending_file_path = path
             self.pending_file_name = os.path.basename(path)
+            self.pending_file_size = file_size
             
             self.clear_input_field()
-            self.insert_input_text(f"[File Ready: {self.pending_file_name}, {len(file_bytes)} bytes - Press Enter to Send]")
+            self.insert_input_text(f"[File Ready: {self.pending_file_name}, {file_size} bytes - Press Enter to Send]")
 
         except Exception as e:
-            self.pending_file_data = None
+            self.pending_file_path = None
             self.pending_file_name = None
             self.insert_message(f"[ERROR] Could not read file {path}: {e}")
 
@@ -365,31 +1348,48 @@ SOFTWARE.
 
     def send_smart_message(self):
         
-        if self.pending_image_bytes:
+        if self.pending_image_encode is not None:
+            self.insert_message("[INFO] The pasted image is still being encoded; press Enter again when it is ready.")
+
+        elif self.pending_image_bytes:
             # SEND IMAGE
             image_bytes = self.pending_image_bytes
-            try:
-                header = f"IMAGE|{len(image_bytes)}|".encode(FORMAT)
-                self.client.sendall(header + image_bytes)
-                self.insert_message(f"[YOU] Sent image ({len(image_bytes)} bytes).")
-            except Exception as e:
-                self.insert_message(f"[ERROR] Failed to send image: {e}")
+            header = f"IMAGE|{len(image_bytes)}|".encode(FORMAT)
+            self.queue_send([header, image_bytes],
+                            on_done=lambda: self.insert_message(f"[YOU] Sent image ({len(image_bytes)} bytes)."),
+                            on_error=lambda e: self.insert_message(f"[ERROR] Failed to send image: {e}"),
+                            bulk=True)
 
             self.pending_image_bytes = None
+            self.pending_image_source = None
             self.clear_input_field()
 
-        elif self.pending_file_data and self.pending_file_name:
+        elif self.pending_archive:
+            # SEND ARCHIVE (streamed: files are read from disk as the sender gets to them)
+            archive_name, archive_size, chunks = self.pending_archive
+            header = f"FILE|{archive_name}|{archive_size}|".encode(FORMAT)
+            self.insert_message(f"[YOU] Sending archive: {archive_name} ({archive_size} bytes)...")
+            self.queue_send(itertools.chain([header], chunks()),
+                            on_done=lambda: self.insert_message(f"[YOU] Sent archive: {archive_name} ({archive_size} bytes)."),
+                            on_error=lambda e: self.insert_message(f"[ERROR] Failed to send archive {archive_name}: {e}"),
+                            bulk=True)
+            
+            self.pending_archive = None
+            self.clear_input_field()
+
+        elif self.pending_file_path and self.pending_file_name:
             # SEND FILE
-            file_bytes = self.pending_file_data
+            file_path = self.pending_file_path
             file_name = self.pending_file_name
-            try:
-                header = f"FILE|{file_name}|{len(file_bytes)}|".encode(FORMAT)
-                self.client.sendall(header + file_bytes)
-                self.insert_message(f"[YOU] Sent file: {file_name} ({len(file_bytes)} bytes).")
-            except Exception as e:
-                self.insert_message(f"[ERROR] Failed to send file: {e}")
+            file_size = self.pending_file_size
+            header = f"FILE|{file_name}|{file_size}|".encode(FORMAT)
+            self.insert_message(f"[YOU] Sending file: {file_name} ({file_size} bytes)...")
+            self.queue_send(itertools.chain([header], read_file_chunks(file_path, file_size)),
+                            on_done=lambda: self.insert_message(f"[YOU] Sent file: {file_name} ({file_size} bytes)."),
+                            on_error=lambda e: self.insert_message(f"[ERROR] Failed to send file {file_name}: {e}"),
+                            bulk=True)
             
-            self.pending_file_data = None
+            self.pending_file_path = None
             self.pending_file_name = None
             self.clear_input_field()
 
@@ -397,25 +1397,29 @@ SOFTWARE.
             # SEND TEXT
             message = self.get_input_text()
             if message:
-                try:
-                    self.client.send(message.encode(FORMAT))
-                    self.clear_input_field()
-                except:
-                    self.insert_message("[ERROR] Could not send message.")
+                if not self.outbox.empty():
+                    self.insert_message("[INFO] Message queued; it goes out after the transfer in progress.")
+                self.queue_send([message.encode(FORMAT)],
+                                on_error=lambda e: self.insert_message(f"[ERROR] Could not send message: {e}"))
+                self.clear_input_field()
 
     # --- RECEIVING/DISPLAYING LOGIC ---
 
     def display_received_file(self, filename, file_data):
-        """Displays a clickable icon and filename in the chat log, prefixed by UTC timestamp."""
+        """Displays a clickable icon and filename in the chat log, prefixed by UTC timestamp.
+        Called from drain_ui_events, which makes the log writable around the batch."""
         try:
             utc_time = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')
             
             file_tag_id = "file_id_" + str(len(self.received_files))
             self.received_files[file_tag_id] = (filename, file_data)
+            files = read_archive_manifest(file_data) if filename.endswith(".tar") else None
             
-            self.chat_log.config(state='normal')
-            
-            self.chat_log.insert(tk.END, f"\n[{utc_time}] [FILE RECEIVED] Click to Open: ") 
+            if files is not None:
+                self.received_manifests[file_tag_id] = files
+                self.chat_log.insert(tk.END, f"\n[{utc_time}] [ARCHIVE RECEIVED, {len(files)} files] Click to Browse: ") 
+            else:
+                self.chat_log.insert(tk.END, f"\n[{utc_time}] [FILE RECEIVED] Click to Open: ") 
             
             if self.file_icon:
                 file_mark = self.chat_log.image_create(tk.END, image=self.file_icon)
@@ -424,27 +1428,43 @@ SOFTWARE.
 
             self.chat_log.insert(tk.END, f" {filename} ({len(file_data)} bytes)\n")
             
-            self.chat_log.yview(tk.END)
-            self.chat_log.config(state='disabled')
-            
         except Exception as e:
             self.insert_message(f"[ERROR] Failed to display received file placeholder: {e}")
 
 
-    def display_received_text(self, message):
-        self.chat_log.config(state='normal')
-        self.chat_log.insert(tk.END, message + '\n')
-        self.chat_log.yview(tk.END)
-        self.chat_log.config(state='disabled')
-
     def receive_messages(self):
+        """Reads messages until the connection drops; returns True if the server told us to leave."""
         while self.running:
             try:
                 # Optimized initial receive size
-                data = self.client.recv(1024) 
+                data = self.read(1024) 
                 if not data:
                     break 
                 
+                pong = PONG_MESSAGE.encode(FORMAT)
+                if data == pong:
+                    data = b""  # Servers before the heartbeat line
+                while data.startswith(pong + b"\n"):
+                    # A heartbeat answer is a line of its own and can arrive glued to the next message
+                    data = data[len(pong) + 1:]
+                if not data:
+                    self.resume_offset = self.stream_offset
+                    continue
+                
+                check = None
+                if data.startswith(DIGEST_MESSAGE.encode(FORMAT)):
+                    # The digest line comes glued to the file/image it is for; get that header too
+                    while digest_line_end(data) == -1 or upload_header_end(data, digest_line_end(data)) == -1:
+                        if len(data) > 4096:
+                            raise ValueError("no upload after the digest line")
+                        chunk = self.read(1024)
+                        if not chunk:
+                            raise Exception("Connection closed during data transfer.")
+                        data += chunk
+                    line_end = digest_line_end(data)
+                    check = start_digest(data[:line_end])
+                    data = data[line_end:]
+                
                 is_binary = data.startswith(b"IMAGE|") or data.startswith(b"FILE|")
                 
                 if is_binary:
@@ -464,45 +1484,58 @@ SOFTWARE.
                         
                     if second_split != -1:
                         header_end_index = second_split + 1
-                        content_data = data[header_end_index:]
+                        content_data = bytearray(data[header_end_index:]) # Appending to bytes would copy the body every chunk
+                        if check:
+                            check[0].update(content_data[:content_size])
                         
                         remaining_size = content_size - len(content_data)
                         while remaining_size > 0:
-                            chunk = self.client.recv(min(remaining_size, 4096))
+                            chunk = self.read(min(remaining_size, 65536))
                             if not chunk:
                                 raise Exception("Connection closed during data transfer.")
+                            if check:
+                                check[0].update(chunk)  # Hashed as it arrives, not reread at the end
                             content_data += chunk
                             remaining_size -= len(chunk)
+                        content_data = bytes(content_data)
+                        if check:
+                            self.verify_digest(*check, "An image" if is_image else filename)
 
                         if is_image:
-                            self.display_image(content_data)
+                            self.ui_events.put(('image', self.image_pool.submit(decode_thumbnail, content_data)))
                         else:
-                            self.display_received_file(filename, content_data)
+                            self.ui_events.put(('file', (filename, content_data)))
+                        self.resume_offset = self.stream_offset
                         
                         continue
+                
+                # The heartbeat answer is written on its own, so it can also come glued after a message
+                data = data.replace(pong + b"\n", b"")
+                if not data:
+                    self.resume_offset = self.stream_offset
+                    continue
                         
                 message = data.decode(FORMAT)
                 if message == DISCONNECT_MESSAGE:
-                    break
+                    return True
+                if message.startswith(ERROR_MESSAGE):
+                    message = "[SERVER ERROR] " + message[len(ERROR_MESSAGE):].strip()
                 
-                self.display_received_text(message)
+                self.ui_events.put(('text', message))
+                self.resume_offset = self.stream_offset
                 
             except Exception as e:
                 print(f"Error in receiver: {e}")
-                self.running = False
                 break
-        
-        self.insert_message("[DISCONNECTED] Lost connection to the server.")
-        # Ensure the client is closed after the loop breaks
-        if self.client:
-            self.client.close()
+        return False
 
     # --- Utility and Image Methods ---
     
     def handle_paste_image(self, event):
         """Prepares clipboard image for sending via Ctrl+V or Cmd+V."""
-        self.pending_file_data = None
+        self.pending_file_path = None
         self.pending_file_name = None
+        self.pending_archive = None
         # Use after(50) to allow the OS to fully place the content in the clipboard
         self.master.after(50, lambda: self._process_clipboard_after_paste())
         return "break" # Prevent the default paste action
@@ -513,53 +1546,43 @@ SOFTWARE.
             
             if img is None or not isinstance(img, Image.Image):
                 self.pending_image_bytes = None
+                self.pending_image_source = None
                 return
 
-            byte_arr = io.BytesIO()
-            original_img = img.copy() 
-            # Resize thumbnail for input field display (not sending)
-            max_size = (300, 300) 
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            # Save the *original* image to bytes for sending as JPEG
-            original_img.save(byte_arr, format='JPEG')
-            image_bytes = byte_arr.getvalue()
-            
-            self.pending_image_bytes = image_bytes
-            
-            self.clear_input_field()
-            self.insert_input_text(f"[Image Ready: {original_img.width}x{original_img.height} - Press Enter to Send]")
+            self.pending_image_source = img
+            self.encode_pending_image()
             
         except Exception as e:
             self.pending_image_bytes = None
             self.insert_message(f"[ERROR] Failed to handle paste: {e}")
 
-    def _resize_image_viewer(self, event, original_img, label):
-        """Scales the image to fit the new size of the Toplevel window."""
-        
-        new_width = max(1, event.width)
-        new_height = max(1, event.height)
-        
-        original_aspect = original_img.width / original_img.height
+    def encode_pending_image(self):
+        """Encodes the pasted image with the current image settings on the worker pool."""
+        img = self.pending_image_source
+        self.pending_image_bytes = None
+        self.clear_input_field()
+        self.insert_input_text(f"[Encoding image {img.width}x{img.height}...]")
         
-        # Determine the maximum fit size while maintaining aspect ratio
-        if new_width / new_height > original_aspect:
-            scale_height = new_height
-            scale_width = int(scale_height * original_aspect)
-        else:
-            scale_width = new_width
-            scale_height = int(scale_width / original_aspect)
+        future = self.image_pool.submit(encode_screenshot, img, dict(self.image_settings))
+        self.pending_image_encode = future
+        future.add_done_callback(lambda f: self.ui_events.put(('call', (self.on_image_encoded, f))))
 
-        scale_width = max(1, scale_width)
-        scale_height = max(1, scale_height)
-        
-        # Resize and convert to PhotoImage
-        resized_img = original_img.copy().resize((scale_width, scale_height), Image.Resampling.LANCZOS)
-        tk_resized_img = ImageTk.PhotoImage(resized_img)
+    def on_image_encoded(self, future):
+        if future is not self.pending_image_encode:
+            return # Superseded by a newer paste or a file
+        self.pending_image_encode = None
+        img = self.pending_image_source
+        try:
+            image_bytes, description = future.result()
+        except Exception as e:
+            self.pending_image_source = None
+            self.clear_input_field()
+            self.insert_message(f"[ERROR] Failed to encode pasted image: {e}")
+            return
         
-        # Update the label and store the reference
-        label.config(image=tk_resized_img)
-        label.image = tk_resized_img # Crucial to prevent garbage collection
+        self.pending_image_bytes = image_bytes
+        self.clear_input_field()
+        self.insert_input_text(f"[Image Ready: {img.width}x{img.height} -> {description} - Press Enter to Send]")
 
     def on_image_click(self, event):
         """Opens a Toplevel window to view the full-size image."""
@@ -569,56 +1592,28 @@ SOFTWARE.
             image_id_tag = next((tag for tag in image_tags if tag.startswith("img_") and tag != "img_tag"), None)
 
             if image_id_tag and image_id_tag in self.original_images:
-                original_img = self.original_images[image_id_tag]
-                
-                # 1. Create the Toplevel window
-                img_window = Toplevel(self.master)
-                img_window.title(f"Full Image View ({original_img.width}x{original_img.height})")
-
-                screen_width = img_window.winfo_screenwidth()
-                screen_height = img_window.winfo_screenheight()
-                
-                initial_width = min(original_img.width, screen_width - 100)
-                initial_height = min(original_img.height, screen_height - 100)
-                
-                img_window.geometry(f"{initial_width}x{initial_height}")
-
-                # 2. Create the initial PhotoImage and Label
-                initial_resized_img = original_img.copy().resize((initial_width, initial_height), Image.Resampling.LANCZOS)
-                tk_full_img = ImageTk.PhotoImage(initial_resized_img)
-
-                label = tk.Label(img_window, image=tk_full_img, bg='gray')
-                label.image = tk_full_img
-                label.pack(expand=True, fill='both') 
-
-                # 3. Bind the <Configure> event to the window for resizing
-                img_window.bind('<Configure>', 
-                                lambda e: self._resize_image_viewer(e, original_img, label))
-                                
+                # The pyramid is kept, so opening the same image again reuses its scaled copies
+                if image_id_tag not in self.image_pyramids:
+                    self.image_pyramids[image_id_tag] = ImagePyramid(self.original_images[image_id_tag])
+                ImageViewer(self.master, self.image_pyramids[image_id_tag])
             else:
                 self.insert_message("[ERROR] Could not find original image data or unique tag.")
 
         except Exception as e:
             print(f"Error handling image click: {e}")
 
-    def display_image(self, image_data):
-        """Displays a thumbnail of the received image in the chat log."""
+    def display_image(self, decoded):
+        """Displays a thumbnail of the received image in the chat log (from drain_ui_events).
+        `decoded` is the finished decode_thumbnail future; only the PhotoImage is made here."""
         try:
             utc_time = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')
             
-            image_stream = io.BytesIO(image_data)
-            original_img = Image.open(image_stream)
-            
-            display_img = original_img.copy()
-            max_display_size = (200, 200)
-            display_img.thumbnail(max_display_size, Image.Resampling.LANCZOS)
+            display_img, original_img = decoded.result()
             tk_thumb_img = ImageTk.PhotoImage(display_img)
             
             image_tag_id = "img_" + str(len(self.image_references)) 
             self.original_images[image_tag_id] = original_img
             
-            self.chat_log.config(state='normal')
-            
             self.chat_log.insert(tk.END, f"\n[{utc_time}] [IMAGE RECEIVED] Click to View: ") 
             
             image_mark = self.chat_log.image_create(tk.END, image=tk_thumb_img)
@@ -628,8 +1623,6 @@ SOFTWARE.
             
             self.chat_log.insert(tk.END, "\n")
             self.image_references.append(tk_thumb_img) 
-            self.chat_log.yview(tk.END)
-            self.chat_log.config(state='disabled')
             
         except Exception as e:
             print(f"Error in display_image: {e}")
@@ -645,17 +1638,37 @@ SOFTWARE.
     def on_closing(self):
         """Handles graceful client shutdown and GUI destruction."""
         self.running = False
+        self.reconnect_now.set() # Wake the reconnect loop so it sees we are closing
+        self.outbox.put(None) # Stop the sender threads
+        self.bulk_outbox.put(None)
+        self.image_pool.shutdown(wait=False, cancel_futures=True)
         try:
             if self.client:
-                # Signal disconnect to the server
-                self.client.send(DISCONNECT_MESSAGE.encode(FORMAT))
-                self.client.close()
+                # Signal disconnect to the server (skipped if an upload is still being written)
+                self.send_bytes(DISCONNECT_MESSAGE.encode(FORMAT), blocking=False)
+                self.drop_connection()
+            self.close_data_channel()
         except:
             pass 
         if self.master.winfo_exists():
              self.master.destroy()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incident Recorder chat client")
+    parser.add_argument("--host", default=ChatClient.DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=ChatClient.DEFAULT_PORT)
+    parser.add_argument("--tls", action="store_true", help="connect with TLS")
+    parser.add_argument("--tls-ca", default=None, help="CA or server certificate to trust (PEM)")
+    parser.add_argument("--image-preset", default=DEFAULT_IMAGE_PRESET, choices=list(IMAGE_PRESETS),
+                        help="how pasted screenshots are scaled and compressed")
+    parser.add_argument("--no-nodelay", action="store_true", help="leave Nagle's algorithm on")
+    parser.add_argument("--sndbuf-kb", type=int, default=0, help="socket send buffer in KB (0: OS default)")
+    parser.add_argument("--rcvbuf-kb", type=int, default=0, help="socket receive buffer in KB (0: OS default)")
+    args = parser.parse_args()
+    TCP_NODELAY_ON = not args.no_nodelay
+    SEND_BUFFER_BYTES = args.sndbuf_kb * 1024
+    RECEIVE_BUFFER_BYTES = args.rcvbuf_kb * 1024
+    
     root = tk.Tk()
-    app = ChatClient(root)
+    app = ChatClient(root, host=args.host, port=args.port, use_tls=args.tls, tls_ca=args.tls_ca, image_preset=args.image_preset)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,1040 @@
+import socket
+import threading
+import subprocess
+import argparse
+import tempfile
+import time
+import sys
+import os
+import re
+import ssl
+import json
+import struct
+import io
+import importlib.util
+import tracemalloc
+import tarfile
+import hashlib
+import shutil
+import contextlib
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Benchmark Settings ---
+# Runs the chat server headless in a scratch directory and drives it with
+# synthetic clients over localhost. Results are printed as plain tables.
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chatServer_1.6.py")
+FORMAT = 'utf-8'
+BENCH_HOST = '127.0.0.1'
+BENCH_PORT = 57101
+CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Client", "client chat program v1_4.py")
+
+
+# --- Helpers ---
+
+def start_server(port, users, extra_args=(), workdir=None, script=SERVER_SCRIPT):
+    """Starts a headless server process and waits until it accepts connections."""
+    workdir = workdir or tempfile.mkdtemp(prefix="chat_bench_")
+    command = [sys.executable, script, "--headless", "--port", str(port),
+               "--users", ",".join(users)] + list(extra_args)
+    if "--config" not in extra_args:
+        # Benchmarks send far faster than a person; measure the server, not the rate limiter
+        config = os.path.join(workdir, "bench_config.json")
+        with open(config, "w") as f:
+            json.dump({"rate_limits": {"default": {"messages_per_second": 0, "bytes_per_second": 0}}}, f)
+        command += ["--config", config]
+    if "--max-pending-per-ip" not in extra_args:
+        # Every client of a benchmark logs in from this one address, and all at once
+        command += ["--max-pending", str(max(64, len(users))), "--max-pending-per-ip", str(max(8, len(users)))]
+    if "--metrics-port" not in extra_args:
+        command += ["--metrics-port", str(port + 1000)]
+    process = subprocess.Popen(command, cwd=workdir, stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((BENCH_HOST, port), timeout=0.5).close()
+            time.sleep(0.3)  # Let every worker reach accept()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+def stop_server(process):
+    try:
+        process.stdin.write(b"quit\n")
+        process.stdin.flush()
+        process.wait(timeout=10)
+    except Exception:
+        process.kill()
+
+def connect_client(port, name):
+    sock = socket.create_connection((BENCH_HOST, port))
+    sock.sendall(name.encode(FORMAT))
+    time.sleep(0.05)
+    return sock
+
+def wait_for_marker(sock, marker, buffer):
+    """Reads until marker appears; buffer carries leftover bytes between calls."""
+    while marker not in buffer:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        buffer += data
+    index = buffer.index(marker) + len(marker)
+    return buffer[index:]
+
+
+# --- Worker Scaling ---
+
+def echo_client(port, name, messages, results, start_event):
+    """Sends messages one at a time, waiting for each broadcast echo."""
+    sock = connect_client(port, name)
+    buffer = b""
+    start_event.wait()
+    started = time.perf_counter()
+    for i in range(messages):
+        marker = f"#{name}-{i}#".encode(FORMAT)
+        sock.sendall(marker)
+        buffer = wait_for_marker(sock, marker, buffer)
+        # Discard what other clients said so the buffer stays small
+        buffer = buffer[-64:]
+    results.append(time.perf_counter() - started)
+    sock.close()
+
+def bench_scaling(args):
+    """Round trips per second through the broadcast path for 1..N workers."""
+    worker_counts = [int(n) for n in args.workers.split(",")]
+    print(f"{'workers':>8}{'clients':>9}{'msgs/client':>13}{'round trips/s':>15}{'deliveries/s':>15}")
+    for run, workers in enumerate(worker_counts):
+        users = [f"bench{i}" for i in range(args.clients)]
+        extra = ["--workers", str(workers)] if workers > 1 else []
+        port = args.port + run  # A fresh port avoids TIME_WAIT from the previous run
+        process = start_server(port, users, extra)
+        try:
+            results = []
+            start_event = threading.Event()
+            threads = [threading.Thread(target=echo_client, args=(port, user, args.messages, results, start_event))
+                       for user in users]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.5)
+            started = time.perf_counter()
+            start_event.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            round_trips = args.clients * args.messages
+            print(f"{workers:>8}{args.clients:>9}{args.messages:>13}{round_trips / elapsed:>15.0f}"
+                  f"{round_trips * args.clients / elapsed:>15.0f}")
+        finally:
+            stop_server(process)
+        time.sleep(0.5)
+
+
+# --- Federation ---
+
+def bench_federation(args):
+    """Chains N servers on localhost and measures end-to-end relay latency and lazy fetch."""
+    users = ["first", "last"]
+    ports = [args.port + i for i in range(args.servers)]
+    processes = []
+    try:
+        for i, port in enumerate(ports):
+            extra = ["--server-id", f"s{i + 1}", "--peer-secret", "bench"]
+            if i > 0:
+                extra += ["--peer", f"{BENCH_HOST}:{ports[i - 1]}"]
+            processes.append(start_server(port, users, extra))
+        time.sleep(1.5)  # Peer links are dialed in the background
+
+        first = connect_client(ports[0], "first")
+        last = connect_client(ports[-1], "last")
+        time.sleep(0.3)
+
+        latencies = []
+        buffer = b""
+        for i in range(args.messages):
+            marker = f"#relay-{i}#".encode(FORMAT)
+            started = time.perf_counter()
+            first.sendall(marker)
+            buffer = wait_for_marker(last, marker, buffer)
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        print(f"{args.servers} servers, {args.messages} messages first -> last:")
+        print(f"  relay latency p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms")
+
+        body = os.urandom(args.file_size)
+        first.sendall(f"FILE|bench.bin|{len(body)}|".encode(FORMAT) + body)
+        match = None
+        while match is None:
+            buffer += last.recv(65536)
+            match = re.search(rb"!FETCH (\S+) to download", buffer)
+        started = time.perf_counter()
+        last.sendall(b"!FETCH " + match.group(1))
+        header = f"FILE|bench.bin|{len(body)}|".encode(FORMAT)
+        buffer = wait_for_marker(last, header, b"")
+        received = len(buffer)
+        while received < len(body):
+            received += len(last.recv(1024 * 1024))
+        elapsed = time.perf_counter() - started
+        print(f"  lazy fetch of {len(body)} bytes across {args.servers - 1} links: {elapsed * 1000:.1f} ms")
+        first.close()
+        last.close()
+    finally:
+        for process in processes:
+            stop_server(process)
+
+
+# --- TLS ---
+
+def generate_certificate(directory):
+    """Creates a self-signed certificate for 127.0.0.1 with the openssl CLI."""
+    cert = os.path.join(directory, "bench_cert.pem")
+    key = os.path.join(directory, "bench_key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+                    "-days", "2", "-subj", "/CN=chat-bench", "-addext", "subjectAltName=IP:127.0.0.1"],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+def tls_connect(port, context, name, session=None):
+    """Connects, authenticates and reads the join notice; returns the socket."""
+    sock = socket.create_connection((BENCH_HOST, port))
+    if context:
+        sock = context.wrap_socket(sock, server_hostname=BENCH_HOST, session=session)
+    sock.sendall(name.encode(FORMAT))
+    sock.recv(1024)  # Join notice; also delivers TLS 1.3 session tickets
+    return sock
+
+def bench_tls(args):
+    """Handshake rate, reconnect storm and bulk throughput with TLS off and on."""
+    workdir = tempfile.mkdtemp(prefix="chat_bench_tls_")
+    cert, key = (args.cert, args.key) if args.cert else generate_certificate(workdir)
+    client_context = ssl.create_default_context(cafile=cert)
+    client_context.check_hostname = False
+
+    modes = [("plain", None, []), ("tls", client_context, ["--tls-cert", cert, "--tls-key", key])]
+    print(f"{'mode':<14}{'connects/s':>12}{'storm (s)':>11}{'resumed':>9}{'failed':>8}{'bulk MB/s':>11}")
+    for run, (label, context, extra) in enumerate(modes):
+        port = args.port + run  # A fresh port avoids TIME_WAIT from the previous run
+        process = start_server(port, ["bench"], extra)
+        try:
+            for resume in ([False, True] if context else [False]):
+                first = tls_connect(port, context, "bench")
+                session = first.session if (context and resume) else None
+                first.close()
+
+                started = time.perf_counter()
+                for _ in range(args.connections):
+                    tls_connect(port, context, "bench", session).close()
+                rate = args.connections / (time.perf_counter() - started)
+
+                storm = []
+                failures = []
+                def reconnect():
+                    try:
+                        storm.append(tls_connect(port, context, "bench", session))
+                    except OSError as e:
+                        failures.append(e)
+                threads = [threading.Thread(target=reconnect) for _ in range(args.storm)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                storm_seconds = time.perf_counter() - started
+                resumed = sum(1 for sock in storm if getattr(sock, "session_reused", False))
+                for sock in storm:
+                    sock.close()
+
+                sender = tls_connect(port, context, "bench", session)
+                body = os.urandom(args.bulk_mb * 1024 * 1024)
+                header = f"FILE|bulk.bin|{len(body)}|".encode(FORMAT)
+                started = time.perf_counter()
+                sender.sendall(header + body)
+                buffer = wait_for_marker(sender, header, b"")
+                received = len(buffer)
+                while received < len(body):
+                    received += len(sender.recv(1024 * 1024))
+                bulk = 2 * len(body) / (time.perf_counter() - started) / (1024 * 1024)  # Up and back
+                sender.close()
+
+                mode = label + (" resumed" if resume else " full" if context else "")
+                print(f"{mode:<14}{rate:>12.0f}{storm_seconds:>11.2f}{resumed:>9}{len(failures):>8}{bulk:>11.1f}")
+                time.sleep(0.5)
+        finally:
+            stop_server(process)
+        time.sleep(0.5)
+
+
+# --- Admission Control ---
+
+def read_metrics(port):
+    """Returns the server's Prometheus output as {series: value}."""
+    text = urllib.request.urlopen(f"http://{BENCH_HOST}:{port + 1000}/metrics", timeout=5).read().decode(FORMAT)
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            series, _, value = line.rpartition(" ")
+            values[series] = float(value)
+    return values
+
+def measure_latency(sock, messages, buffer=b""):
+    latencies = []
+    for i in range(messages):
+        marker = f"#probe-{i}-{time.perf_counter()}#".encode(FORMAT)
+        started = time.perf_counter()
+        sock.sendall(marker)
+        buffer = wait_for_marker(sock, marker, buffer)[-64:]
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.01)
+    latencies.sort()
+    return latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000
+
+def flood(port, stop, opened):
+    """Opens connections that never authenticate: some stay silent, some send a bad name."""
+    held = []
+    while not stop.is_set():
+        try:
+            sock = socket.create_connection((BENCH_HOST, port), timeout=2)
+            opened.append(1)
+            if len(opened) % 2:
+                sock.sendall(b"intruder")
+            held.append(sock)
+        except OSError:
+            pass
+        if len(held) > 200:
+            for sock in held[:100]:
+                sock.close()
+            del held[:100]
+    for sock in held:
+        sock.close()
+
+def bench_admission(args):
+    """Chat latency of an authorized client while the port is flooded with unauthenticated connections."""
+    port = args.port
+    process = start_server(port, ["bench"], ["--auth-timeout", str(args.auth_timeout)])
+    try:
+        client = connect_client(port, "bench")
+        time.sleep(0.3)
+        p50, p99 = measure_latency(client, args.messages)
+        print(f"{'phase':<10}{'p50 ms':>9}{'p99 ms':>9}{'server threads':>16}{'connects':>10}{'refused':>9}")
+        print(f"{'idle':<10}{p50:>9.2f}{p99:>9.2f}{read_metrics(port).get('chat_threads', 0):>16.0f}{0:>10}{0:>9}")
+
+        stop = threading.Event()
+        opened = []
+        flooders = [threading.Thread(target=flood, args=(port, stop, opened)) for _ in range(args.flooders)]
+        for thread in flooders:
+            thread.start()
+        time.sleep(1)
+        p50, p99 = measure_latency(client, args.messages)
+        values = read_metrics(port)
+        threads = values.get('chat_threads', 0)
+        refused = sum(v for k, v in values.items() if k.startswith('chat_admission_rejects_total'))
+        stop.set()
+        for thread in flooders:
+            thread.join()
+        print(f"{'flood':<10}{p50:>9.2f}{p99:>9.2f}{threads:>16.0f}{len(opened):>10}{refused:>9.0f}")
+        client.close()
+    finally:
+        stop_server(process)
+
+
+# --- Bulk Transfers ---
+
+PROBE_PATTERN = re.compile(rb"#probe-(\d+)#")
+
+def read_line(sock):
+    line = b""
+    while not line.endswith(b"\n"):
+        byte = sock.recv(1)
+        if not byte:
+            raise ConnectionError("server closed the connection")
+        line += byte
+    return line.decode(FORMAT).split()
+
+def login(port, name, data_channel):
+    """Returns (chat socket, data socket or None); with data_channel the client logs in
+    as a resumable client and opens the data connection the server offers."""
+    if not data_channel:
+        return connect_client(port, name), None
+    sock = socket.create_connection((BENCH_HOST, port))
+    sock.sendall(f"{name}\n!RESUME".encode(FORMAT))
+    session = read_line(sock)
+    if len(session) < 4:
+        raise RuntimeError("server did not offer a data connection")
+    data = socket.create_connection((BENCH_HOST, port))
+    data.sendall(f"!DATA {session[3]}\n".encode(FORMAT))
+    if read_line(data) != ["!DATA", "ready"]:
+        raise RuntimeError("data connection refused")
+    return sock, data
+
+def drain(sock, received, probes=None, rate=None):
+    """Reads everything from sock, counting bytes and noting when each probe arrives.
+    rate (bytes/s) reads no faster than that, like a client on a slower link."""
+    tail = b""
+    started = time.perf_counter()
+    while True:
+        if rate:
+            time.sleep(max(0, received[0] / rate - (time.perf_counter() - started)))
+        try:
+            data = sock.recv(65536 if rate else 1 << 20)
+        except OSError:
+            return
+        if not data:
+            return
+        now = time.perf_counter()
+        received[0] += len(data)
+        if probes is not None:
+            window = tail + data
+            for match in PROBE_PATTERN.finditer(window):
+                probes.setdefault(int(match.group(1)), now)
+            tail = data[-32:]
+
+def bench_bulk(args):
+    """Chat latency seen by one client while another sends it a large file, with and
+    without the separate data connection. The watcher reads at --link-mbit, so the
+    server has to queue the body for it as it would for a remote responder."""
+    port = args.port
+    size = args.file_mb * 1024 * 1024
+    rate = args.link_mbit * 1000 * 1000 / 8
+    print(f"{'mode':<18}{'probes':>7}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'transfer s':>12}")
+    for mode, data_channel in (("shared", False), ("data connection", True)):
+        port += 1  # A fresh port; the last one may still be in TIME_WAIT
+        process = start_server(port, ["watcher", "sender", "prober"])
+        try:
+            sockets = {name: login(port, name, data_channel) for name in ("watcher", "sender", "prober")}
+            time.sleep(0.3)
+            sent, arrived, body_bytes = {}, {}, [0]
+            readers = []
+            for name, (chat, data) in sockets.items():
+                watcher = name == "watcher"
+                counter = body_bytes if watcher and data is None else [0]
+                readers.append(threading.Thread(target=drain, daemon=True,
+                                                args=(chat, counter, arrived if watcher else None, rate if watcher and data is None else None)))
+                if data is not None:
+                    readers.append(threading.Thread(target=drain, daemon=True,
+                                                    args=(data, body_bytes if watcher else [0], None, rate if watcher else None)))
+            for thread in readers:
+                thread.start()
+            
+            chat, data = sockets["sender"]
+            def upload():
+                target = data or chat
+                target.sendall(f"FILE|bench.bin|{size}|".encode(FORMAT))
+                chunk = b"\0" * (1 << 20)
+                for _ in range(args.file_mb):
+                    target.sendall(chunk)
+            started = time.perf_counter()
+            uploader = threading.Thread(target=upload, daemon=True)
+            uploader.start()
+            
+            # Probe while the body is still on its way to the watcher
+            prober = sockets["prober"][0]
+            i = 0
+            while body_bytes[0] < size and time.perf_counter() - started < args.timeout:
+                sent[i] = time.perf_counter()
+                prober.sendall(f"#probe-{i}#".encode(FORMAT))
+                i += 1
+                time.sleep(0.02)
+            transfer = time.perf_counter() - started
+            deadline = time.perf_counter() + 10
+            while len(arrived) < len(sent) and time.perf_counter() < deadline:
+                time.sleep(0.05)
+            latencies = sorted((arrived[k] - sent[k]) * 1000 for k in sent if k in arrived)
+            if latencies:
+                p50 = latencies[len(latencies) // 2]
+                p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+                print(f"{mode:<18}{len(latencies):>7}{p50:>9.1f}{p99:>9.1f}{latencies[-1]:>9.1f}{transfer:>12.2f}")
+            else:
+                print(f"{mode:<18}{0:>7}{'-':>9}{'-':>9}{'-':>9}{transfer:>12.2f}")
+            for chat, data in sockets.values():
+                chat.close()
+                if data is not None:
+                    data.close()
+        finally:
+            stop_server(process)
+
+
+# --- Image Decoding ---
+
+def load_client_module():
+    """Imports the chat client (its file name has spaces) without starting the GUI."""
+    spec = importlib.util.spec_from_file_location("chat_client", CLIENT_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_screenshot(width, height, image_format):
+    """A screenshot-like test image: flat panels, text-ish lines and a gradient strip."""
+    from PIL import Image, ImageDraw
+    img = Image.new('RGB', (width, height), (236, 236, 236))
+    draw = ImageDraw.Draw(img)
+    for x in range(width):
+        draw.line([(x, 0), (x, height // 12)], fill=(40, 80 + x * 120 // width, 160))
+    for i, top in enumerate(range(height // 10, height, max(12, height // 60))):
+        left = (i * 37) % (width // 3)
+        draw.rectangle([left, top, left + width // 2, top + 6], fill=(30 + i % 5 * 20, 30, 30))
+    draw.rectangle([width * 2 // 3, height // 5, width - 20, height - 20], fill=(255, 255, 255), outline=(90, 90, 90))
+    data = io.BytesIO()
+    if image_format == 'JPEG':
+        img.save(data, format=image_format, quality=85)
+    else:
+        img.save(data, format=image_format)
+    return data.getvalue()
+
+def full_decode_thumbnail(image_data):
+    """What display_image used to do on the receive thread."""
+    from PIL import Image
+    original = Image.open(io.BytesIO(image_data))
+    thumb = original.copy()
+    thumb.thumbnail((200, 200), Image.Resampling.LANCZOS)
+    return thumb, original
+
+def images_per_second(decode, images, workers):
+    started = time.perf_counter()
+    if workers <= 1:
+        for data in images:
+            decode(data)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(decode, images))
+    return len(images) / (time.perf_counter() - started)
+
+def bench_images(args):
+    """Thumbnails per second for received screenshots: old full decode vs draft/reduce, serial and pooled."""
+    client = load_client_module()
+    workers = args.workers or client.IMAGE_DECODE_WORKERS
+    print(f"{'image':<16}{'format':>7}{'KB':>7}{'full img/s':>12}{'draft img/s':>13}{f'pool x{workers} img/s':>16}")
+    for size in args.sizes.split(','):
+        width, height = (int(v) for v in size.split('x'))
+        for image_format in args.formats.upper().split(','):
+            data = make_screenshot(width, height, image_format)
+            images = [data] * args.count
+            full = images_per_second(full_decode_thumbnail, images, 1)
+            draft = images_per_second(client.decode_thumbnail, images, 1)
+            pooled = images_per_second(client.decode_thumbnail, images, workers)
+            print(f"{size:<16}{image_format:>7}{len(data) // 1024:>7}{full:>12.1f}{draft:>13.1f}{pooled:>16.1f}")
+
+
+# --- Downloads ---
+
+def load_server_module():
+    """Imports the chat server (its file name has a dot) without starting it."""
+    spec = importlib.util.spec_from_file_location("chat_server", SERVER_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def tcp_pair():
+    """A connected pair of loopback TCP sockets."""
+    listener = socket.create_server((BENCH_HOST, 0))
+    client = socket.create_connection(listener.getsockname())
+    server_side, _ = listener.accept()
+    listener.close()
+    return server_side, client
+
+def read_exactly(sock, size, buffer):
+    remaining = size
+    while remaining:
+        received = sock.recv_into(buffer, min(remaining, len(buffer)))
+        if not received:
+            raise ConnectionError("closed early")
+        remaining -= received
+
+def serve_concurrently(serve, clients, size):
+    """Seconds and peak Python memory for serving one download to each of clients readers at once."""
+    pairs = [tcp_pair() for _ in range(clients)]
+    # Readers reuse one buffer each, so the peak only counts what serving allocates
+    readers = [threading.Thread(target=read_exactly, args=(client, size, bytearray(1 << 20))) for _, client in pairs]
+    for thread in readers:
+        thread.start()
+    tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(serve, [server_side for server_side, _ in pairs]))
+    for thread in readers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    for pair in pairs:
+        for sock in pair:
+            sock.close()
+    return elapsed, peak
+
+def bench_downloads(args):
+    """Serving one stored file to several clients at once: read into bytes first (how
+    !FETCH used to do it) against the server's StoredFile over sendfile() and over mmap."""
+    server = load_server_module()
+    workdir = tempfile.mkdtemp(prefix="chat_bench_dl_")
+    path = os.path.join(workdir, "evidence.bin")
+    with open(path, "wb") as f:
+        for _ in range(args.file_mb):
+            f.write(os.urandom(1 << 20))
+    size = args.file_mb << 20
+    header = f"FILE|evidence.bin|{size}|".encode(FORMAT)
+    
+    def buffered(sock):
+        with open(path, 'rb') as f:
+            body = f.read()
+        sock.sendall(header + body)
+    def sendfile(sock):
+        body = server.StoredFile(header, path, 0, size)
+        body.write_to(sock, 0, len(body))
+    def mapped(sock):
+        body = server.StoredFile(header, path, 0, size)
+        sock.sendall(header)
+        body.send_mapped(sock, 0, size)
+    
+    print(f"{'clients':<9}{'mode':<10}{'MB/s':>9}{'peak MB':>9}")
+    for clients in (int(n) for n in args.clients.split(',')):
+        for mode, serve in (("buffered", buffered), ("sendfile", sendfile), ("mmap", mapped)):
+            elapsed, peak = serve_concurrently(serve, clients, len(header) + size)
+            print(f"{clients:<9}{mode:<10}{clients * size / elapsed / 1e6:>9.0f}{peak / 1e6:>9.1f}")
+    os.remove(path)
+
+
+# --- Evidence Export ---
+
+def make_evidence_set(directory, total_bytes, file_bytes):
+    """A journal plus stored files: one in four is log-like text, the rest incompressible like screenshots."""
+    files_dir = os.path.join(directory, "files")
+    os.makedirs(files_dir)
+    noise = os.urandom(file_bytes)
+    text = b"".join(f"[2026-10-19 04:{i // 60 % 60:02d}:{i % 60:02d} UTC] [INFO] [host-{i % 97}]: process {i} exited with status 0\n".encode(FORMAT)
+                    for i in range(file_bytes // 70 + 1))[:file_bytes]
+    with open(os.path.join(directory, "chat_server.log"), "w", encoding=FORMAT) as journal:
+        for i in range(max(1, total_bytes // file_bytes)):
+            name = f"2026-10-19 04-00-{i % 60:02d} UTC_artifact{i}.bin"
+            with open(os.path.join(files_dir, name), "wb") as f:
+                f.write(str(i).encode(FORMAT))  # Every file different
+                f.write(text if i % 4 == 0 else noise)
+            journal.write(f"[2026-10-19 04:00:00 UTC] [INFO] [responder{i % 5}]: Sent FILE ({file_bytes} bytes) - Saved as {os.path.join('files', name)}\n")
+
+def serial_export(destination):
+    """The manual way: tar czf, then sha256sum every file."""
+    with tarfile.open(destination, "w:gz", compresslevel=6) as tar:
+        tar.add("chat_server.log")
+        tar.add("files")
+    for current, _, names in os.walk("files"):
+        for name in names:
+            digest = hashlib.sha256()
+            with open(os.path.join(current, name), "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+
+def bench_export(args):
+    """Evidence export throughput: tar.gz then hashing, one thread, against export_evidence."""
+    server = load_server_module()
+    workdir = tempfile.mkdtemp(prefix="chat_bench_export_", dir=args.dir)
+    evidence = os.path.join(workdir, "evidence")
+    total = int(args.total_gb * (1 << 30))
+    print(f"Writing a {args.total_gb:g} GB evidence set to {evidence}...")
+    make_evidence_set(evidence, total, args.file_mb << 20)
+    workers = args.workers or server.EXPORT_WORKERS
+    previous = os.getcwd()
+    os.chdir(evidence)
+    try:
+        print(f"{'mode':<24}{'seconds':>9}{'MB/s':>8}{'archive MB':>12}")
+        for mode, run in (("tar.gz + sha256sum", lambda path: serial_export(path)),
+                          (f"export x{workers}", lambda path: server.export_evidence(path, os.path.join(workdir, "key"), workers))):
+            destination = os.path.join(workdir, "export.tar.gz")
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                run(destination)
+            elapsed = time.perf_counter() - started
+            print(f"{mode:<24}{elapsed:>9.1f}{total / elapsed / 1e6:>8.0f}{os.path.getsize(destination) / 1e6:>12.0f}")
+            os.remove(destination)
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# --- Socket Tuning ---
+
+TUNING_MODES = [
+    ("nagle", ["--no-nodelay", "--no-cork", "--coalesce-kb", "0"]),
+    ("nodelay", ["--coalesce-kb", "0"]),
+    ("nodelay+coalesce", []),
+    ("coalesce 2ms", ["--coalesce-ms", "2"]),
+]
+
+def burst_latency(port, bursts, burst_size):
+    """Sends bursts of short chat messages and times each one's arrival at another client (ms, sorted)."""
+    sender, _ = login(port, "sender", False)
+    receiver, _ = login(port, "receiver", False)
+    for sock in (sender, receiver):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # As the chat client does
+    time.sleep(0.3)
+    sent, arrived = {}, {}
+    for sock, probes in ((sender, None), (receiver, arrived)):
+        threading.Thread(target=drain, args=(sock, [0], probes), daemon=True).start()
+    i = 0
+    for _ in range(bursts):
+        for _ in range(burst_size):
+            sent[i] = time.perf_counter()
+            sender.sendall(f"#probe-{i}#".encode(FORMAT))
+            i += 1
+        time.sleep(0.02)
+    deadline = time.perf_counter() + 10
+    while len(arrived) < len(sent) and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    sender.close()
+    receiver.close()
+    return sorted((arrived[k] - sent[k]) * 1000 for k in sent if k in arrived)
+
+def small_file_fan_out(port, senders, receivers, files, size):
+    """Small files from several senders to receivers on data connections.
+    Returns (files delivered per second, MB/s, frames per data connection send)."""
+    before = read_metrics(port).get('chat_socket_writes_total{connection="data"}', 0)
+    receiving = [login(port, f"recv{i}", True) for i in range(receivers)]
+    sending = [login(port, f"send{i}", False)[0] for i in range(senders)]
+    time.sleep(0.3)
+    counters = []
+    for chat, data in receiving:
+        counters.append([0])
+        threading.Thread(target=drain, args=(data, counters[-1]), daemon=True).start()
+        threading.Thread(target=drain, args=(chat, [0]), daemon=True).start()
+    for sock in sending:
+        threading.Thread(target=drain, args=(sock, [0]), daemon=True).start()
+    body = os.urandom(size)
+    def upload(sock, name):
+        for i in range(files):
+            sock.sendall(f"FILE|{name}-{i}.bin|{size}|".encode(FORMAT) + body)
+    started = time.perf_counter()
+    uploaders = [threading.Thread(target=upload, args=(sock, f"s{n}")) for n, sock in enumerate(sending)]
+    for thread in uploaders:
+        thread.start()
+    # Done once nothing more has arrived for a second
+    last_total, last_change = -1, time.perf_counter()
+    while time.perf_counter() - last_change < 1:
+        total = sum(counter[0] for counter in counters)
+        if total != last_total:
+            last_total, last_change = total, time.perf_counter()
+        time.sleep(0.01)
+    elapsed = last_change - started
+    sends = read_metrics(port).get('chat_socket_writes_total{connection="data"}', 0) - before
+    for sock in sending + [sock for pair in receiving for sock in pair]:
+        sock.close()
+    delivered = senders * files * receivers
+    return delivered / elapsed, last_total / elapsed / 1e6, delivered / max(1, sends)
+
+def bench_tuning(args):
+    """Chat latency of short-message bursts and small-file fan-out rate under each
+    combination of TCP_NODELAY, TCP_CORK and data connection write coalescing."""
+    users = ["sender", "receiver"] + [f"recv{i}" for i in range(args.receivers)] + [f"send{i}" for i in range(args.senders)]
+    print(f"{'mode':<18}{'p50 ms':>8}{'p99 ms':>8}{'max ms':>8}{'files/s':>10}{'MB/s':>8}{'frames/send':>13}")
+    for mode, extra in TUNING_MODES:
+        process = start_server(args.port, users, extra)
+        try:
+            latencies = burst_latency(args.port, args.bursts, args.burst_size)
+            rate, throughput, frames = small_file_fan_out(args.port, args.senders, args.receivers, args.files, args.file_kb * 1024)
+        finally:
+            stop_server(process)
+        if latencies:
+            p50, p99 = latencies[len(latencies) // 2], latencies[max(0, int(len(latencies) * 0.99) - 1)]
+            print(f"{mode:<18}{p50:>8.2f}{p99:>8.2f}{latencies[-1]:>8.2f}{rate:>10.0f}{throughput:>8.1f}{frames:>13.1f}")
+        else:
+            print(f"{mode:<18}{'-':>8}{'-':>8}{'-':>8}{rate:>10.0f}{throughput:>8.1f}{frames:>13.1f}")
+
+
+# --- Capture Replay ---
+# Drives a fresh server with traffic recorded by its --capture option. Each
+# captured connection is opened again under the same user and its reads are
+# sent on their recorded schedule divided by --speed (0: as fast as possible,
+# keeping only the order within each user). Upload bodies go out as zeros of
+# the recorded length, and a resumed session is resumed on the new server too.
+# Two probe clients time chat messages through the lobby meanwhile.
+
+REPLAY_PROBES = ("replay-probe-send", "replay-probe-recv")
+REPLAY_COLUMNS = ("elapsed s", "frames/s", "in MB/s", "out MB/s", "p50 ms", "p99 ms", "lag ms")
+ZEROS = bytes(65536)
+NAME_PAUSE = 0.05  # After a name-only hello, so the server reads the name on its own
+
+def load_capture(paths):
+    """Reads one or more capture files (one per worker) into (users, streams): a
+    stream is the records of one user's chat connections, or of one data
+    connection, as (seconds from the first record, connection, kind, payload)."""
+    server = load_server_module()
+    records = []
+    for n, path in enumerate(paths):
+        for at, connection, kind, payload in server.read_capture(path):
+            if kind == server.CAPTURE_DATA_OPEN:
+                payload = (n, struct.unpack('!I', payload)[0])
+            records.append((at, (n, connection), kind, payload))
+    if not records:
+        raise SystemExit("the capture has no client traffic")
+    records.sort(key=lambda record: record[0])
+    started = records[0][0]
+    owners = {}  # connection -> stream key
+    streams = {}
+    for at, connection, kind, payload in records:
+        if kind == server.CAPTURE_OPEN:
+            owners[connection] = payload.partition(b"\n")[0].decode(FORMAT, 'replace')
+        elif kind == server.CAPTURE_DATA_OPEN:
+            owners[connection] = connection
+        if connection in owners:  # A capture started mid-connection misses its hello
+            streams.setdefault(owners[connection], []).append((at - started, connection, kind, payload))
+    users = sorted(key for key in streams if isinstance(key, str))
+    return server, users, list(streams.values())
+
+class Replay(object):
+    """One replay of a capture against a server on port."""
+    def __init__(self, server, streams, port, speed):
+        self.kinds = server  # Capture record kinds come from the server module
+        self.streams = streams
+        self.port = port
+        self.speed = speed
+        self.sessions = {}  # User -> [token, data token, bytes received on the session]
+        self.data_tokens = {}  # Chat connection -> data token
+        self.opened = {}       # Chat connection -> Event set once it is open (or failed)
+        self.counters = []
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.sent = 0
+        self.lag = 0.0
+        self.errors = 0
+
+    def run(self):
+        """Replays every stream; returns the seconds it took."""
+        for records in self.streams:
+            for _, connection, kind, _ in records:
+                if kind == self.kinds.CAPTURE_OPEN:
+                    self.opened[connection] = threading.Event()
+        threads = [threading.Thread(target=self.play, args=(records,), daemon=True) for records in self.streams]
+        self.started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - self.started
+
+    def play(self, records):
+        kinds = self.kinds
+        socks = {}
+        paused = 0.0  # NAME_PAUSEs so far; the schedule moves back by them rather than count them as lag
+        try:
+            for at, connection, kind, payload in records:
+                if self.speed:
+                    late = time.perf_counter() - (self.started + at / self.speed + paused)
+                    if late < 0:
+                        time.sleep(-late)
+                    elif late > self.lag:
+                        self.lag = late
+                if kind == kinds.CAPTURE_OPEN:
+                    socks[connection] = self.open_chat(connection, payload)
+                    if b"\n" not in payload:
+                        paused += NAME_PAUSE
+                elif kind == kinds.CAPTURE_DATA_OPEN:
+                    socks[connection] = self.open_data(payload)
+                elif kind == kinds.CAPTURE_DATA:
+                    socks[connection].sendall(payload)
+                    with self.lock:
+                        self.frames += 1
+                        self.sent += len(payload)
+                elif kind == kinds.CAPTURE_BODY:
+                    for offset in range(0, payload, len(ZEROS)):
+                        socks[connection].sendall(memoryview(ZEROS)[:min(len(ZEROS), payload - offset)])
+                    with self.lock:
+                        self.sent += payload
+                elif kind == kinds.CAPTURE_CLOSE:
+                    socks.pop(connection).close()
+        except (OSError, KeyError, IndexError, ValueError) as e:
+            with self.lock:
+                self.errors += 1
+            print(f"[REPLAY] {e!r}; the rest of this user's traffic is skipped", file=sys.stderr)
+        finally:
+            for event in [self.opened.get(connection) for _, connection, _, _ in records]:
+                if event is not None:
+                    event.set()  # Data connections waiting on a chat connection that failed give up
+            for sock in socks.values():
+                sock.close()
+
+    def open_chat(self, connection, hello):
+        name, _, rest = hello.decode(FORMAT, 'replace').partition("\n")
+        sock = socket.create_connection((BENCH_HOST, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        received = [0]
+        if rest.startswith("!RESUME"):
+            held = self.sessions.get(name) if len(rest.split()) == 3 else None
+            sock.sendall(f"{name}\n!RESUME {held[0]} {held[2][0]}".encode(FORMAT) if held
+                         else f"{name}\n!RESUME".encode(FORMAT))
+            line = read_line(sock)
+            if line[0] == "!RESUMED":
+                received[0] = int(line[1])
+                self.sessions[name][2] = received
+            else:  # Held too long on this server, or never resumed here: a new session
+                self.sessions[name] = [line[1], line[3] if len(line) > 3 else None, received]
+            self.data_tokens[connection] = self.sessions[name][1]
+        else:
+            sock.sendall(name.encode(FORMAT))
+            time.sleep(NAME_PAUSE)
+        self.counters.append(received)
+        threading.Thread(target=drain, args=(sock, received), daemon=True).start()
+        self.opened[connection].set()
+        return sock
+
+    def open_data(self, chat):
+        if chat not in self.opened or not self.opened[chat].wait(30) or not self.data_tokens.get(chat):
+            raise ValueError(f"no data token for connection {chat}")
+        sock = socket.create_connection((BENCH_HOST, self.port))
+        sock.sendall(f"!DATA {self.data_tokens[chat]}\n".encode(FORMAT))
+        if read_line(sock) != ["!DATA", "ready"]:
+            raise ValueError("data connection refused")
+        received = [0]
+        self.counters.append(received)
+        threading.Thread(target=drain, args=(sock, received), daemon=True).start()
+        return sock
+
+def probe_lobby(port, stop, sent, arrived):
+    """Sends a probe through the lobby every 50 ms until stop is set."""
+    sender, _ = login(port, REPLAY_PROBES[0], False)
+    receiver, _ = login(port, REPLAY_PROBES[1], False)
+    for sock in (sender, receiver):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    threading.Thread(target=drain, args=(sender, [0]), daemon=True).start()
+    threading.Thread(target=drain, args=(receiver, [0], arrived), daemon=True).start()
+    i = 0
+    while not stop.wait(0.05):
+        sent[i] = time.perf_counter()
+        sender.sendall(f"#probe-{i}#".encode(FORMAT))
+        i += 1
+    time.sleep(1)  # Stragglers
+    sender.close()
+    receiver.close()
+
+def replay_build(script, port, server, users, streams, speed):
+    """Replays the capture against a fresh server started from script; returns a REPLAY_COLUMNS row."""
+    process = start_server(port, users + list(REPLAY_PROBES), script=script)
+    try:
+        replay = Replay(server, streams, port, speed)
+        stop = threading.Event()
+        sent, arrived = {}, {}
+        prober = threading.Thread(target=probe_lobby, args=(port, stop, sent, arrived))
+        prober.start()
+        time.sleep(0.5)
+        elapsed = replay.run()
+        received = sum(counter[0] for counter in replay.counters)
+        stop.set()
+        prober.join()
+    finally:
+        stop_server(process)
+    latencies = sorted((arrived[k] - sent[k]) * 1000 for k in sent if k in arrived)
+    if replay.errors or len(latencies) < len(sent):
+        print(f"[REPLAY] {os.path.basename(script)}: {replay.errors} users failed, "
+              f"{len(sent) - len(latencies)} of {len(sent)} probes lost", file=sys.stderr)
+    p50 = latencies[len(latencies) // 2] if latencies else float('nan')
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] if latencies else float('nan')
+    return (elapsed, replay.frames / elapsed, replay.sent / elapsed / 1e6, received / elapsed / 1e6,
+            p50, p99, replay.lag * 1000)
+
+def bench_replay(args):
+    """Replays captured traffic against a server build (and a baseline build) and
+    compares throughput and chat latency. At --speed 0 throughput shows how fast the
+    build can take the load; at 1 or 10 it follows the capture and latency and lag
+    are what to compare."""
+    server, users, streams = load_capture(args.capture)
+    connections = sum(1 for records in streams for record in records if record[2] in (server.CAPTURE_OPEN, server.CAPTURE_DATA_OPEN))
+    print(f"{len(users)} users, {connections} connections, "
+          f"{max(records[-1][0] for records in streams):.1f}s captured, speed {args.speed or 'max'}")
+    builds = [("candidate", args.server)]
+    if args.baseline:
+        builds.insert(0, ("baseline", args.baseline))
+    print(f"{'build':<12}" + "".join(f"{column:>11}" for column in REPLAY_COLUMNS))
+    rows = []
+    for n, (label, script) in enumerate(builds):
+        # A fresh port for each build; the last one may still be in TIME_WAIT
+        rows.append(replay_build(script, args.port + n, server, users, streams, args.speed))
+        print(f"{label:<12}" + "".join(f"{value:>11.2f}" for value in rows[-1]))
+    if len(rows) == 2:
+        print(f"{'change %':<12}" + "".join(f"{(new - old) / old * 100 if old else float('nan'):>+11.1f}"
+                                            for old, new in zip(*rows)))
+
+
+# --- Main ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incident Recorder chat server benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    scaling = sub.add_parser("scaling", help="broadcast throughput with 1..N worker processes")
+    scaling.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    scaling.add_argument("--clients", type=int, default=32)
+    scaling.add_argument("--messages", type=int, default=200, help="messages per client")
+    scaling.add_argument("--port", type=int, default=BENCH_PORT)
+    scaling.set_defaults(func=bench_scaling)
+
+    federation = sub.add_parser("federation", help="relay latency and lazy fetch across chained servers")
+    federation.add_argument("--servers", type=int, default=3)
+    federation.add_argument("--messages", type=int, default=200)
+    federation.add_argument("--file-size", type=int, default=8 * 1024 * 1024)
+    federation.add_argument("--port", type=int, default=BENCH_PORT)
+    federation.set_defaults(func=bench_federation)
+
+    tls = sub.add_parser("tls", help="handshake rate, reconnect storm and bulk throughput with TLS off/on")
+    tls.add_argument("--connections", type=int, default=200, help="sequential connects for the rate test")
+    tls.add_argument("--storm", type=int, default=200, help="simultaneous reconnecting clients")
+    tls.add_argument("--bulk-mb", type=int, default=64)
+    tls.add_argument("--cert", default=None, help="use this certificate instead of generating one")
+    tls.add_argument("--key", default=None)
+    tls.add_argument("--port", type=int, default=BENCH_PORT)
+    tls.set_defaults(func=bench_tls)
+
+    admission = sub.add_parser("admission", help="chat latency while the port is flooded with unauthenticated connections")
+    admission.add_argument("--flooders", type=int, default=8, help="threads opening connections")
+    admission.add_argument("--messages", type=int, default=200, help="latency probes per phase")
+    admission.add_argument("--auth-timeout", type=float, default=2)
+    admission.add_argument("--port", type=int, default=BENCH_PORT)
+    admission.set_defaults(func=bench_admission)
+
+    bulk = sub.add_parser("bulk", help="chat latency during a large file transfer, with and without the data connection")
+    bulk.add_argument("--file-mb", type=int, default=64)
+    bulk.add_argument("--link-mbit", type=float, default=100, help="how fast the watching client reads")
+    bulk.add_argument("--timeout", type=float, default=120, help="seconds to wait for the transfer")
+    bulk.add_argument("--port", type=int, default=BENCH_PORT)
+    bulk.set_defaults(func=bench_bulk)
+
+    images = sub.add_parser("images", help="client thumbnail decoding rate for typical screenshot sizes")
+    images.add_argument("--sizes", default="1366x768,1920x1080,2560x1440,3840x2160")
+    images.add_argument("--formats", default="jpeg,png")
+    images.add_argument("--count", type=int, default=40, help="images decoded per measurement")
+    images.add_argument("--workers", type=int, default=0, help="pool size (default: the client's)")
+    images.set_defaults(func=bench_images)
+
+    downloads = sub.add_parser("downloads", help="serving a stored file to many clients: buffered reads vs sendfile/mmap")
+    downloads.add_argument("--file-mb", type=int, default=32)
+    downloads.add_argument("--clients", default="1,4,16", help="comma separated numbers of simultaneous downloads")
+    downloads.set_defaults(func=bench_downloads)
+
+    export = sub.add_parser("export", help="evidence export throughput against tar.gz plus sha256sum")
+    export.add_argument("--total-gb", type=float, default=2, help="size of the generated evidence set (e.g. 50)")
+    export.add_argument("--file-mb", type=int, default=64)
+    export.add_argument("--workers", type=int, default=0, help="hashing/compression threads (default: one per core)")
+    export.add_argument("--dir", default=None, help="where to generate the evidence set (needs twice its size free)")
+    export.set_defaults(func=bench_export)
+
+    tuning = sub.add_parser("tuning", help="small-message latency and small-file fan-out with TCP_NODELAY/TCP_CORK/coalescing")
+    tuning.add_argument("--bursts", type=int, default=100)
+    tuning.add_argument("--burst-size", type=int, default=10, help="short messages sent back to back per burst")
+    tuning.add_argument("--senders", type=int, default=4)
+    tuning.add_argument("--receivers", type=int, default=8)
+    tuning.add_argument("--files", type=int, default=200, help="files per sender")
+    tuning.add_argument("--file-kb", type=int, default=4)
+    tuning.add_argument("--port", type=int, default=BENCH_PORT)
+    tuning.set_defaults(func=bench_tuning)
+
+    replay = sub.add_parser("replay", help="replay traffic recorded with the server's --capture and compare builds")
+    replay.add_argument("capture", nargs="+", help="capture file(s); one per worker with --workers")
+    replay.add_argument("--speed", type=float, default=1, help="1 for real time, 10 for ten times faster, 0 as fast as possible")
+    replay.add_argument("--server", default=SERVER_SCRIPT, help="server build to replay against")
+    replay.add_argument("--baseline", default=None, help="another server build to replay against first and compare with")
+    replay.add_argument("--port", type=int, default=BENCH_PORT)
+    replay.set_defaults(func=bench_replay)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
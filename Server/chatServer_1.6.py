@@ -6,8 +6,32 @@ import traceback
 from PIL import Image
 import io
 import tkinter as tk
-from tkinter import simpledialog, messagebox, scrolledtext, Menu, Toplevel, Checkbutton, IntVar
+from tkinter import simpledialog, messagebox, scrolledtext, filedialog, Menu, Toplevel, Checkbutton, IntVar
 import sys
+import time
+import bisect
+import argparse
+import signal
+import tracemalloc
+import struct
+import json
+import tempfile
+import itertools
+import re
+import ssl
+import select
+import mmap
+import selectors
+import secrets
+import queue
+import gzip
+import zlib
+import hashlib
+import hmac
+import tarfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # --- Configuration & Globals ---
 # Default settings
@@ -15,21 +39,280 @@ DEFAULT_HOST = '0.0.0.0'
 DEFAULT_PORT = 57001
 FORMAT = 'utf-8'
 DISCONNECT_MESSAGE = "!DISCONNECT"
+PEER_MESSAGE = "!PEER"    # First message of a server-to-server link
+FETCH_MESSAGE = "!FETCH"  # Client asks for a stored or shared file: "!FETCH id" or "!FETCH id first-last" for a byte range
+FILES_MESSAGE = "!FILES"  # List stored files and their IDs
+JOIN_MESSAGE = "!JOIN"    # Subscribe to a room and start talking in it
+LEAVE_MESSAGE = "!LEAVE"  # Unsubscribe from a room
+ROOM_MESSAGE = "!ROOM"    # Switch which subscribed room your messages go to
+ROOMS_MESSAGE = "!ROOMS"  # List rooms
+RESUME_MESSAGE = "!RESUME"    # Second line of the hello: "!RESUME" for a new session, "!RESUME token offset" to resume
+SESSION_MESSAGE = "!SESSION"  # Server's first line to a resumable client: "!SESSION token"
+RESUMED_MESSAGE = "!RESUMED"  # Server's first line on resume: "!RESUMED offset", followed by the replayed bytes
+PING_MESSAGE = "!PING"        # Heartbeat line from a resumable client ("!PING\n"); answered with "!PONG\n"
+PONG_MESSAGE = "!PONG"
+ERROR_MESSAGE = "!ERROR"      # Protocol error sent to a client: "!ERROR code: explanation"
+DATA_MESSAGE = "!DATA"        # First line of a session's data connection: "!DATA token"; answered with "!DATA ready"
+DIGEST_MESSAGE = "!DIGEST"    # Line ahead of a file/image sent to a resumable client: "!DIGEST algorithm hex" of the body
+DEFAULT_ROOM = "lobby"    # Everyone starts here; it keeps the original log and files locations
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")  # Room names double as directory and journal names
 LOG_FILE = "chat_server.log"
+LOG_ROTATE_BYTES = 64 * 1024 * 1024  # Start a new journal segment past this size (0: never by size)
+LOG_ROTATE_DAILY = True              # ... and when the UTC date changes
 FILES_DIR = "files"  # Subdirectory for storing received files
+UPLOAD_DIGEST = "sha256"  # Hash of each upload as received, for the journal and recipients ("sha256" or "blake2b")
+METRICS_HOST = '127.0.0.1'  # Metrics endpoint only answers locally
+METRICS_PORT = 57002
+DIAGNOSTICS_DIR = "diagnostics"  # Profiles, memory snapshots and stack dumps
+CONFIG_FILE = "chat_server_config.json"  # Users, rate limits and extra listen addresses; reloaded when edited
+CONFIG_POLL_INTERVAL = 2  # Seconds between checks of CONFIG_FILE for changes
 
 # Server State Variables
 HOST = DEFAULT_HOST
 PORT = DEFAULT_PORT
-server_socket = None
 server_thread = None
 is_server_running = False
+REUSE_PORT = False   # Set for worker processes sharing the port via SO_REUSEPORT
+worker_id = None     # 1..N inside a worker process, None in a single-process server
+bus_socket = None    # Worker's connection to the fan-out bus hub
+SERVER_ID = None     # Name of this server in a federation (defaults to hostname-port)
+PEERS = []           # "host:port" of other servers to keep a link to
+PEER_SECRET = ""     # Shared secret every server in the federation presents
+TLS_CERT = None      # PEM certificate chain; setting it turns TLS on for the listener
+TLS_KEY = None       # PEM private key (may be None if it is inside TLS_CERT)
+TLS_CA = None        # CA/pinned certificate used to verify peers when dialing them
+TLS_HANDSHAKE_TIMEOUT = 10
+tls_context = None
+RESUME_GRACE_SECONDS = 120          # How long a dropped session waits for its client to come back
+RESUME_BUFFER_BYTES = 8 * 1024 * 1024  # Recent output kept per session for replay
+HEARTBEAT_INTERVAL = 15  # Seconds between client pings; also the TCP keepalive idle time
+HEARTBEAT_TIMEOUT = 45   # A pinging client silent for this long is reaped
+LISTEN_BACKLOG = 128     # Connections the kernel queues while the accept loop is busy
+MAX_PENDING = 64         # Connections not yet authenticated, from everyone
+MAX_PENDING_PER_IP = 8   # ... and from one address
+AUTH_TIMEOUT = 10        # Seconds a new connection has to finish TLS and send its name
+TCP_NODELAY_ON = True    # Small writes go out at once instead of waiting for an ACK (Nagle); see chatBenchmark.py tuning
+TCP_CORK_ON = True       # Linux: a header waits for its body so they share segments
+SEND_BUFFER_BYTES = 0    # SO_SNDBUF of client connections (0: kernel default, which autotunes)
+RECEIVE_BUFFER_BYTES = 0 # SO_RCVBUF (0: kernel default)
+COALESCE_BYTES = 64 * 1024  # Data connection: queued frames gathered into one send, up to this much
+COALESCE_DELAY = 0.0     # ... waiting this long for more after the first (0: only what is already queued)
+admission = None         # AdmissionControl of the running listeners
+LISTEN_ADDRESSES = []    # "host:port" to listen on besides HOST:PORT
+CAPTURE_FILE = None      # Record client traffic here for chatBenchmark.py replay (off by default)
 
 # Lists
 clients = []        # Keeps track of sockets for broadcasting
 client_names = []   # Keeps track of names for legacy broadcast logic
 authorizedUsers = [] # List of allowed usernames
 connectedClients = [] # List of dictionaries: {'name': name, 'ip': ip, 'conn': connection_object}
+client_lookup = {}  # Maps socket -> name for per-session accounting
+sessions = {}       # Resume token -> ClientSession, including sessions waiting for their client to reconnect
+rooms = {DEFAULT_ROOM: set()}  # Room name -> set of subscribed sockets
+client_rooms = {}   # Maps socket -> room the client is currently talking in
+roomMembers = {}    # Room name -> users allowed to join; rooms not listed are open to all authorized users
+rooms_lock = threading.Lock()  # Guards rooms, their subscriber sets and client_rooms; never held while sending
+
+# Per-user flood protection. Rates are token buckets: a user may send `burst`
+# messages/bytes back to back and then `per_second` on average. Going over
+# delays reading from that user (soft); if the delay would exceed max_delay the
+# message is rejected with an ERROR_MESSAGE instead (hard). 0 turns a limit off.
+RATE_LIMIT_DEFAULTS = {
+    'messages_per_second': 5,
+    'message_burst': 20,
+    'bytes_per_second': 16 * 1024 * 1024,
+    'byte_burst': 32 * 1024 * 1024,
+    'max_delay': 2.0,
+}
+rateLimits = dict(RATE_LIMIT_DEFAULTS)  # Limits for everyone
+userRateLimits = {}  # User -> overrides of rateLimits, e.g. for an automation account
+
+# --- Metrics ---
+# Upper bounds (seconds) for the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+METRIC_HELP = {
+    'chat_messages_in_total': ('counter', 'Messages received from clients'),
+    'chat_bytes_in_total': ('counter', 'Bytes received from clients'),
+    'chat_messages_out_total': ('counter', 'Messages written to clients'),
+    'chat_bytes_out_total': ('counter', 'Bytes written to clients'),
+    'chat_auth_rejects_total': ('counter', 'Connections rejected during authentication'),
+    'chat_admission_rejects_total': ('counter', 'Connections closed before authentication by admission control, by reason'),
+    'chat_throttled_total': ('counter', 'Messages delayed or rejected by the rate limiter, by user and action'),
+    'chat_data_connections_total': ('counter', 'Data connections opened for file/image bodies, by result'),
+    'chat_bulk_fallbacks_total': ('counter', 'File/image bodies sent on the chat connection because the data connection failed'),
+    'chat_socket_writes_total': ('counter', 'Sends to clients, by connection (chat or data); data connection sends can carry several frames'),
+    'chat_downloads_total': ('counter', 'Stored files served to clients from disk, whole or as a byte range'),
+    'chat_broadcast_seconds': ('histogram', 'Time to fan a message out to all clients'),
+    'chat_outbound_seconds': ('histogram', 'Time from queueing a message for a client to its last byte being written, by priority'),
+    'chat_slow_consumers_total': ('counter', 'Clients dropped for letting too much pile up unread, by the priority that went over'),
+    'chat_disk_write_seconds': ('histogram', 'Time spent writing the log and saved files'),
+    'chat_log_rotations_total': ('counter', 'Journal segments closed, by reason (size or day)'),
+}
+
+class Histogram(object):
+    """Fixed-bucket histogram in the Prometheus style (last slot is +Inf)."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates a quantile as the upper bound of the bucket that holds it."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for i, bucket_count in enumerate(self.counts):
+            running += bucket_count
+            if running >= target:
+                break
+        return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+class ServerMetrics(object):
+    """Counters, gauges and histograms shared by all handler threads.
+
+    Updates only hold the lock for a dictionary update, so instrumenting the
+    hot path costs well under a microsecond per event.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> number
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}      # name -> callable returning the current value
+        self.open_connections = 0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def connection_opened(self):
+        with self.lock:
+            self.open_connections += 1
+            return self.open_connections
+
+    def connection_closed(self):
+        with self.lock:
+            self.open_connections -= 1
+
+    def register_gauge(self, name, help_text, func):
+        """Registers a gauge whose value is read from func() at scrape time."""
+        METRIC_HELP[name] = ('gauge', help_text)
+        self.gauges[name] = func
+
+    def snapshot(self):
+        """Returns consistent copies of the counters and histograms."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {}
+            for key, hist in self.histograms.items():
+                copy = Histogram(hist.buckets)
+                copy.counts = list(hist.counts)
+                copy.sum = hist.sum
+                copy.count = hist.count
+                histograms[key] = copy
+        gauges = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = 0
+        return counters, histograms, gauges
+
+    def render_prometheus(self):
+        """Renders every metric in the Prometheus text exposition format."""
+        counters, histograms, gauges = self.snapshot()
+
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in METRIC_HELP:
+                kind, help_text = METRIC_HELP[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f"{name}{fmt_labels(labels)} {value}")
+
+        for (name, labels), hist in sorted(histograms.items()):
+            describe(name)
+            running = 0
+            for bound, bucket_count in zip(hist.buckets, hist.counts):
+                running += bucket_count
+                lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {running}")
+            lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {hist.count}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {hist.sum:.6f}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {hist.count}")
+
+        for name, value in sorted(gauges.items()):
+            describe(name)
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = ServerMetrics()
+metrics.register_gauge('chat_connected_clients', 'Authenticated client sessions', lambda: len(clients))
+metrics.register_gauge('chat_open_connections', 'Accepted TCP connections, authenticated or not', lambda: metrics.open_connections)
+metrics.register_gauge('chat_threads', 'Live Python threads in the server process', threading.active_count)
+METRIC_HELP['chat_tls_handshakes_total'] = ('counter', 'Completed TLS handshakes, by whether the session was resumed')
+METRIC_HELP['chat_session_resumes_total'] = ('counter', 'Resume attempts, by result (replayed, partial, expired)')
+METRIC_HELP['chat_reaped_connections_total'] = ('counter', 'Client connections closed for missing heartbeats')
+metrics.register_gauge('chat_held_sessions', 'Dropped sessions waiting for their client to reconnect',
+                       lambda: sum(1 for session in list(sessions.values()) if session.sock is None))
+metrics_httpd = None
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves the metrics registry at /metrics for Prometheus or curl."""
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode(FORMAT)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep scrapes out of the server output
+
+def start_metrics_endpoint():
+    """Starts the local metrics HTTP endpoint once per process."""
+    global metrics_httpd
+    if metrics_httpd is not None:
+        return
+    try:
+        metrics_httpd = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+        metrics_httpd.daemon_threads = True
+        threading.Thread(target=metrics_httpd.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"[METRICS] Serving on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        print(f"[ERROR] Metrics endpoint failed to start: {e}")
 
 # --- IO Redirection Class ---
 class IORedirector(object):
@@ -62,17 +345,576 @@ class IORedirector(object):
         if self.terminal:
             self.terminal.flush()
 
+# --- Diagnostics ---
+
+def _diagnostics_path(prefix, extension):
+    """Returns a timestamped path inside DIAGNOSTICS_DIR, creating it if needed."""
+    if not os.path.exists(DIAGNOSTICS_DIR):
+        os.makedirs(DIAGNOSTICS_DIR)
+    stamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+    return os.path.join(DIAGNOSTICS_DIR, f"{prefix}_{stamp}.{extension}")
+
+class SamplingProfiler(object):
+    """Periodically samples the stack of every thread.
+
+    Nothing is hooked into the handler threads, so it can be started and
+    stopped on a live server without interrupting the chat.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = {}  # (thread name, folded stack) -> sample count
+        self.samples = 0
+        self.running = False
+        self.thread = None
+        self.started_at = None
+
+    def start(self):
+        if self.running:
+            return False
+        self.stacks = {}
+        self.samples = 0
+        self.started_at = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="diagnostics-profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while self.running:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = (names.get(thread_id, str(thread_id)), ";".join(reversed(stack)))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self, top=30):
+        """Stops sampling and writes folded stacks plus a top-functions report."""
+        if not self.running:
+            return None
+        self.running = False
+        self.thread.join()
+        
+        folded_path = _diagnostics_path("profile", "folded")
+        with open(folded_path, 'w', encoding=FORMAT) as f:
+            for (thread_name, stack), count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{thread_name};{stack} {count}\n")
+        
+        self_counts = {}
+        total_counts = {}
+        for (thread_name, stack), count in self.stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + count
+            for frame_name in set(frames):
+                total_counts[frame_name] = total_counts.get(frame_name, 0) + count
+        
+        report_path = folded_path[:-len(".folded")] + ".txt"
+        duration = time.time() - self.started_at
+        with open(report_path, 'w', encoding=FORMAT) as f:
+            f.write(f"{self.samples} sampling rounds over {duration:.1f}s ({self.interval * 1000:.0f} ms interval)\n\n")
+            f.write(f"Top {top} by self samples:\n")
+            for frame_name, count in sorted(self_counts.items(), key=lambda item: -item[1])[:top]:
+                f.write(f"{count:>8}  {frame_name}\n")
+            f.write(f"\nTop {top} by total samples:\n")
+            for frame_name, count in sorted(total_counts.items(), key=lambda item: -item[1])[:top]:
+                f.write(f"{count:>8}  {frame_name}\n")
+        return report_path
+
+profiler = SamplingProfiler()
+last_memory_snapshot = None
+
+def start_profiler():
+    if profiler.start():
+        print("[DIAGNOSTICS] Sampling profiler started.")
+    else:
+        print("[DIAGNOSTICS] Sampling profiler is already running.")
+
+def stop_profiler():
+    report_path = profiler.stop()
+    if report_path:
+        print(f"[DIAGNOSTICS] Profile written to {report_path} (folded stacks alongside).")
+    else:
+        print("[DIAGNOSTICS] Sampling profiler is not running.")
+
+def toggle_profiler():
+    if profiler.running:
+        stop_profiler()
+    else:
+        start_profiler()
+
+def take_memory_snapshot(top=25):
+    """Takes a tracemalloc snapshot and reports the growth since the previous one."""
+    global last_memory_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(10)
+        last_memory_snapshot = None
+        print("[DIAGNOSTICS] tracemalloc started; take another snapshot later to see growth.")
+    
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    path = _diagnostics_path("memory", "txt")
+    with open(path, 'w', encoding=FORMAT) as f:
+        current, peak = tracemalloc.get_traced_memory()
+        f.write(f"Traced memory: {current} bytes (peak {peak} bytes)\n\n")
+        f.write(f"Top {top} allocation sites:\n")
+        for stat in snapshot.statistics('lineno')[:top]:
+            f.write(f"{stat}\n")
+        if last_memory_snapshot is not None:
+            f.write(f"\nTop {top} changes since previous snapshot:\n")
+            for stat in snapshot.compare_to(last_memory_snapshot, 'lineno')[:top]:
+                f.write(f"{stat}\n")
+    last_memory_snapshot = snapshot
+    print(f"[DIAGNOSTICS] Memory snapshot written to {path}")
+
+def stop_memory_tracing():
+    global last_memory_snapshot
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+        last_memory_snapshot = None
+        print("[DIAGNOSTICS] tracemalloc stopped.")
+
+def dump_thread_stacks():
+    """Writes the current stack of every thread to the diagnostics directory."""
+    path = _diagnostics_path("stacks", "txt")
+    threads = {t.ident: t for t in threading.enumerate()}
+    with open(path, 'w', encoding=FORMAT) as f:
+        for thread_id, frame in sys._current_frames().items():
+            thread = threads.get(thread_id)
+            title = f"{thread.name} (daemon={thread.daemon})" if thread else "unknown"
+            f.write(f"--- Thread {thread_id}: {title} ---\n")
+            f.write("".join(traceback.format_stack(frame)))
+            f.write("\n")
+    print(f"[DIAGNOSTICS] Thread stacks written to {path}")
+
+# --- Journal Segments ---
+# Each journal (LOG_FILE and every room's log) is rotated when it passes
+# LOG_ROTATE_BYTES or the UTC date changes: the file is renamed to
+# <name>.<YYYYmmdd-HHMMSS><ext> and a new one started, all under the writer's
+# lock, so a write waits for a rename at most. A background thread then gzips
+# the segment and records the time range of its lines in <name>.index.json,
+# so a tool looking for one night can open one segment instead of all of them.
+
+JOURNAL_TIME = re.compile(rb"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d UTC)\]", re.MULTILINE)
+
+journal_writers = {}          # journal path -> JournalWriter
+journal_writers_lock = threading.Lock()
+journal_segments = queue.Queue()  # (journal, segment) waiting to be compressed
+journal_index_lock = threading.Lock()
+journal_compressor = None
+journal_freeze = threading.Lock()  # Held by an evidence export: segments stay where they are until it is done
+
+class JournalWriter(object):
+    """Appends lines to one journal, keeping the file open between writes."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.day = None
+
+    def write(self, line):
+        now = datetime.datetime.utcnow()
+        with self.lock:
+            if self.file is None:
+                self._open()
+            if journal_freeze.locked():
+                pass  # Rotated once the export has finished
+            elif self.size and LOG_ROTATE_BYTES and self.size >= LOG_ROTATE_BYTES:
+                self._rotate(now, 'size')
+            elif self.size and LOG_ROTATE_DAILY and self.day != now.date():
+                self._rotate(now, 'day')
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.size = self.file.tell()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(self.path, 'a', encoding=FORMAT)
+        self.size = self.file.tell()
+        # A journal left from an earlier run belongs to the day it was last written
+        modified = os.path.getmtime(self.path) if self.size else time.time()
+        self.day = datetime.datetime.utcfromtimestamp(modified).date()
+        # Segments a previous run rotated but did not get to compress
+        for segment in uncompressed_segments(self.path):
+            queue_segment(self.path, segment)
+
+    def _rotate(self, now, reason):
+        root, ext = os.path.splitext(self.path)
+        segment = f"{root}.{now:%Y%m%d-%H%M%S}{ext}"
+        for n in itertools.count(1):
+            if not os.path.exists(segment) and not os.path.exists(segment + ".gz"):
+                break
+            segment = f"{root}.{now:%Y%m%d-%H%M%S}-{n}{ext}"
+        self.file.close()
+        try:
+            os.rename(self.path, segment)
+        except OSError as e:
+            # E.g. the file is open in another program on Windows; carry on and try again later
+            print(f"[JOURNAL] Could not rotate {self.path}: {e}")
+            segment = None
+        self.file = open(self.path, 'a', encoding=FORMAT)
+        self.size = self.file.tell()
+        self.day = now.date()
+        if segment:
+            metrics.inc('chat_log_rotations_total', reason=reason)
+            queue_segment(self.path, segment)
+
+def write_journal(path, line):
+    """Appends a line to a journal, rotating it as configured."""
+    with journal_writers_lock:
+        writer = journal_writers.get(path)
+        if writer is None:
+            writer = journal_writers[path] = JournalWriter(path)
+    writer.write(line)
+
+def uncompressed_segments(journal):
+    root, ext = os.path.splitext(journal)
+    directory = os.path.dirname(journal) or "."
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.\d{8}-\d{6}(-\d+)?" + re.escape(ext) + "$")
+    return sorted(os.path.join(os.path.dirname(journal), name) for name in os.listdir(directory) if pattern.match(name))
+
+def queue_segment(journal, segment):
+    global journal_compressor
+    journal_segments.put((journal, segment))
+    with journal_writers_lock:
+        if journal_compressor is None:
+            journal_compressor = threading.Thread(target=compress_segments, name="journal-compressor")
+            journal_compressor.daemon = True
+            journal_compressor.start()
+
+def compress_segments():
+    while True:
+        journal, segment = journal_segments.get()
+        try:
+            with journal_freeze:
+                compress_segment(journal, segment)
+        except Exception as e:
+            print(f"[JOURNAL] Could not compress {segment}: {e}")
+
+def compress_segment(journal, segment):
+    """Gzips a rotated segment and adds it to the journal's index."""
+    first = last = None
+    lines = size = 0
+    tail = b""
+    temporary = segment + ".gz.tmp"
+    with open(segment, 'rb') as source, open(temporary, 'wb') as raw:
+        with gzip.GzipFile(filename=os.path.basename(segment), mode='wb', fileobj=raw) as target:
+            while True:
+                chunk = source.read(1024 * 1024)
+                if not chunk:
+                    break
+                if first is None:
+                    match = JOURNAL_TIME.search(chunk)
+                    first = match.group(1).decode(FORMAT) if match else None
+                lines += chunk.count(b"\n")
+                size += len(chunk)
+                tail = (tail + chunk)[-65536:]
+                target.write(chunk)
+    stamps = JOURNAL_TIME.findall(tail)
+    last = stamps[-1].decode(FORMAT) if stamps else first
+    os.replace(temporary, segment + ".gz")
+    update_journal_index(journal, {'file': os.path.basename(segment) + ".gz", 'first': first, 'last': last,
+                                   'lines': lines, 'bytes': size})
+    os.remove(segment)
+
+def update_journal_index(journal, entry):
+    """Adds (or replaces) a segment in <journal>.index.json, oldest first."""
+    index_path = os.path.splitext(journal)[0] + ".index.json"
+    with journal_index_lock:
+        try:
+            with open(index_path, 'r', encoding=FORMAT) as f:
+                segments = json.load(f)
+        except (OSError, ValueError):
+            segments = []
+        segments = [s for s in segments if s.get('file') != entry['file']] + [entry]
+        segments.sort(key=lambda s: (s.get('first') or "", s['file']))
+        temporary = index_path + ".tmp"
+        with open(temporary, 'w', encoding=FORMAT) as f:
+            json.dump(segments, f, indent=1)
+        os.replace(temporary, index_path)
+
+# --- Evidence Export ---
+# Hands the journal and everything under FILES_DIR over as one .tar.gz for
+# chain of custody. The archive is written as a stream, straight from the
+# original files; nothing is staged. A pool of threads computes the SHA-256
+# of each file a little ahead of the writer (hashlib releases the GIL), and
+# the tar stream is compressed in blocks on a second pool: every block is a
+# complete gzip member, and concatenated members are an ordinary .gz, as
+# pigz writes them. The last member is a manifest of digests, sizes and
+# senders with an HMAC-SHA256 signature made with the key in EXPORT_KEY_FILE;
+# a copy is written next to the archive.
+
+EXPORT_KEY_FILE = "export_signing.key"  # Secret for manifest signatures; created by the first export
+EXPORT_MANIFEST = "MANIFEST.json"
+EXPORT_WORKERS = os.cpu_count() or 1
+EXPORT_BLOCK = 4 * 1024 * 1024  # Compressed independently
+EXPORT_LEVEL = 6
+SAVED_AS = re.compile(r"^\[([^\]]+)\] \[[^\]]+\] \[([^\]]+)\]: (?:.*?, received (\w+ [0-9a-f]+)\))?.* - Saved as (.+)$")
+
+class ParallelGzipWriter(object):
+    """Write-only file that gzips blocks on a thread pool and writes them out in order."""
+    def __init__(self, fileobj, pool, workers, level=EXPORT_LEVEL, block=EXPORT_BLOCK):
+        self.fileobj = fileobj
+        self.pool = pool
+        self.limit = 2 * workers  # Blocks in flight; bounds memory
+        self.level = level
+        self.block = block
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.offset = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        if len(self.buffer) >= self.block:
+            self._submit()
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def _submit(self):
+        self.pending.append(self.pool.submit(gzip_member, bytes(self.buffer), self.level))
+        self.buffer = bytearray()
+        while len(self.pending) > self.limit:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self._submit()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+def gzip_member(data, level):
+    """One block as a complete gzip member. Blocks that do not shrink (images, archives) are stored."""
+    sample = data[:65536]
+    if len(zlib.compress(sample, 1)) > 0.95 * len(sample):
+        level = 0
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def collect_evidence(exclude=()):
+    """Lists (archive name, path, size, is journal) for the journal, its segments and
+    index, and everything under FILES_DIR. Sizes are taken now: a journal that is still
+    being written is exported as it was at this moment."""
+    excluded = {os.path.abspath(path) for path in exclude}
+    entries = []
+    def add(path, journal):
+        if os.path.abspath(path) not in excluded:
+            entries.append((os.path.normpath(path).replace(os.sep, "/"), path, os.path.getsize(path), journal))
+    
+    def journal_family(journal):
+        root, ext = os.path.splitext(os.path.basename(journal))
+        segment = re.compile(re.escape(root) + r"\.\d{8}-\d{6}(-\d+)?" + re.escape(ext) + r"(\.gz)?$")
+        return lambda name: name == os.path.basename(journal) or segment.match(name)
+    
+    directory = os.path.dirname(LOG_FILE)
+    is_journal = journal_family(LOG_FILE)
+    for name in sorted(os.listdir(directory or ".")):
+        if is_journal(name):
+            add(os.path.join(directory, name), True)
+        elif name == os.path.splitext(os.path.basename(LOG_FILE))[0] + ".index.json":
+            add(os.path.join(directory, name), False)
+    
+    rooms_dir = os.path.join(FILES_DIR, "rooms")
+    for current, subdirs, names in os.walk(FILES_DIR):
+        subdirs.sort()
+        in_room = os.path.dirname(current) == rooms_dir
+        is_room_journal = journal_family(os.path.basename(current) + ".log") if in_room else None
+        for name in sorted(names):
+            add(os.path.join(current, name), bool(is_room_journal and is_room_journal(name)))
+    return entries
+
+def evidence_senders(entries):
+    """Maps each saved file to (sender, time, digest as received) from the "Saved as" lines of the exported journals."""
+    senders = {}
+    for _, path, _, journal in entries:
+        if not journal:
+            continue
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, 'rt', encoding=FORMAT, errors='replace') as f:
+            for line in f:
+                if " - Saved as " in line:
+                    match = SAVED_AS.match(line.rstrip("\n"))
+                    if match:
+                        senders[os.path.normpath(match.group(4))] = (match.group(2), match.group(1), match.group(3))
+    return senders
+
+def hash_file(path, size):
+    """SHA-256 of the first size bytes of a file."""
+    digest = hashlib.sha256()
+    buffer = bytearray(1024 * 1024)
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining:
+            count = f.readinto(memoryview(buffer)[:min(remaining, len(buffer))])
+            if not count:
+                raise OSError(f"{path} shrank while it was being exported")
+            digest.update(memoryview(buffer)[:count])
+            remaining -= count
+    return digest.hexdigest()
+
+def load_export_key(path, create=True):
+    """Reads the manifest signing secret, creating a random one on first use (None if
+    it does not exist and create is False)."""
+    if not os.path.exists(path):
+        if not create:
+            return None
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        print(f"[EXPORT] Created signing key {path}; keep it to verify exports later.")
+    with open(path, 'rb') as f:
+        return f.read().strip()
+
+def sign_manifest(manifest, key):
+    canonical = json.dumps(manifest, sort_keys=True, separators=(",", ":")).encode(FORMAT)
+    return hmac.new(key, canonical, hashlib.sha256).hexdigest()
+
+def export_evidence(destination, key_file=None, workers=None):
+    """Writes the journal and stored files to destination (.tar.gz) with a signed manifest.
+    Returns the manifest."""
+    workers = workers or EXPORT_WORKERS
+    key = load_export_key(key_file or EXPORT_KEY_FILE)
+    started = time.perf_counter()
+    partial = destination + ".part"
+    with journal_freeze:
+        entries = collect_evidence(exclude=(destination, partial))
+        total = sum(entry[2] for entry in entries)
+        print(f"[EXPORT] Exporting {len(entries)} files ({total / 1e6:.1f} MB) to {destination}...")
+        senders = evidence_senders(entries)
+        files = []
+        with ThreadPoolExecutor(workers) as hashers, ThreadPoolExecutor(workers) as compressors, \
+                open(partial, 'wb') as out:
+            stream = ParallelGzipWriter(out, compressors, workers)
+            tar = tarfile.open(fileobj=stream, mode='w', format=tarfile.PAX_FORMAT, copybufsize=1024 * 1024)
+            # Hashing runs a few files ahead of the writer, so both mostly read from the page cache
+            digests = deque(hashers.submit(hash_file, path, size) for _, path, size, _ in entries[:2 * workers])
+            queued = len(digests)
+            written = 0
+            last_report = time.monotonic()
+            for arcname, path, size, _ in entries:
+                info = tarfile.TarInfo(arcname)
+                info.size = size
+                info.mtime = int(os.path.getmtime(path))
+                with open(path, 'rb') as f:
+                    tar.addfile(info, f)
+                if queued < len(entries):
+                    _, next_path, next_size, _ = entries[queued]
+                    digests.append(hashers.submit(hash_file, next_path, next_size))
+                    queued += 1
+                sender, received, received_digest = senders.get(os.path.normpath(path), (None, None, None))
+                files.append({'path': arcname, 'size': size, 'sha256': digests.popleft().result(),
+                              'sender': sender, 'received': received, 'received_digest': received_digest})
+                written += size
+                if time.monotonic() - last_report > 5:
+                    last_report = time.monotonic()
+                    print(f"[EXPORT] {written / 1e6:.0f} of {total / 1e6:.0f} MB")
+            
+            manifest = {'server': server_id(), 'created': datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"),
+                        'algorithm': 'sha256', 'files': files}
+            signed = {'manifest': manifest, 'signature': {'hmac_sha256': sign_manifest(manifest, key),
+                                                          'key_id': hashlib.sha256(key).hexdigest()[:16]}}
+            manifest_data = json.dumps(signed, indent=1).encode(FORMAT)
+            info = tarfile.TarInfo(EXPORT_MANIFEST)
+            info.size = len(manifest_data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(manifest_data))
+            tar.close()
+            stream.close()
+        os.replace(partial, destination)
+    with open(destination + ".manifest.json", 'wb') as f:
+        f.write(manifest_data)
+    elapsed = time.perf_counter() - started
+    print(f"[EXPORT] Done: {len(files)} files, {total / 1e6:.1f} MB in {elapsed:.1f}s "
+          f"({total / 1e6 / max(elapsed, 1e-6):.0f} MB/s) -> {destination} ({os.path.getsize(destination) / 1e6:.1f} MB)")
+    return manifest
+
+def verify_export(archive, key_file=None):
+    """Re-reads an export and checks every file against its manifest and the manifest's signature."""
+    key_file = key_file or EXPORT_KEY_FILE
+    key = load_export_key(key_file, create=False)  # A new key could only ever report a bad signature
+    if key is None:
+        print(f"[VERIFY] {archive}: key file not found: {key_file}")
+        return False
+    found = {}
+    signed = None
+    with open(archive, 'rb') as raw, gzip.GzipFile(fileobj=raw) as stream, tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            f = tar.extractfile(member)
+            if f is None:
+                continue
+            if member.name == EXPORT_MANIFEST:
+                signed = json.loads(f.read().decode(FORMAT))
+                continue
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+            found[member.name] = (member.size, digest.hexdigest())
+    problems = []
+    if signed is None:
+        problems.append("no manifest")
+    else:
+        if not hmac.compare_digest(sign_manifest(signed['manifest'], key), signed['signature']['hmac_sha256']):
+            problems.append("manifest signature does not match (wrong key or altered manifest)")
+        for entry in signed['manifest']['files']:
+            if found.pop(entry['path'], None) != (entry['size'], entry['sha256']):
+                problems.append(f"{entry['path']}: missing or altered")
+        problems += [f"{name}: not in the manifest" for name in found]
+    for problem in problems:
+        print(f"[VERIFY] {problem}")
+    print(f"[VERIFY] {archive}: {'OK' if not problems else f'{len(problems)} problem(s)'}")
+    return not problems
+
+def start_evidence_export(destination=None):
+    """Runs export_evidence on a background thread, so the chat keeps going."""
+    destination = destination or f"evidence_{datetime.datetime.utcnow():%Y%m%d-%H%M%S}.tar.gz"
+    def run():
+        try:
+            export_evidence(destination)
+        except Exception as e:
+            print(f"[EXPORT] Failed: {e}")
+    threading.Thread(target=run, name="evidence-export", daemon=True).start()
+
 # --- Original Server Helper Functions ---
 
-def log_message(source, message_type, content_size=None, content=None, filename=None, status="INFO"):
+def room_storage(room):
+    """Returns (files directory, journal path) for a room; the lobby keeps the original locations."""
+    if not room or room == DEFAULT_ROOM:
+        return FILES_DIR, LOG_FILE
+    if not ROOM_NAME.fullmatch(room):
+        # Peers send room names too; never let one lead outside FILES_DIR
+        raise ValueError(f"invalid room name {room!r}")
+    room_dir = os.path.join(FILES_DIR, "rooms", room)
+    return room_dir, os.path.join(room_dir, f"{room}.log")
+
+def log_message(source, message_type, content_size=None, content=None, filename=None, status="INFO", record=None, room=None,
+                digest=None):
     """
     Logs the message event with a UTC timestamp and saves files/images.
+    Events in a room other than the lobby go to that room's journal and directory.
+    If a record dict is passed, the saved path is stored in record['path'].
+    digest ("algorithm hex", of the bytes as received) is written into the line of a file/image.
     """
     utc_time = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    files_dir, log_file = room_storage(room)
+    received = f", received {digest}" if digest else ""
     
     # Ensure files directory exists
-    if not os.path.exists(FILES_DIR):
-        os.makedirs(FILES_DIR)
+    if not os.path.exists(files_dir):
+        os.makedirs(files_dir)
     
     if message_type == "IMAGE":
         log_entry = f"[{utc_time}] [{status}] [{source}]: Sent IMAGE"
@@ -80,7 +922,7 @@ def log_message(source, message_type, content_size=None, content=None, filename=
             if content is None and content_size is None:
                 raise ValueError("No image data provided for saving")
             new_filename = f"{utc_time.replace(':', '-')}_image.png"
-            destination = os.path.join(FILES_DIR, new_filename)
+            destination = os.path.join(files_dir, new_filename)
             if not isinstance(content, bytes):
                 try:
                     content = bytes(content)
@@ -89,6 +931,7 @@ def log_message(source, message_type, content_size=None, content=None, filename=
                     raise ValueError(f"Cannot convert {type(content)} to bytes")
             if len(content) == 0:
                 raise ValueError("Empty image data")
+            write_start = time.perf_counter()
             with open(destination, 'wb') as f:
                 f.write(content)
             try:
@@ -97,9 +940,12 @@ def log_message(source, message_type, content_size=None, content=None, filename=
                     converted_img.save(destination, format='PNG')
             except Exception as img_error:
                 print(f"Pillow Image Processing Error: {img_error}")
+            metrics.observe('chat_disk_write_seconds', time.perf_counter() - write_start, kind='image')
             if os.path.exists(destination):
                 saved_size = os.path.getsize(destination)
-                log_entry = f"[{utc_time}] [{status}] [{source}]: Sent IMAGE ({saved_size} bytes) - Saved as {os.path.join(FILES_DIR, new_filename)}"
+                if record is not None:
+                    record['path'] = destination
+                log_entry = f"[{utc_time}] [{status}] [{source}]: Sent IMAGE ({saved_size} bytes{received}) - Saved as {os.path.join(files_dir, new_filename)}"
                 print(f"Image saved successfully: {destination}")
             else:
                 log_entry = f"[{utc_time}] [ERROR] [{source}]: Image file creation failed"
@@ -117,7 +963,7 @@ def log_message(source, message_type, content_size=None, content=None, filename=
                 filename = f"{utc_time.replace(':', '-')}_file"
             else:
                 filename = f"{utc_time.replace(':', '-')}_{filename}"
-            destination = os.path.join(FILES_DIR, filename)
+            destination = os.path.join(files_dir, filename)
             if not isinstance(content, bytes):
                 try:
                     content = bytes(content)
@@ -126,11 +972,15 @@ def log_message(source, message_type, content_size=None, content=None, filename=
                     raise ValueError(f"Cannot convert {type(content)} to bytes")
             if len(content) == 0:
                 raise ValueError("Empty file data")
+            write_start = time.perf_counter()
             with open(destination, 'wb') as f:
                 f.write(content)
+            metrics.observe('chat_disk_write_seconds', time.perf_counter() - write_start, kind='file')
             if os.path.exists(destination):
                 saved_size = os.path.getsize(destination)
-                log_entry = f"[{utc_time}] [{status}] [{source}]: Sent FILE ({saved_size} bytes) - Saved as {os.path.join(FILES_DIR, filename)}"
+                if record is not None:
+                    record['path'] = destination
+                log_entry = f"[{utc_time}] [{status}] [{source}]: Sent FILE ({saved_size} bytes{received}) - Saved as {os.path.join(files_dir, filename)}"
                 print(f"File saved successfully: {destination}")
             else:
                 log_entry = f"[{utc_time}] [ERROR] [{source}]: File creation failed"
@@ -147,27 +997,49 @@ def log_message(source, message_type, content_size=None, content=None, filename=
     # PRINT to console (which is now redirected to GUI)
     print(log_entry)
     
-    # Write to file
-    with open(LOG_FILE, 'a', encoding=FORMAT) as f:
-        f.write(log_entry + '\n')
+    # Write to file (workers hand the line to the bus hub, the journal's single writer)
+    write_start = time.perf_counter()
+    if bus_socket is not None:
+        bus_publish(BUS_LOG, f"{log_file}\n{log_entry}".encode(FORMAT))
+    else:
+        write_journal(log_file, log_entry)
+    metrics.observe('chat_disk_write_seconds', time.perf_counter() - write_start, kind='log')
     
     return utc_time.encode(FORMAT)
 
-def broadcast(message):
-    """Sends a message to all connected clients."""
-    for client in clients[:]:
+def broadcast(message, relay=True, room=None, bulk=False, digest=None):
+    """Sends a message to a room's subscribers, or to every client if room is None.
+    With relay set, the message also goes to the other workers. bulk marks a
+    file/image, which goes over the data connection of clients that have one;
+    digest is its "!DIGEST" line for the clients that verify uploads."""
+    if relay and bus_socket is not None:
+        bus_publish(BUS_BROADCAST, (room or "").encode(FORMAT) + b"\n" + message)
+    fan_out_start = time.perf_counter()
+    if room is None:
+        recipients = clients[:]
+    else:
+        with rooms_lock:
+            recipients = list(rooms.get(room, ()))
+    for client in recipients:
         try:
-            client.sendall(message)
+            if bulk:
+                client.send_bulk(message, digest)
+            else:
+                client.sendall(message)
+            user = client_lookup.get(client, "")
+            metrics.inc('chat_messages_out_total', user=user)
+            metrics.inc('chat_bytes_out_total', len(message), user=user)
         except:
             pass
+    metrics.observe('chat_broadcast_seconds', time.perf_counter() - fan_out_start)
 
 def stop_server_logic():
     """Logic to stop the server, close sockets, and reset state."""
-    global is_server_running, server_socket, clients, client_names, connectedClients
+    global is_server_running, clients, client_names, connectedClients
     
     is_server_running = False
     
-    for client in clients:
+    for client in clients[:]:
         try:
             client.close()
         except:
@@ -176,12 +1048,20 @@ def stop_server_logic():
     clients.clear()
     client_names.clear()
     connectedClients.clear()
+    client_lookup.clear()
+    sessions.clear()
+    with rooms_lock:
+        client_rooms.clear()
+        rooms.clear()
+        rooms[DEFAULT_ROOM] = set()
     
-    if server_socket:
-        try:
-            server_socket.close()
-        except:
-            pass
+    for link in peer_links[:]:
+        link.close()
+    
+    if admission is not None:
+        admission.close_listeners()
+    if capture is not None:
+        capture.flush()
     
     print("[SERVER] Stopped.")
 
@@ -190,146 +1070,1536 @@ def start_server_thread():
     global server_thread, is_server_running
     if not is_server_running:
         is_server_running = True
-        server_thread = threading.Thread(target=run_server)
+        start_metrics_endpoint()
+        server_thread = threading.Thread(target=run_server, name="accept-loop")
         server_thread.daemon = True
         server_thread.start()
 
+def build_tls_context():
+    """Server-side TLS context shared by every connection.
+
+    One context means one session-ticket key, so clients that reconnect with
+    the session from their previous connection resume it instead of paying
+    for a full handshake. Building it before forking workers shares the key
+    across workers as well. Kernel TLS offload is requested where the ssl
+    module exposes it (Python 3.12+ with OpenSSL 3 on Linux).
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(TLS_CERT, TLS_KEY)
+    context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
+    context.num_tickets = 2
+    return context
+
+def peer_tls_context():
+    """Client-side context for dialing peers; the peer certificate must chain to TLS_CA (or be TLS_CERT)."""
+    context = ssl.create_default_context(cafile=TLS_CA or TLS_CERT)
+    context.check_hostname = False  # Peers are usually addressed by IP; the pinned CA is what is checked
+    return context
+
+class TLSConnection(object):
+    """Makes one SSLSocket safe to share between threads.
+
+    OpenSSL does not allow an SSL object to be read and written at the same
+    time, yet the handler thread reads while broadcast() writes from other
+    threads. The socket is switched to non-blocking mode, every SSL call is
+    made under a lock, and waiting for the network happens outside it.
+    """
+    def __init__(self, tls_sock):
+        self.sock = tls_sock
+        self.lock = threading.Lock()
+        self.timeout = None
+        self.closed = False
+        tls_sock.setblocking(False)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def _wait(self, for_write, deadline):
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        if for_write:
+            ready = select.select([], [self.sock], [], remaining)[1]
+        else:
+            ready = select.select([self.sock], [], [], remaining)[0]
+        if not ready:
+            raise socket.timeout("timed out")
+
+    def recv(self, size):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                if self.closed:
+                    return b""
+                try:
+                    return self.sock.recv(size)
+                except ssl.SSLWantReadError:
+                    want_write = False
+                except ssl.SSLWantWriteError:
+                    want_write = True
+            self._wait(want_write, deadline)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        with self.lock:
+            while view:
+                if self.closed:
+                    raise OSError("connection closed")
+                try:
+                    sent = self.sock.send(view)
+                    view = view[sent:]
+                except ssl.SSLWantWriteError:
+                    self._wait(True, None)
+                except ssl.SSLWantReadError:
+                    self._wait(False, None)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # Wakes a writer stuck waiting on this socket so the lock is released
+            socket.socket.shutdown(self.sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self.lock:
+            self.sock.close()
+
+    def __getattr__(self, attribute):
+        return getattr(self.sock, attribute)
+
+def configure_keepalive(sock):
+    """Turns on TCP keepalive so the kernel notices peers that vanished without a FIN.
+    Where supported, unacknowledged writes also fail after HEARTBEAT_TIMEOUT, so a
+    broadcast cannot block for long on a dead client."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(HEARTBEAT_INTERVAL)))
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(HEARTBEAT_INTERVAL) // 3))
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        if hasattr(socket, "TCP_USER_TIMEOUT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(HEARTBEAT_TIMEOUT * 1000))
+    except OSError as e:
+        print(f"[WARN] Could not set keepalive options: {e}")
+
+def tune_socket(sock):
+    """Applies the TCP_NODELAY and buffer settings to a connection (or to a listener,
+    whose receive buffer its connections inherit in time for the window scale)."""
+    try:
+        if SEND_BUFFER_BYTES:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+        if RECEIVE_BUFFER_BYTES:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+        if TCP_NODELAY_ON and sock.type == socket.SOCK_STREAM:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        print(f"[WARN] Could not tune socket: {e}")
+
+def set_cork(sock, corked):
+    """With TCP_NODELAY a header written on its own is a packet of its own; corking
+    holds it until the body is written, and uncorking sends what is left at once."""
+    if TCP_CORK_ON and hasattr(socket, "TCP_CORK"):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if corked else 0)
+        except OSError:
+            pass
+
+def send_parts(sock, parts):
+    """Writes several buffers with one call: sendmsg() gathers them on a plain socket,
+    and over TLS they are joined so they travel in one record."""
+    if isinstance(sock, TLSConnection) or not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(parts))
+        return
+    views = [memoryview(part) for part in parts]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if views:
+            views[0] = views[0][sent:]
+
+def reap_idle_sessions():
+    """Closes connections of pinging clients that have gone quiet; their threads then exit
+    and the session is held for resume or ended as usual."""
+    while is_server_running:
+        time.sleep(max(1, HEARTBEAT_INTERVAL / 3))
+        now = time.time()
+        for session in clients[:]:
+            sock = session.sock
+            if sock is not None and session.heartbeats and now - session.last_seen > HEARTBEAT_TIMEOUT:
+                print(f"[REAPED] {session.name}: no heartbeat for {now - session.last_seen:.0f}s.")
+                metrics.inc('chat_reaped_connections_total')
+                close_connection(sock)
+        # Flush throttle summaries of users who have since gone quiet
+        for name, throttle in list(throttles.items()):
+            report_throttling(name, throttle)
+
+def close_connection(sock):
+    """Closes a client connection so that a thread blocked reading it wakes up."""
+    try:
+        if not isinstance(sock, TLSConnection):  # TLSConnection.close() shuts the socket down itself
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    try:
+        sock.close()
+    except OSError:
+        pass
+
+def accept_tls(conn, addr, timeout=TLS_HANDSHAKE_TIMEOUT):
+    """Runs the server side of the TLS handshake; returns the wrapped socket or None."""
+    try:
+        # Handshake flights and session tickets are small back-to-back writes; Nagle would hold them for an ACK
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.settimeout(timeout)
+        tls_conn = tls_context.wrap_socket(conn, server_side=True)
+        tls_conn.settimeout(None)
+    except (ssl.SSLError, OSError) as e:
+        print(f"[AUTH FAILED] TLS handshake with {addr[0]} failed: {e}")
+        metrics.inc('chat_auth_rejects_total', reason='tls_handshake')
+        try:
+            conn.close()
+        except OSError:
+            pass
+        return None
+    metrics.inc('chat_tls_handshakes_total', resumed=str(tls_conn.session_reused).lower())
+    return TLSConnection(tls_conn)
+
+# --- Admission Control ---
+
+def open_listener(host, port):
+    """A non-blocking listening socket on host:port."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != 'nt':
+        # Lets a listener come back on a port it just left while old connections sit in TIME_WAIT
+        # (on Windows the option would let another program take the port instead)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if REUSE_PORT:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    tune_socket(listener)
+    try:
+        listener.bind((host, port))
+        listener.listen(LISTEN_BACKLOG)
+    except OSError:
+        listener.close()
+        raise
+    listener.setblocking(False)
+    return listener
+
+def parse_address(address):
+    """("host", port) from "host:port"; raises ValueError if it is not one."""
+    host, _, port = address.strip().rpartition(":")
+    return host or DEFAULT_HOST, int(port)
+
+class AdmissionControl(object):
+    """Keeps connections that have not authenticated cheap.
+
+    New connections wait in a selector on the accept thread until they send
+    something; only then do they get a handler thread. Connections that are
+    waiting or still authenticating are capped in total and per IP, and have
+    AUTH_TIMEOUT seconds to finish. Noise on the port therefore costs a file
+    descriptor for a few seconds, never a thread per connection.
+
+    Listeners can be added and removed while it runs. Connections are
+    independent of the listener that accepted them, so removing one only
+    stops new connections on that address.
+    """
+    REPORT_INTERVAL = 10
+
+    def __init__(self, listener, address):
+        self.listeners = {address: listener}  # ("host", port) -> listening socket
+        self.changes = []   # (address, listener or None to remove), applied by the accept thread
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.pending = {}   # IP -> connections not yet authenticated
+        self.total = 0
+        self.refused = {}   # Reason -> connections refused since the last report
+        self.reported = time.monotonic()
+
+    def add_listener(self, address):
+        """Starts accepting on address as well; raises OSError if it cannot be bound."""
+        with self.lock:
+            pending = [listener for changed, listener in self.changes if changed == address]
+            if (pending[-1] is not None) if pending else address in self.listeners:
+                return  # Already listening there
+        listener = open_listener(*address)  # Bound here, so the caller hears about a port in use
+        with self.lock:
+            self.changes.append((address, listener))
+        log_message("SERVER", f"LISTENING on {address[0]}:{address[1]}")
+
+    def remove_listener(self, address):
+        with self.lock:
+            self.changes.append((address, None))
+        log_message("SERVER", f"STOPPED LISTENING on {address[0]}:{address[1]}")
+
+    def addresses(self):
+        with self.lock:
+            return list(self.listeners)
+
+    def _apply_changes(self):
+        """Adds and removes listeners on the accept thread, which owns the selector."""
+        with self.lock:
+            changes, self.changes = self.changes, []
+            for address, listener in changes:
+                old = self.listeners.pop(address, None)
+                if old is not None:
+                    self.selector.unregister(old)
+                    old.close()
+                if listener is not None:
+                    self.listeners[address] = listener
+                    self.selector.register(listener, selectors.EVENT_READ)
+
+    def close_listeners(self):
+        """Stops accepting on every address (the server is stopping)."""
+        with self.lock:
+            for listener in list(self.listeners.values()) + [l for _, l in self.changes if l is not None]:
+                try:
+                    listener.close()
+                except OSError:
+                    pass
+
+    def poll(self, timeout=0.5):
+        if self.changes:
+            self._apply_changes()
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                self._accept(key.fileobj)
+                continue
+            # First bytes arrived (name or TLS ClientHello): worth a thread now
+            self.selector.unregister(key.fileobj)
+            conn, (addr, deadline) = key.fileobj, key.data
+            conn.setblocking(True)
+            thread = threading.Thread(target=handle_client, args=(conn, addr, deadline, self), name=f"client-{addr[0]}:{addr[1]}")
+            thread.start()
+        self._expire()
+        self._report()
+
+    def _accept(self, listener):
+        for _ in range(LISTEN_BACKLOG):
+            try:
+                conn, addr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # A client that resets before accept() (common in reconnect storms) must not stop the listener
+                print(f"[ERROR] Accept error: {e}")
+                time.sleep(0.01)
+                return
+            reason = self._admit(addr[0])
+            if reason:
+                self._refuse(conn, reason)
+                continue
+            open_connections = metrics.connection_opened()
+            print(f"[ACTIVE CONNECTIONS] {open_connections}")
+            configure_keepalive(conn)
+            tune_socket(conn)
+            conn.setblocking(False)
+            self.selector.register(conn, selectors.EVENT_READ, (addr, time.monotonic() + AUTH_TIMEOUT))
+
+    def _admit(self, ip):
+        with self.lock:
+            if self.total >= MAX_PENDING:
+                return 'pending_total'
+            if self.pending.get(ip, 0) >= MAX_PENDING_PER_IP:
+                return 'pending_per_ip'
+            self.total += 1
+            self.pending[ip] = self.pending.get(ip, 0) + 1
+        return None
+
+    def release(self, ip):
+        """Called once a connection has authenticated or gone away."""
+        with self.lock:
+            self.total -= 1
+            self.pending[ip] -= 1
+            if not self.pending[ip]:
+                del self.pending[ip]
+
+    def _refuse(self, conn, reason):
+        try:
+            conn.close()
+        except OSError:
+            pass
+        metrics.inc('chat_admission_rejects_total', reason=reason)
+        self.refused[reason] = self.refused.get(reason, 0) + 1
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in list(self.selector.get_map().values()):
+            if key.data is None or key.data[1] > now:
+                continue
+            self.selector.unregister(key.fileobj)
+            self.release(key.data[0][0])
+            metrics.connection_closed()
+            self._refuse(key.fileobj, 'auth_timeout')
+
+    def _report(self):
+        """Summarises refusals instead of printing one line per connection of a flood."""
+        if not self.refused or time.monotonic() - self.reported < self.REPORT_INTERVAL:
+            return
+        summary = ", ".join(f"{count} {reason}" for reason, count in sorted(self.refused.items()))
+        log_message("SERVER", f"ADMISSION refused {summary}", status="WARNING")
+        self.refused.clear()
+        self.reported = time.monotonic()
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                # Still waiting to authenticate: counted like an expired one
+                self.release(key.data[0][0])
+                metrics.connection_closed()
+                try:
+                    key.fileobj.close()
+                except OSError:
+                    pass
+        self.close_listeners()
+        self.selector.close()
+
 def run_server():
     """Main server loop."""
-    global server_socket, HOST, PORT, is_server_running
+    global HOST, PORT, is_server_running, tls_context, admission
     
     try:
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((HOST, PORT))
-        server_socket.listen()
+        if TLS_CERT and tls_context is None:
+            tls_context = build_tls_context()
+        admission = AdmissionControl(open_listener(HOST, PORT), (HOST, PORT))
         
-        print(f"[LISTENING] Server is listening on {HOST}:{PORT}")
-        log_message("SERVER", "STARTUP", f"Server started on {HOST}:{PORT}")
+        worker_label = f" (worker {worker_id})" if worker_id else ""
+        if tls_context:
+            worker_label += " with TLS"
+        print(f"[LISTENING] Server is listening on {HOST}:{PORT}{worker_label}")
+        log_message("SERVER", "STARTUP", f"Server started on {HOST}:{PORT}{worker_label}")
+        for address in LISTEN_ADDRESSES:
+            try:
+                admission.add_listener(parse_address(address))
+            except (OSError, ValueError) as e:
+                print(f"[ERROR] Cannot listen on {address}: {e}")
+        start_peer_dialers()
+        start_config_watcher()
+        start_capture()
+        threading.Thread(target=reap_idle_sessions, name="reaper", daemon=True).start()
         
         while is_server_running:
             try:
-                conn, addr = server_socket.accept()
-                thread = threading.Thread(target=handle_client, args=(conn, addr))
-                thread.start()
-                print(f"[ACTIVE CONNECTIONS] {threading.active_count() - 2}") 
-            except OSError:
-                break
+                admission.poll()
+            except (OSError, ValueError) as e:
+                if not is_server_running:
+                    break
+                print(f"[ERROR] Accept error: {e}")
+                time.sleep(0.01)
             except Exception as e:
                 print(f"[ERROR] Accept error: {e}")
                 break
+        admission.close()
                 
     except Exception as e:
         print(f"[ERROR] Server failed to start: {e}")
         is_server_running = False
 
-def handle_client(conn, addr):
-    """Handles communication with a single client."""
+# --- Rate Limiting ---
+
+class TokenBucket(object):
+    """Refills at `rate` tokens per second up to `burst`; taking more than is
+    there leaves a debt, and the wait returned is how long until it is repaid."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount):
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def give_back(self, amount):
+        self.tokens = min(self.burst, self.tokens + amount)
+
+class UserThrottle(object):
+    """Both buckets of one user plus counters for the throttle log."""
+    def __init__(self, limits):
+        self.limits = limits
+        self.messages = TokenBucket(limits['messages_per_second'], max(1, limits['message_burst']))
+        self.bytes = TokenBucket(limits['bytes_per_second'], max(1, limits['byte_burst']))
+        self.lock = threading.Lock()
+        self.delayed = 0
+        self.rejected = 0
+        self.reported = 0.0  # When the last summary was logged (0: never)
+
+throttles = {}  # User -> UserThrottle, shared by all of that user's connections
+THROTTLE_LOG_INTERVAL = 10  # Seconds between journal lines about one user's throttling
+
+def limits_for(name):
+    limits = dict(rateLimits)
+    limits.update(userRateLimits.get(name, {}))
+    return limits
+
+def user_throttle(name):
+    throttle = throttles.get(name)
+    if throttle is None:
+        throttle = throttles.setdefault(name, UserThrottle(limits_for(name)))
+    return throttle
+
+def report_throttling(name, throttle):
+    """Logs a summary of one user's throttling at most every THROTTLE_LOG_INTERVAL seconds."""
+    now = time.monotonic()
+    if throttle.reported and now - throttle.reported < THROTTLE_LOG_INTERVAL:
+        return
+    with throttle.lock:
+        delayed, rejected = throttle.delayed, throttle.rejected
+        throttle.delayed = throttle.rejected = 0
+        throttle.reported = now
+    if delayed or rejected:
+        log_message("SERVER", f"THROTTLE {name}: {delayed} delayed, {rejected} rejected", status="WARNING")
+
+def rate_limit(conn, name, size):
+    """Charges one message of `size` bytes to the user. Waits if they are a little over
+    their limit; returns False (after telling them) if the message should be dropped."""
+    throttle = user_throttle(name)
+    with throttle.lock:
+        wait = max(throttle.messages.take(1), throttle.bytes.take(size))
+        rejected = wait > throttle.limits['max_delay']
+        if rejected:
+            throttle.messages.give_back(1)
+            throttle.bytes.give_back(size)
+            throttle.rejected += 1
+        elif wait > 0:
+            throttle.delayed += 1
+    if rejected:
+        metrics.inc('chat_throttled_total', user=name, action='rejected')
+        report_throttling(name, throttle)
+        try:
+            conn.sendall(f"{ERROR_MESSAGE} rate_limited: message dropped, you are sending faster than "
+                         f"{throttle.limits['messages_per_second']} messages/s.".encode(FORMAT), PRIORITY_CONTROL)
+        except OSError:
+            pass
+        return False
+    if wait > 0:
+        metrics.inc('chat_throttled_total', user=name, action='delayed')
+        report_throttling(name, throttle)
+        # Not reading is the throttle: the client's sends back up in TCP
+        time.sleep(wait)
+    return True
+
+def pace_upload(name, size):
+    """Delays reading the rest of a file/image so it arrives at the user's byte rate."""
+    throttle = user_throttle(name)
+    with throttle.lock:
+        wait = throttle.bytes.take(size)
+    if wait > 0:
+        time.sleep(wait)
+
+def clean_limits(limits):
+    """The limits with float values; raises ValueError for an unknown name or a bad value."""
+    for key in limits:
+        if key not in RATE_LIMIT_DEFAULTS:
+            raise ValueError(f"unknown limit '{key}'")
+    return {key: float(value) for key, value in limits.items()}
+
+def apply_rate_limits(defaults, per_user):
+    """Replaces the limits. Users whose limits changed get new buckets on their next
+    message; everyone else keeps theirs. Returns the users whose limits changed."""
+    before = {name: throttle.limits for name, throttle in list(throttles.items())}
+    rateLimits.clear()
+    rateLimits.update(RATE_LIMIT_DEFAULTS)
+    rateLimits.update(defaults)
+    userRateLimits.clear()
+    userRateLimits.update(per_user)
+    changed = sorted(name for name, limits in before.items() if limits_for(name) != limits)
+    for name in changed:
+        throttles.pop(name, None)
+    return changed
+
+# --- Configuration File ---
+# CONFIG_FILE holds the authorized users, the rate limits and the addresses to
+# listen on besides HOST:PORT. The GUI writes it, and it may be edited while
+# the server runs: a watcher thread polls it and applies only the sections
+# that differ from what it last read. A user taken off the list loses their
+# sessions, a limit change resets only the buckets it affects, and listeners
+# are opened or closed without touching established connections.
+CONFIG_SECTIONS = ('users', 'rate_limits', 'listen')
+config_sections = {}  # Section -> value as last read from or written to CONFIG_FILE
+config_stamp = None   # (mtime, size) of CONFIG_FILE when last read or written
+config_watcher = None
+
+def config_file_stamp():
+    try:
+        info = os.stat(CONFIG_FILE)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+def read_config():
+    with open(CONFIG_FILE, 'r', encoding=FORMAT) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError("not a JSON object")
+    return config
+
+def apply_users(users):
+    """Replaces the authorized users and ends the sessions of anyone no longer on the list.
+    Returns the users removed."""
+    removed = set(authorizedUsers) - set(users)
+    authorizedUsers[:] = users
+    for session in set(clients[:]) | set(sessions.values()):
+        if session.name in removed:
+            print(f"[CONFIG] {session.name} is no longer authorized; closing their session.")
+            session.close()
+    return sorted(removed)
+
+def apply_listen_addresses(addresses):
+    """Opens and closes listeners so that the server listens on HOST:PORT and addresses."""
+    parsed = {address: parse_address(address) for address in addresses}
+    old = [address for address in LISTEN_ADDRESSES if address not in parsed]
+    LISTEN_ADDRESSES[:] = addresses
+    if admission is None or not is_server_running:
+        return
+    for address in old:
+        if parse_address(address) != (HOST, PORT):
+            admission.remove_listener(parse_address(address))
+    for address, host_port in parsed.items():
+        try:
+            admission.add_listener(host_port)
+        except OSError as e:
+            print(f"[ERROR] Cannot listen on {address}: {e}")
+
+def apply_config_section(section, value):
+    """Puts one section of the configuration file into effect; returns a summary for the journal."""
+    if section != 'rate_limits' and not isinstance(value, list):
+        raise TypeError(f"'{section}' must be a list")
+    if section == 'users':
+        removed = apply_users([str(user).strip() for user in value if str(user).strip()])
+        return f"{len(authorizedUsers)} users" + (f", removed {', '.join(removed)}" if removed else "")
+    if section == 'rate_limits':
+        per_user = {user: clean_limits(limits) for user, limits in value.get('users', {}).items()}
+        changed = apply_rate_limits(clean_limits(value.get('default', {})), per_user)
+        return f"buckets reset for {', '.join(changed) or 'nobody'}"
+    apply_listen_addresses([str(address) for address in value])
+    return ", ".join([f"{HOST}:{PORT}"] + LISTEN_ADDRESSES)
+
+def load_config(path=None):
+    """Reads the configuration file at startup; a missing file leaves the defaults."""
+    global CONFIG_FILE, config_stamp
+    CONFIG_FILE = path or CONFIG_FILE
+    config_stamp = config_file_stamp()
+    if config_stamp is None:
+        return
+    try:
+        config = read_config()
+        for section in CONFIG_SECTIONS:
+            if section in config:
+                apply_config_section(section, config[section])
+                config_sections[section] = config[section]
+        print(f"[CONFIG] Loaded {CONFIG_FILE}")
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        print(f"[ERROR] Could not read {CONFIG_FILE}: {e}")
+
+def reload_config():
+    """Applies the sections of the configuration file that changed since it was last read."""
+    global config_stamp
+    config_stamp = config_file_stamp()
+    try:
+        config = read_config()
+    except (OSError, ValueError) as e:
+        # Often an editor half way through saving; the next change brings it back here
+        print(f"[ERROR] Could not read {CONFIG_FILE}: {e}")
+        return
+    for section in CONFIG_SECTIONS:
+        if section not in config or config[section] == config_sections.get(section):
+            continue
+        try:
+            summary = apply_config_section(section, config[section])
+        except (ValueError, TypeError, AttributeError) as e:
+            print(f"[ERROR] {CONFIG_FILE}: ignoring the '{section}' section: {e}")
+            continue
+        config_sections[section] = config[section]
+        log_message("SERVER", f"CONFIG RELOAD {section}: {summary}")
+
+def save_config():
+    """Writes the users, rate limits and listen addresses to CONFIG_FILE."""
+    global config_stamp
+    config = {'users': list(authorizedUsers), 'rate_limits': {'default': rateLimits, 'users': userRateLimits},
+              'listen': list(LISTEN_ADDRESSES)}
+    try:
+        # Replaced in one step so a watcher (ours or another worker's) never reads half a file
+        with open(CONFIG_FILE + ".tmp", 'w', encoding=FORMAT) as f:
+            json.dump(config, f, indent=2)
+        os.replace(CONFIG_FILE + ".tmp", CONFIG_FILE)
+    except OSError as e:
+        print(f"[ERROR] Could not write {CONFIG_FILE}: {e}")
+        return
+    config_sections.update(json.loads(json.dumps(config)))  # As the watcher would read it back
+    config_stamp = config_file_stamp()
+
+def watch_config():
+    """Reloads CONFIG_FILE whenever it changes on disk, while the server runs."""
+    while is_server_running:
+        time.sleep(CONFIG_POLL_INTERVAL)
+        stamp = config_file_stamp()
+        if stamp is not None and stamp != config_stamp:
+            reload_config()
+
+def start_config_watcher():
+    global config_watcher
+    if config_watcher is None or not config_watcher.is_alive():
+        config_watcher = threading.Thread(target=watch_config, name="config-watcher", daemon=True)
+        config_watcher.start()
+
+
+# --- Outbound Scheduling ---
+# Writes to a client are queued by priority class and sent by a writer thread,
+# so a chat message does not wait behind a file fan-out that is still queued.
+# Classes share the connection by weighted fair queuing on bytes: with these
+# weights a text message gets 16 bytes on the wire for every byte of a file.
+PRIORITY_CONTROL = 'control'  # Pongs and errors
+PRIORITY_TEXT = 'text'        # Chat text and server notices
+PRIORITY_IMAGE = 'image'
+PRIORITY_BULK = 'bulk'        # File bodies
+PRIORITY_WEIGHTS = {PRIORITY_CONTROL: 64, PRIORITY_TEXT: 16, PRIORITY_IMAGE: 4, PRIORITY_BULK: 1}
+OUTBOUND_CHUNK = 256 * 1024         # Largest single write
+# A client that stays connected but stops reading would make the server keep
+# every broadcast for it. Past these marks (bytes waiting for one connection,
+# per class, and for all of a session's connections) it is sent
+# "!ERROR slow_consumer" and dropped. One message bigger than a mark is still
+# queued when nothing else of its class is waiting.
+OUTBOUND_LIMITS = {PRIORITY_CONTROL: 1024 * 1024, PRIORITY_TEXT: 8 * 1024 * 1024,
+                   PRIORITY_IMAGE: 64 * 1024 * 1024, PRIORITY_BULK: 128 * 1024 * 1024}
+OUTBOUND_SESSION_LIMIT = 256 * 1024 * 1024
+SLOW_CONSUMER_GRACE = 5  # Seconds the error gets to go out before the connection is closed anyway
+DATA_FRAME = struct.Struct('!II')   # Data connection to the client: stream id, chunk length
+
+class StoredFile(object):
+    """A message whose body is read from disk as it is written: header, then
+    length bytes of the file from start. On a plain socket the body goes out
+    with sendfile(); over TLS, from a read-only mmap of the file. Either way it
+    never becomes Python bytes, and every download of the same file is served
+    from the one copy in the page cache. close() it once it has left the
+    queues and the resume backlog (see close_message())."""
+    def __init__(self, header, path, start, length):
+        self.header = header
+        self.start = start
+        self.length = length
+        self.file = open(path, 'rb')  # Kept open, so the body survives the file being moved
+        self.map = None
+        self.lock = threading.Lock()
+        self.writers = 0      # write_to() calls in progress
+        self.closed = False
+
+    def __len__(self):
+        return len(self.header) + self.length
+
+    def startswith(self, prefix):
+        return self.header.startswith(prefix)
+
+    def write_to(self, sock, offset, size):
+        """Writes bytes offset..offset+size of the message to sock."""
+        with self.lock:
+            if self.closed:
+                raise OSError("stored file closed")
+            self.writers += 1
+        try:
+            if offset < len(self.header):
+                head = self.header[offset:offset + size]
+                sock.sendall(head)
+                offset += len(head)
+                size -= len(head)
+            if size <= 0:
+                return
+            position = self.start + offset - len(self.header)
+            if isinstance(sock, TLSConnection):
+                # The kernel cannot encrypt, so sendfile() is out; a view of the mapping still avoids a copy
+                self.send_mapped(sock, position, size)
+            else:
+                self.send_file(sock, position, size)
+        finally:
+            with self.lock:
+                self.writers -= 1
+                release = self.closed and not self.writers
+            if release:
+                self.release()
+
+    def close(self):
+        """Closes the file and its mapping, once no write is using them."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.writers:
+                return  # The last write_to() releases them
+        self.release()
+
+    def release(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def send_file(self, sock, position, size):
+        if sock.sendfile(self.file, position, size) != size:
+            raise OSError("stored file is shorter than when it was queued")
+
+    def send_mapped(self, sock, position, size):
+        with self.lock:
+            if self.map is None:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        with memoryview(self.map)[position:position + size] as view:
+            sock.sendall(view)
+
+class PrefixedMessage(object):
+    """A message with a line in front of it, for the clients that read that line
+    (the "!DIGEST" of an upload), without copying a body that every recipient shares."""
+    def __init__(self, prefix, message):
+        self.prefix = prefix
+        self.message = message
+
+    def __len__(self):
+        return len(self.prefix) + len(self.message)
+
+    def startswith(self, prefix):
+        return self.message.startswith(prefix)  # Classifies it like the message it carries
+
+    def write_to(self, sock, offset, size):
+        if offset < len(self.prefix):
+            head = self.prefix[offset:offset + size]
+            sock.sendall(head)
+            offset += len(head)
+            size -= len(head)
+        if size > 0:
+            write_piece(sock, self.message, offset - len(self.prefix), size)
+
+def memory_parts(data, offset, size):
+    """The buffers holding bytes offset..offset+size of a queued message, or None if some come from a file."""
+    if isinstance(data, bytes):
+        return [memoryview(data)[offset:offset + size]]
+    if isinstance(data, PrefixedMessage) and isinstance(data.message, bytes):
+        end = offset + size
+        parts = [memoryview(data.prefix)[offset:end]] if offset < len(data.prefix) else []
+        start = max(0, offset - len(data.prefix))
+        if end - len(data.prefix) > start:
+            parts.append(memoryview(data.message)[start:end - len(data.prefix)])
+        return parts
+    return None
+
+def write_piece(sock, data, offset, size):
+    """Writes part of a queued message (bytes, StoredFile or PrefixedMessage) to sock."""
+    parts = memory_parts(data, offset, size)
+    if parts is None:
+        data.write_to(sock, offset, size)
+    elif len(parts) == 1:
+        sock.sendall(parts[0])
+    else:
+        send_parts(sock, parts)
+
+def close_message(data):
+    """Releases what a message nobody will write again holds open: the file of a StoredFile."""
+    if isinstance(data, PrefixedMessage):
+        data = data.message
+    if isinstance(data, StoredFile):
+        data.close()
+
+class SlowConsumer(OSError):
+    """A message would take a client past OUTBOUND_LIMITS or OUTBOUND_SESSION_LIMIT."""
+
+class OutboundScheduler(object):
+    """Messages waiting to be written to one connection, by priority class.
+
+    next_write() picks the class with the smallest virtual finish tag. The
+    chat connection is unframed, so a message that has been started is
+    written to the end; with framed=True (the data connection) messages are
+    cut into OUTBOUND_CHUNK pieces and pieces of different messages interleave.
+    """
+    def __init__(self, framed=False):
+        self.framed = framed
+        self.cond = threading.Condition()
+        self.queues = {priority: deque() for priority in PRIORITY_WEIGHTS}
+        self.finish = dict.fromkeys(PRIORITY_WEIGHTS, 0.0)
+        self.virtual_time = 0.0
+        self.streams = itertools.count(1)
+        self.queued = dict.fromkeys(PRIORITY_WEIGHTS, 0)  # Bytes not handed out yet, by class
+        self.closed = False
+
+    def put(self, data, priority, force=False):
+        """Queues a message; raises SlowConsumer past the class's OUTBOUND_LIMITS unless force."""
+        with self.cond:
+            if self.closed:
+                raise OSError("connection closed")
+            if not force and self.queues[priority] and self.queued[priority] + len(data) > OUTBOUND_LIMITS[priority]:
+                raise SlowConsumer(f"{self.queued[priority]} bytes of {priority} messages waiting")
+            # [data, bytes handed out, stream id, time queued]
+            self.queues[priority].append([data, 0, next(self.streams), time.monotonic()])
+            self.queued[priority] += len(data)
+            self.cond.notify()
+
+    def queued_bytes(self):
+        with self.cond:
+            return sum(self.queued.values())
+
+    def next_write(self, timeout=None):
+        """Waits for something to write. Returns (priority, stream id, message, offset, size,
+        time queued if that piece ends the message, else None), None once closed, or
+        False if timeout (seconds) passes with nothing to write."""
+        with self.cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.closed and not any(self.queues.values()):
+                if deadline is None:
+                    self.cond.wait()
+                elif not self.cond.wait(max(0, deadline - time.monotonic())) and not any(self.queues.values()):
+                    return False
+            if self.closed:
+                return None
+            best = None
+            for priority, pending in self.queues.items():
+                if pending:
+                    data, offset = pending[0][0], pending[0][1]
+                    size = len(data) - offset
+                    if self.framed:
+                        size = min(size, OUTBOUND_CHUNK)
+                    start = max(self.virtual_time, self.finish[priority])
+                    tag = start + size / PRIORITY_WEIGHTS[priority]
+                    if best is None or tag < best[0]:
+                        best = (tag, start, priority, size)
+            tag, self.virtual_time, priority, size = best
+            self.finish[priority] = tag
+            entry = self.queues[priority][0]
+            data, offset, stream, queued = entry
+            entry[1] += size
+            self.queued[priority] -= size
+            if entry[1] < len(data):
+                return priority, stream, data, offset, size, None
+            self.queues[priority].popleft()
+            return priority, stream, data, offset, size, queued
+
+    def close(self):
+        """Stops the writer; returns (message, priority) for every message not completely handed out."""
+        with self.cond:
+            self.closed = True
+            unsent = [(entry[0], priority) for priority, pending in self.queues.items() for entry in pending]
+            self.clear()
+            self.cond.notify_all()
+        return unsent
+
+    def discard(self):
+        """Forgets every queued message; the writer carries on with whatever is queued next."""
+        with self.cond:
+            dropped = [entry[0] for pending in self.queues.values() for entry in pending]
+            self.clear()
+        for data in dropped:
+            close_message(data)
+
+    def clear(self):
+        for pending in self.queues.values():
+            pending.clear()
+        self.queued = dict.fromkeys(PRIORITY_WEIGHTS, 0)
+
+# --- Client Sessions ---
+
+class ClientSession(object):
+    """A client's place in the chat, which can outlive its connection.
+
+    Everything written to the client goes through sendall(), which queues it
+    for the session's writer thread. The writer counts the bytes and keeps the
+    most recent ones in the order they went out, so a client that reconnects
+    with its token and the offset it had processed gets exactly the bytes it
+    missed. While no connection is attached, writes are only kept.
+    """
+    def __init__(self, sock, name, ip, resumable):
+        self.sock = sock
+        self.name = name
+        self.ip = ip
+        self.resumable = resumable
+        self.token = secrets.token_hex(16) if resumable else None
+        self.claimed = False   # Holds a name claim at the bus hub
+        self.lock = threading.Lock()
+        self.sent = 0          # Bytes written over the whole session
+        self.backlog = deque() # (offset, bytes) of recent writes
+        self.backlog_bytes = 0
+        self.generation = 0    # Bumped on every resume so a stale connection thread can tell
+        self.detached_at = None
+        self.closed = False
+        self.dropped = False   # Stopped reading; being disconnected (see drop_slow)
+        self.last_seen = time.time()  # Last time anything arrived from the client
+        self.heartbeats = False       # The client pings, so silence means it is gone
+        # Resumable clients may open a second connection for file/image bodies (see serve_data_channel).
+        # Workers do not offer it: the kernel may hand that connection to a different process.
+        self.data_token = secrets.token_hex(16) if resumable and bus_socket is None else None
+        self.data_sock = None
+        self.data_outbox = None  # Scheduler of the data connection's writer thread
+        self.capture_id = None   # Chat connection's id in the traffic capture
+        self.outbound = OutboundScheduler()
+        writer = threading.Thread(target=self.write_loop, name=f"out-{name}")
+        writer.daemon = True
+        writer.start()
+
+    def sendall(self, data, priority=PRIORITY_TEXT):
+        if self.closed or self.dropped:
+            raise OSError("session closed")
+        self.enqueue(self.outbound, data if isinstance(data, (StoredFile, PrefixedMessage)) else bytes(data), priority)
+
+    def send_bulk(self, data, digest=None):
+        """Sends a file/image over the data connection if there is one, so chat text
+        keeps moving on the main connection while it goes out; otherwise like sendall.
+        digest is the upload's "!DIGEST" line, sent ahead of it to clients that verify it."""
+        priority = PRIORITY_IMAGE if data.startswith(b"IMAGE|") else PRIORITY_BULK
+        if digest is not None and self.resumable:
+            data = PrefixedMessage(digest, data)
+        with self.lock:
+            outbox = self.data_outbox
+        if outbox is not None:
+            try:
+                self.enqueue(outbox, data, priority)
+                return
+            except SlowConsumer:
+                raise
+            except OSError:
+                pass  # Its connection just failed; the chat connection carries it
+        self.sendall(data, priority)
+
+    def enqueue(self, outbox, data, priority):
+        """Queues data on one of the session's connections, or drops the client if it
+        has let more than OUTBOUND_LIMITS / OUTBOUND_SESSION_LIMIT pile up unread."""
+        with self.lock:
+            data_outbox = self.data_outbox
+        queued = self.outbound.queued_bytes() + (data_outbox.queued_bytes() if data_outbox else 0)
+        try:
+            if queued and queued + len(data) > OUTBOUND_SESSION_LIMIT:
+                raise SlowConsumer(f"{queued} bytes waiting")
+            outbox.put(data, priority)
+        except SlowConsumer as e:
+            self.drop_slow(priority, e)
+            raise
+
+    def drop_slow(self, priority, reason):
+        """Frees what was queued for a client that stopped reading, tells it why and
+        disconnects it, after SLOW_CONSUMER_GRACE at the latest if the error cannot get out."""
+        with self.lock:
+            if self.dropped or self.closed:
+                return
+            self.dropped = True
+            data_sock, data_outbox = self.data_sock, self.data_outbox
+            self.data_sock = self.data_outbox = None  # Nothing is resent from the data connection
+        metrics.inc('chat_slow_consumers_total', priority=priority)
+        log_message("SERVER", f"SLOW CONSUMER {self.name} dropped: {reason}")
+        self.outbound.discard()
+        if data_outbox is not None:
+            for data, _ in data_outbox.close():
+                close_message(data)
+        if data_sock is not None:
+            close_connection(data_sock)
+        try:
+            self.outbound.put(f"{ERROR_MESSAGE} slow_consumer: you were disconnected because messages for you "
+                              f"were piling up unread.".encode(FORMAT), PRIORITY_CONTROL, force=True)
+        except OSError:
+            pass
+        timer = threading.Timer(SLOW_CONSUMER_GRACE, self.close)
+        timer.daemon = True
+        timer.start()
+
+    def write_loop(self):
+        """Writer thread of the chat connection, until the session ends."""
+        while True:
+            item = self.outbound.next_write()
+            if item is None:
+                return
+            priority, _, data, _, _, queued = item
+            self.write(data)
+            metrics.observe('chat_outbound_seconds', time.monotonic() - queued, priority=priority)
+            if self.dropped and not self.outbound.queued_bytes():
+                self.close()  # The slow_consumer error is out
+
+    def write(self, data):
+        evicted = []
+        with self.lock:
+            if self.resumable:
+                self.backlog.append((self.sent, data))
+                self.backlog_bytes += len(data)
+                while self.backlog_bytes > RESUME_BUFFER_BYTES and len(self.backlog) > 1:
+                    evicted.append(self.backlog.popleft()[1])
+                    self.backlog_bytes -= len(evicted[-1])
+            self.sent += len(data)
+            sock, generation = self.sock, self.generation
+        for old in evicted:
+            close_message(old)
+        try:
+            self.write_to_socket(sock, generation, data)
+        finally:
+            if not self.resumable:
+                close_message(data)  # Not kept for a resume
+
+    def write_to_socket(self, sock, generation, data):
+        if sock is None:
+            return
+        # Written outside the lock in bounded pieces, so a resume does not wait for a whole file
+        corked = memory_parts(data, 0, len(data)) is None  # Header and file body are separate writes
+        if corked:
+            set_cork(sock, True)
+        try:
+            for offset in range(0, len(data), OUTBOUND_CHUNK):
+                if self.generation != generation:
+                    return  # Resumed meanwhile; the replay carried the rest
+                write_piece(sock, data, offset, min(OUTBOUND_CHUNK, len(data) - offset))
+                metrics.inc('chat_socket_writes_total', connection='chat')
+        except OSError:
+            # The connection's reading thread notices and holds or ends the session
+            close_connection(sock)
+        finally:
+            if corked:
+                set_cork(sock, False)
+
+    def attach_data(self, sock):
+        """Makes sock the data connection; returns the scheduler its writer serves, or None."""
+        with self.lock:
+            if self.closed:
+                return None
+            old_sock, old_outbox = self.data_sock, self.data_outbox
+            self.data_sock, self.data_outbox = sock, OutboundScheduler(framed=True)
+            outbox = self.data_outbox
+        if old_sock is not None:
+            # Reconnected; what the old connection still had goes out on the new one
+            close_connection(old_sock)
+            resend_bulk(self, old_outbox.close())
+        return outbox
+
+    def detach_data(self, sock):
+        """Stops queueing bodies for sock; later ones go to a newer data connection or the chat connection."""
+        with self.lock:
+            if self.data_sock is not sock:
+                return None
+            outbox = self.data_outbox
+            self.data_sock = self.data_outbox = None
+        return outbox
+
+    def attach(self, sock, offset):
+        """Moves the session onto a new connection and replays everything after offset.
+        Returns (generation, complete) or None if the session has already ended."""
+        with self.lock:
+            if self.closed:
+                return None
+            old_sock = self.sock
+            self.sock = sock
+            self.generation += 1
+            self.detached_at = None
+            self.last_seen = time.time()
+            kept_from = self.backlog[0][0] if self.backlog else self.sent
+            complete = kept_from <= offset
+            offset = min(max(offset, kept_from), self.sent)
+            replay = [f"{RESUMED_MESSAGE} {offset}\n".encode(FORMAT)]
+            for start, data in self.backlog:
+                if start + len(data) <= offset:
+                    continue
+                skip = max(0, offset - start)
+                if isinstance(data, (StoredFile, PrefixedMessage)):
+                    sock.sendall(b"".join(replay))
+                    replay = []
+                    data.write_to(sock, skip, len(data) - skip)
+                else:
+                    replay.append(data[skip:])
+            sock.sendall(b"".join(replay))
+            generation = self.generation
+        if old_sock is not None:
+            # The client came back before we noticed the old connection was dead
+            close_connection(old_sock)
+        return generation, complete
+
+    def detach(self, generation):
+        """Called when a connection ends; False if a newer connection already owns the session."""
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.sock = None
+            self.detached_at = time.time()
+            return True
+
+    def expire(self, generation):
+        """Ends a held session unless its client has come back since."""
+        with self.lock:
+            if self.closed or self.sock is not None or generation != self.generation:
+                return False
+            self.closed = True
+            return True
+
+    def close(self):
+        """Ends the session for good (kicked or server stopping)."""
+        with self.lock:
+            was_closed = self.closed
+            self.closed = True
+            sock = self.sock
+        if self.data_sock is not None:
+            close_connection(self.data_sock)
+        if sock is not None:
+            # Its connection thread notices and ends the session
+            close_connection(sock)
+        elif not was_closed:
+            end_session(self)
+
+def find_session(name, hello):
+    """Returns the session a "!RESUME token offset" hello refers to, or None."""
+    if len(hello) != 3 or hello[0] != RESUME_MESSAGE:
+        return None
+    session = sessions.get(hello[1])
+    if session is None or session.name != name or session.closed:
+        return None
+    return session
+
+def hold_session(session):
+    """Keeps a dropped session in its rooms for a while so its client can resume it."""
+    print(f"[SESSION] {session.name} dropped; holding the session for {RESUME_GRACE_SECONDS}s.")
+    timer = threading.Timer(RESUME_GRACE_SECONDS, expire_session, args=(session, session.generation))
+    timer.daemon = True
+    timer.start()
+
+def expire_session(session, generation):
+    if session.expire(generation):
+        print(f"[SESSION] {session.name} did not come back; session expired.")
+        end_session(session)
+
+def end_session(session):
+    """Removes a session from every list and tells everyone it has left."""
+    session.closed = True
+    for data, _ in session.outbound.close():
+        close_message(data)
+    with session.lock:
+        kept, session.backlog, session.backlog_bytes = session.backlog, deque(), 0
+    for _, data in kept:
+        close_message(data)
+    if session.data_sock is not None:
+        close_connection(session.data_sock)
+    sessions.pop(session.token, None)
+    client_lookup.pop(session, None)
+    with rooms_lock:
+        client_rooms.pop(session, None)
+        for subscribers in rooms.values():
+            subscribers.discard(session)
+    if session in clients:
+        clients.remove(session)
+    if session.name in client_names:
+        client_names.remove(session.name)
+    
+    for client_data in connectedClients:
+        if client_data['name'] == session.name and client_data['conn'] is session:
+            connectedClients.remove(client_data)
+            break
+    
+    if session.claimed:
+        bus_release(session.name, session.ip)
+    
+    log_message("SERVER", "DISCONNECTION", session.name)
+    broadcast(f"[SERVER] {session.name} has left the chat.".encode(FORMAT))
+
+def open_session(conn, addr, name, resumable, capture_hello=b""):
+    """Checks the name and IP of a new login and registers its session; None if refused.
+    capture_hello is what the traffic capture records for the login."""
     client_ip = addr[0]
+    if name not in authorizedUsers:
+        print(f"[AUTH FAILED] {name} is not in authorized list.")
+        metrics.inc('chat_auth_rejects_total', reason='not_authorized')
+        conn.sendall("unauthorized connection".encode(FORMAT))
+        conn.close()
+        return None
+    
+    # A client that lost its token replaces the session it left behind
+    for held in list(sessions.values()):
+        if held.name == name and held.ip == client_ip and held.expire(held.generation):
+            end_session(held)
+
+    user_entry = next((item for item in connectedClients if item["name"] == name), None)
+    
+    if bus_socket is not None and not bus_claim(name, client_ip):
+        # Another worker already holds this name for a different IP
+        print(f"[AUTH FAILED] {name} attempted connection from different IP {client_ip}.")
+        metrics.inc('chat_auth_rejects_total', reason='ip_mismatch')
+        conn.sendall("unauthorized connection".encode(FORMAT))
+        conn.close()
+        return None
+    
+    if user_entry and user_entry['ip'] != client_ip:
+        print(f"[AUTH FAILED] {name} attempted connection from different IP {client_ip}.")
+        metrics.inc('chat_auth_rejects_total', reason='ip_mismatch')
+        if bus_socket is not None:
+            bus_release(name, client_ip)
+        conn.sendall("unauthorized connection".encode(FORMAT))
+        conn.close()
+        return None
+    
+    session = ClientSession(conn, name, client_ip, resumable)
+    session.claimed = bus_socket is not None
+    # Opened before the client can see its token, so its data connection has something to point at
+    session.capture_id = capture_open(capture_hello)
+    if resumable:
+        # Registered first: the client may open its data connection as soon as it reads the line
+        sessions[session.token] = session
+        # Sent before the session is visible to broadcast so it is always the first line
+        data_token = f" {session.data_token}" if session.data_token else ""
+        try:
+            conn.sendall(f"{SESSION_MESSAGE} {session.token} {HEARTBEAT_INTERVAL}{data_token}\n".encode(FORMAT))
+        except OSError:
+            sessions.pop(session.token, None)
+            session.outbound.close()  # Stops its writer thread
+            capture_record(session.capture_id, CAPTURE_CLOSE)
+            raise
+    if not user_entry:
+        connectedClients.append({'name': name, 'ip': client_ip, 'conn': session})
+
+    client_names.append(name)
+    client_lookup[session] = name
+    with rooms_lock:
+        rooms.setdefault(DEFAULT_ROOM, set()).add(session)
+        client_rooms[session] = DEFAULT_ROOM
+    clients.append(session)
+    
+    log_message("SERVER", "CONNECTION", f"{addr} connected as {name}")
+    broadcast(f"[SERVER] {name} joined the chat!".encode(FORMAT))
+    return session
+
+def room_allowed(name, room):
+    members = roomMembers.get(room)
+    return members is None or name in members
+
+def enforce_room_members(changed):
+    """Takes sessions out of the rooms in `changed` that their user may no longer join."""
+    removed = []
+    with rooms_lock:
+        for room in changed:
+            subscribers = rooms.get(room, set())
+            for session in [s for s in subscribers if not room_allowed(s.name, room)]:
+                subscribers.discard(session)
+                if client_rooms.get(session) == room:
+                    client_rooms[session] = next((r for r, members in rooms.items() if session in members), None)
+                removed.append((session, room))
+    for session, room in removed:
+        log_message("SERVER", "ROOM REMOVED", f"{session.name} is no longer a member of #{room}", room=room)
+        try:
+            session.sendall(f"[SERVER] You are no longer a member of #{room}.".encode(FORMAT))
+        except OSError:
+            pass
+
+def handle_room_command(conn, name, text):
+    """Handles !JOIN, !LEAVE, !ROOM and !ROOMS; returns False for anything else."""
+    parts = text.split()
+    command = parts[0].upper()
+    if command not in (JOIN_MESSAGE, LEAVE_MESSAGE, ROOM_MESSAGE, ROOMS_MESSAGE):
+        return False
+    
+    def reply(message):
+        conn.sendall(f"[SERVER] {message}".encode(FORMAT))
+    
+    if command == ROOMS_MESSAGE:
+        with rooms_lock:
+            mine = [room for room, subscribers in rooms.items() if conn in subscribers]
+            listing = ", ".join(f"#{room} ({len(subscribers)})" for room, subscribers in sorted(rooms.items()))
+            current = client_rooms.get(conn)
+        reply(f"Rooms: {listing}. You are in: {', '.join('#' + r for r in mine) or 'none'}; talking in #{current or '-'}.")
+        return True
+    
+    room = parts[1].lstrip("#") if len(parts) > 1 else ""
+    if not ROOM_NAME.fullmatch(room):
+        reply(f"Usage: {command} <room> (letters, digits, - and _ only).")
+        return True
+    
+    if command == JOIN_MESSAGE:
+        if not room_allowed(name, room):
+            print(f"[AUTH FAILED] {name} is not a member of #{room}.")
+            metrics.inc('chat_auth_rejects_total', reason='room_not_member')
+            reply(f"You are not a member of #{room}.")
+            return True
+        with rooms_lock:
+            rooms.setdefault(room, set()).add(conn)
+            client_rooms[conn] = room
+        log_message("SERVER", "ROOM JOIN", f"{name} joined #{room}", room=room)
+        broadcast(f"[SERVER] {name} joined #{room}.".encode(FORMAT), room=room)
+        reply(f"Your messages now go to #{room}.")
+    
+    elif command == LEAVE_MESSAGE:
+        with rooms_lock:
+            subscribers = rooms.get(room)
+            left = subscribers is not None and conn in subscribers
+            if left:
+                subscribers.discard(conn)
+                if client_rooms.get(conn) == room:
+                    client_rooms[conn] = next((r for r, members in rooms.items() if conn in members), None)
+            current = client_rooms.get(conn)
+        if not left:
+            reply(f"You are not in #{room}.")
+            return True
+        log_message("SERVER", "ROOM LEAVE", f"{name} left #{room}", room=room)
+        broadcast(f"[SERVER] {name} left #{room}.".encode(FORMAT), room=room)
+        reply(f"Left #{room}. " + (f"Talking in #{current}." if current else f"Use {JOIN_MESSAGE} <room> to talk."))
+    
+    else:
+        with rooms_lock:
+            joined = conn in rooms.get(room, ())
+            if joined:
+                client_rooms[conn] = room
+        if not joined:
+            reply(f"Join #{room} first with {JOIN_MESSAGE} {room}.")
+            return True
+        reply(f"Your messages now go to #{room}.")
+    return True
+
+def handle_client(conn, addr, deadline=None, admitted_by=None):
+    """Handles communication with a single client.
+    deadline (time.monotonic()) is when admission control gives up on authentication;
+    admitted_by is the AdmissionControl counting the connection until then. That may no
+    longer be the global `admission` once the server has been stopped and started again."""
     name = None
+    session = None
+    generation = 0
+    leaving = False
+    capture_id = None
+    pending = admitted_by is not None  # Still counted against the admission limits
+    deadline = deadline or time.monotonic() + AUTH_TIMEOUT
     
     try:
-        name_data = conn.recv(1024)
+        if tls_context:
+            conn = accept_tls(conn, addr, timeout=max(0.1, deadline - time.monotonic()))
+            if conn is None:
+                return
+        
+        try:
+            conn.settimeout(max(0.1, deadline - time.monotonic()))
+            name_data = conn.recv(1024)
+            conn.settimeout(None)
+        except socket.timeout:
+            print(f"[AUTH FAILED] {addr[0]} did not send a name within {AUTH_TIMEOUT}s.")
+            metrics.inc('chat_auth_rejects_total', reason='auth_timeout')
+            conn.close()
+            return
         if not name_data:
             conn.close()
             return
-            
-        name = name_data.decode(FORMAT)
         
-        if name not in authorizedUsers:
-            print(f"[AUTH FAILED] {name} is not in authorized list.")
-            conn.sendall("unauthorized connection".encode(FORMAT))
-            conn.close()
+        if name_data.startswith(PEER_MESSAGE.encode(FORMAT)):
+            if pending:
+                admitted_by.release(addr[0])
+                pending = False
+            accept_peer_link(conn, addr, name_data.decode(FORMAT))
             return
-
-        user_entry = next((item for item in connectedClients if item["name"] == name), None)
         
-        if user_entry:
-            if user_entry['ip'] != client_ip:
-                print(f"[AUTH FAILED] {name} attempted connection from different IP {client_ip}.")
-                conn.sendall("unauthorized connection".encode(FORMAT))
-                conn.close()
-                return
+        if name_data.startswith(DATA_MESSAGE.encode(FORMAT)):
+            if pending:
+                admitted_by.release(addr[0])
+                pending = False
+            serve_data_channel(conn, addr, name_data)
+            return
+            
+        # Resumable clients send "name\n!RESUME" (or "!RESUME token offset" to pick up where they left off)
+        name, _, hello = name_data.decode(FORMAT).partition("\n")
+        hello = hello.split()
+        
+        # The session token stays out of the capture; replay only needs to know it was a resume
+        capture_hello = name_data if len(hello) != 3 else f"{name}\n{RESUME_MESSAGE} - {hello[2]}".encode(FORMAT)
+        
+        session = find_session(name, hello)
+        if session:
+            # Opened before the client hears it resumed, as its data connection follows right after
+            capture_id = session.capture_id = capture_open(capture_hello)
+        resumed = session.attach(conn, int(hello[2]) if hello[2].isdigit() else 0) if session else None
+        if resumed:
+            # The token stands in for the name/IP checks; rooms and the name claim were kept while it was away
+            generation, complete = resumed
+            metrics.inc('chat_session_resumes_total', result='replayed' if complete else 'partial')
+            log_message("SERVER", f"RESUME {name} from {addr}")
+            if not complete:
+                session.sendall("[SERVER] Some messages sent while you were away could not be replayed.".encode(FORMAT))
         else:
-            connectedClients.append({'name': name, 'ip': client_ip, 'conn': conn})
-
-        client_names.append(name)
-        clients.append(conn)
+            if len(hello) == 3:
+                metrics.inc('chat_session_resumes_total', result='expired')
+            capture_record(capture_id, CAPTURE_CLOSE)
+            session = open_session(conn, addr, name, resumable=hello[:1] == [RESUME_MESSAGE],
+                                   capture_hello=capture_hello)
+            if session is None:
+                return
+            capture_id = session.capture_id
+        
+        # Reads stay on this connection; every write goes through the session so it can be replayed
+        sock, conn = conn, session
+        if pending:
+            admitted_by.release(addr[0])
+            pending = False
         
-        log_message("SERVER", "CONNECTION", f"{addr} connected as {name}")
-        broadcast(f"[SERVER] {name} joined the chat!".encode(FORMAT))
-
         connected = True
+        leftover = b""  # Read together with the end of an upload; handled as the next message
         while connected and is_server_running:
             try:
-                data = conn.recv(1024) 
-                if not data:
-                    break 
+                if leftover:
+                    data, leftover = leftover, b""
+                else:
+                    data = sock.recv(1024) 
+                    if not data:
+                        break 
+                    capture_read(capture_id, data)
+                conn.last_seen = time.time()
+                ping = PING_MESSAGE.encode(FORMAT)
+                if data == ping or data.startswith(ping + b"\n"):
+                    # A heartbeat is a line of its own, so chat text ending in "!PING" is left alone;
+                    # the next message can arrive glued after it
+                    conn.heartbeats = True
+                    conn.sendall(f"{PONG_MESSAGE}\n".encode(FORMAT), PRIORITY_CONTROL)
+                    data = data[len(ping) + 1:]
+                    if not data:
+                        continue
+                metrics.inc('chat_messages_in_total', user=name)
+                metrics.inc('chat_bytes_in_total', len(data), user=name)
                 
-                is_file = False
-                is_image = False
                 message_to_broadcast = data
                 message_type = "TEXT"
                 log_content = ""
+                room = client_rooms.get(conn)
                 
-                utc_timestamp = log_message(name, "RECEIVE", len(data), status="LOGGING")
+                utc_timestamp = log_message(name, "RECEIVE", len(data), status="LOGGING", room=room)
+                allowed = data.startswith(DISCONNECT_MESSAGE.encode(FORMAT)) or rate_limit(conn, name, len(data))
 
                 if data.startswith(b"IMAGE|") or data.startswith(b"FILE|"):
-                    if data.startswith(b"IMAGE|"):
-                        message_type = "IMAGE"
-                        is_image = True
-                        header_marker = b"IMAGE|"
-                    else: 
-                        message_type = "FILE"
-                        is_file = True
-                        header_marker = b"FILE|"
-                    
-                    header_start = data.find(header_marker)
-                    first_split = data.find(b"|", header_start + len(header_marker))
-                    second_split = data.find(b"|", first_split + 1)
-                    
-                    if second_split != -1:
-                        header_end_index = second_split + 1
-                        if is_file:
-                            filename = data[header_start + len(header_marker):first_split].decode(FORMAT)
-                            size_bytes = data[first_split + 1:second_split]
-                            content_size = int(size_bytes.decode(FORMAT))
-                            log_content = f"{filename}, {content_size} bytes"
-                        else: 
-                            content_size = int(data[header_start + len(header_marker):first_split].decode(FORMAT))
-                            log_content = f"{content_size} bytes"
-                            header_end_index = first_split + 1
-                        
-                        content_data = data[header_end_index:]
-                        remaining_size = content_size - len(content_data)
-                        while remaining_size > 0:
-                            chunk = conn.recv(min(remaining_size, 4096))
-                            if not chunk:
-                                raise Exception("Client closed during transfer.")
-                            content_data += chunk
-                            remaining_size -= len(chunk)
-                        
-                        message_to_broadcast = data[:header_end_index] + content_data
-
-                        # FIX: Pass content_data to log_message and capture timestamp
-                        if is_image:
-                            utc_timestamp = log_message(name, "IMAGE", content_size=content_size, content=content_data)
-                        elif is_file:
-                            utc_timestamp = log_message(name, "FILE", content_size=content_size, content=content_data, filename=filename)
-                    else:
-                        log_message(name, message_type, "N/A", status="ERROR: Malformed Header")
-                        continue
+                    leftover = receive_upload(sock, conn, name, data, allowed, capture_id)
+                    continue
                 
                 elif data.decode(FORMAT).startswith(DISCONNECT_MESSAGE):
                     connected = False
+                    leaving = True
+                    continue
+                
+                elif not allowed:
+                    continue
+                
+                elif data.decode(FORMAT).startswith(FETCH_MESSAGE):
+                    args = data.decode(FORMAT)[len(FETCH_MESSAGE):].split()
+                    file_id, byte_range = (args + ["", None])[:2]
+                    if not file_allowed(name, file_id):
+                        # Same answer as for an unknown id, so ids from other rooms cannot be probed
+                        conn.sendall("[SERVER] That file is not available.".encode(FORMAT))
+                        continue
+                    if file_id not in local_files and file_id in remote_files:
+                        conn.sendall(f"[SERVER] Fetching {file_id} from {remote_files[file_id]['origin']}...".encode(FORMAT))
+                    # Once fetched over the federation the file is stored here too
+                    request_file(file_id, lambda *_, c=conn, f=file_id, r=byte_range: serve_download(c, f, r), stored_only=True)
+                    continue
+                
+                elif data.decode(FORMAT).strip() == FILES_MESSAGE:
+                    list_stored_files(conn)
+                    continue
+                
+                elif data.startswith(b"!") and handle_room_command(conn, name, data.decode(FORMAT)):
                     continue
                 
                 if message_type == "TEXT":
+                    if room is None:
+                        conn.sendall(f"[SERVER] Join a room with {JOIN_MESSAGE} <room> before sending.".encode(FORMAT))
+                        continue
                     original_text = data.decode(FORMAT)
                     log_content = original_text
-                    timestamped_message = f"[{utc_timestamp.decode(FORMAT)} {name}]: {original_text}"
+                    room_label = "" if room == DEFAULT_ROOM else f" #{room}"
+                    timestamped_message = f"[{utc_timestamp.decode(FORMAT)} {name}{room_label}]: {original_text}"
                     message_to_broadcast = timestamped_message.encode(FORMAT)
                 
-                broadcast(message_to_broadcast)
+                broadcast(message_to_broadcast, room=room)
+                relay_message_to_peers(name, message_to_broadcast, room)
                     
             except Exception as e:
                 log_message(name, "ERROR", str(e), status="CRITICAL ERROR")
@@ -339,25 +2609,913 @@ def handle_client(conn, addr):
         print(f"Error handling client {addr}: {e}")
     
     finally:
-        if conn in clients:
-            clients.remove(conn)
-        if name in client_names:
-            client_names.remove(name)
-        
-        for client_data in connectedClients:
-            if client_data['name'] == name and client_data['conn'] == conn:
-                connectedClients.remove(client_data)
-                break
-
+        metrics.connection_closed()
+        capture_record(capture_id, CAPTURE_CLOSE)
+        if pending:
+            admitted_by.release(addr[0])
+        if isinstance(conn, ClientSession):
+            conn = sock  # Close only this connection; the session may live on
         try:
             conn.close()
         except:
             pass
-            
-        if name:
-            log_message("SERVER", "DISCONNECTION", name)
-            broadcast(f"[SERVER] {name} has left the chat.".encode(FORMAT))
+        
+        if session is not None and session.detach(generation):
+            # A dropped resumable client keeps its place; leaving, kicks and shutdown end the session
+            if session.resumable and not leaving and not session.closed and is_server_running:
+                hold_session(session)
+            else:
+                end_session(session)
+
+
+# --- Uploads and Data Connections ---
+# A file or image arrives as "IMAGE|size|" or "FILE|name|size|" followed by the
+# body, on the chat connection or on the session's data connection. Resumable
+# clients are offered a data token in the SESSION line; a second connection
+# that starts with "!DATA token" then carries bodies both ways, so a large
+# transfer never holds up chat text. Whenever there is no data connection
+# (older clients, workers, or it dropped) bodies use the chat connection.
+
+def upload_header_end(data):
+    """Index just past an IMAGE|size| or FILE|name|size| header, or -1 while it is incomplete."""
+    end = -1
+    for _ in range(2 if data.startswith(b"IMAGE|") else 3):
+        end = data.find(b"|", end + 1)
+        if end == -1:
+            return -1
+    return end + 1
+
+def receive_upload(sock, conn, name, data, allowed, capture_id=None):
+    """Reads the rest of an upload whose header starts `data`, saves it and sends it to
+    the sender's room. Returns any bytes read past the end of the body.
+    capture_id is sock's connection in the traffic capture."""
+    room = client_rooms.get(conn)
+    is_image = data.startswith(b"IMAGE|")
+    is_file = not is_image
+    message_type = "IMAGE" if is_image else "FILE"
+    header_marker = b"IMAGE|" if is_image else b"FILE|"
+    
+    header_start = data.find(header_marker)
+    first_split = data.find(b"|", header_start + len(header_marker))
+    second_split = data.find(b"|", first_split + 1)
+    
+    if first_split == -1 or (is_file and second_split == -1):  # IMAGE|size| has no second field
+        log_message(name, message_type, "N/A", status="ERROR: Malformed Header")
+        return b""
+    
+    header_end_index = second_split + 1
+    if is_file:
+        filename = data[header_start + len(header_marker):first_split].decode(FORMAT)
+        size_bytes = data[first_split + 1:second_split]
+        content_size = int(size_bytes.decode(FORMAT))
+    else: 
+        content_size = int(data[header_start + len(header_marker):first_split].decode(FORMAT))
+        header_end_index = first_split + 1
+    
+    # bytearray: appending to bytes copies the whole body every chunk
+    content_data = bytearray(data[header_end_index:header_end_index + content_size])
+    leftover = bytes(data[header_end_index + content_size:])
+    remaining_size = content_size - len(content_data)
+    # Hashed a chunk at a time as it arrives, while it is still in cache, rather than reread once saved
+    hasher = hashlib.new(UPLOAD_DIGEST)
+    hasher.update(content_data)
+    while remaining_size > 0:
+        chunk = sock.recv(min(remaining_size, 65536))
+        if not chunk:
+            raise Exception("Client closed during transfer.")
+        conn.last_seen = time.time()
+        capture_record(capture_id, CAPTURE_BODY, length=len(chunk))
+        pace_upload(name, len(chunk))
+        hasher.update(chunk)
+        content_data += chunk
+        remaining_size -= len(chunk)
+    digest = f"{UPLOAD_DIGEST} {hasher.hexdigest()}"
+    metrics.inc('chat_bytes_in_total', len(content_data) - (len(data) - header_end_index), user=name)
+    
+    message_to_broadcast = data[:header_end_index] + content_data
+    if not allowed:
+        return leftover
+
+    # FIX: Pass content_data to log_message and capture timestamp
+    saved = {}
+    if room is None:
+        conn.sendall(f"[SERVER] Join a room with {JOIN_MESSAGE} <room> before sending.".encode(FORMAT))
+        return leftover
+    if is_image:
+        log_message(name, "IMAGE", content_size=content_size, content=content_data, record=saved, room=room, digest=digest)
+    elif is_file:
+        log_message(name, "FILE", content_size=content_size, content=content_data, filename=filename, record=saved,
+                    room=room, digest=digest)
+    if 'path' in saved:
+        offer_file_to_peers(name, message_type, filename if is_file else "image.png", content_size, saved['path'], room)
+    
+    broadcast(message_to_broadcast, room=room, bulk=True, digest=f"{DIGEST_MESSAGE} {digest}\n".encode(FORMAT))
+    return leftover
+
+def serve_data_channel(sock, addr, hello):
+    """Runs a session's data connection: uploads are read here, and a writer thread
+    sends the bodies queued by send_bulk(), framed so that several can interleave."""
+    line, _, data = hello.partition(b"\n")
+    parts = line.decode(FORMAT, 'replace').split()
+    session = next((s for s in list(sessions.values())
+                    if len(parts) == 2 and s.data_token and secrets.compare_digest(s.data_token, parts[1])), None)
+    outbox = session.attach_data(sock) if session else None
+    if outbox is None:
+        print(f"[AUTH FAILED] {addr[0]} opened a data connection with an unknown token.")
+        metrics.inc('chat_data_connections_total', result='bad_token')
+        close_connection(sock)
+        return
+    
+    name = session.name
+    metrics.inc('chat_data_connections_total', result='attached')
+    log_message("SERVER", f"DATA CONNECTION {name} from {addr}")
+    capture_id = None
+    if session.capture_id is not None:
+        capture_id = capture_open(struct.pack('!I', session.capture_id), CAPTURE_DATA_OPEN)
+    recorded = 0  # Bytes of data already in the capture
+    try:
+        sock.sendall(f"{DATA_MESSAGE} ready\n".encode(FORMAT))
+        writer = threading.Thread(target=write_data_channel, args=(session, sock, outbox), name=f"data-out-{name}")
+        writer.daemon = True
+        writer.start()
+        
+        while is_server_running and not session.closed:
+            while upload_header_end(data) == -1:
+                if len(data) > 4096:
+                    raise ValueError("no upload header")
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+            if not (data.startswith(b"IMAGE|") or data.startswith(b"FILE|")):
+                raise ValueError("only files and images may be sent on the data connection")
+            session.last_seen = time.time()
+            metrics.inc('chat_messages_in_total', user=name)
+            metrics.inc('chat_bytes_in_total', len(data), user=name)
+            capture_read(capture_id, data, recorded)
+            data = receive_upload(sock, session, name, data, rate_limit(session, name, len(data)), capture_id)
+            recorded = len(data)  # What is left was recorded with the read it came in
+    except Exception as e:
+        print(f"[DATA] {name}: data connection from {addr[0]} closed ({e}).")
+    finally:
+        capture_record(capture_id, CAPTURE_CLOSE)
+        if session.detach_data(sock) is outbox:
+            resend_bulk(session, outbox.close())
+        close_connection(sock)
+
+def write_data_channel(session, sock, outbox):
+    """Writer thread of a data connection. Each piece goes out as a DATA_FRAME header
+    and the piece; the client joins the pieces of a stream id back into the body.
+    Frames are framed, so small ones queued together (or within COALESCE_DELAY)
+    are written with one send instead of two writes each."""
+    item = None
+    while True:
+        item = item or outbox.next_write()
+        if item is None:
+            return
+        batch = [item]
+        batched = item[4]
+        item = None
+        while batched < COALESCE_BYTES and len(batch) < 64:
+            item = outbox.next_write(COALESCE_DELAY)
+            if not item:
+                break
+            if batched + item[4] > COALESCE_BYTES:
+                break  # Goes first in the next batch
+            batch.append(item)
+            batched += item[4]
+            item = None
+        try:
+            write_frames(sock, batch)
+        except OSError:
+            # Those bodies and any still queued go out again on a newer data connection or the chat connection
+            close_connection(sock)
+            session.detach_data(sock)
+            unsent = [(data, priority) for priority, _, data, _, _, queued in batch + [item] * bool(item)
+                      if queued is not None]  # Finished messages have left the queue
+            resend_bulk(session, unsent + outbox.close())
+            return
+        for priority, _, data, _, _, queued in batch:
+            if queued is not None:
+                metrics.observe('chat_outbound_seconds', time.monotonic() - queued, priority=priority)
+                close_message(data)  # Nothing is resent from the data connection
+
+def write_frames(sock, batch):
+    """Writes frames from OutboundScheduler.next_write(): in-memory ones gathered into one send,
+    file-backed ones (sendfile) in between under a cork so their headers do not go out alone."""
+    pieces = [(stream, data, offset, size, memory_parts(data, offset, size)) for _, stream, data, offset, size, _ in batch]
+    file_backed = any(in_memory is None for *_, in_memory in pieces)
+    if file_backed:
+        set_cork(sock, True)
+    try:
+        parts = []
+        for stream, data, offset, size, in_memory in pieces:
+            parts.append(DATA_FRAME.pack(stream, size))
+            if in_memory is not None:
+                parts.extend(in_memory)
+                continue
+            send_parts(sock, parts)
+            parts = []
+            write_piece(sock, data, offset, size)
+            metrics.inc('chat_socket_writes_total', connection='data')
+        if parts:
+            send_parts(sock, parts)
+            metrics.inc('chat_socket_writes_total', connection='data')
+    finally:
+        if file_backed:
+            set_cork(sock, False)
+
+def resend_bulk(session, unsent):
+    """Sends bodies a closed data connection did not finish (from OutboundScheduler.close())."""
+    for n, (data, _) in enumerate(unsent):
+        metrics.inc('chat_bulk_fallbacks_total')
+        try:
+            session.send_bulk(data)
+        except OSError:
+            for data, _ in unsent[n:]:
+                close_message(data)  # Not queued anywhere
+            break
+
+
+# --- Traffic Capture ---
+# Opt-in (--capture FILE): every read from an authenticated client is appended
+# to FILE with its time and connection, so chatBenchmark.py replay can drive a
+# new build with the same load. The file starts with CAPTURE_MAGIC and the
+# wall-clock start time (CAPTURE_START); each record is a CAPTURE_RECORD
+# (microseconds since the start, connection id, kind, length) followed by
+# `length` bytes for the kinds that carry a payload. Upload bodies are
+# recorded by length only, including the part that arrives in the same read
+# as the header: the capture stays compact and the evidence is not copied
+# into it. Session tokens are left out of resume hellos. Chat text is
+# recorded as sent.
+
+CAPTURE_MAGIC = b"IRCAP\x01"
+CAPTURE_START = struct.Struct('!d')
+CAPTURE_RECORD = struct.Struct('!QIBI')
+CAPTURE_OPEN = 1       # Chat connection authenticated; payload is the hello
+CAPTURE_DATA = 2       # Bytes as read from the connection
+CAPTURE_BODY = 3       # Upload body bytes read; length only
+CAPTURE_DATA_OPEN = 4  # Data connection attached; payload is its chat connection's id (!I)
+CAPTURE_CLOSE = 5
+CAPTURE_PAYLOAD = (CAPTURE_OPEN, CAPTURE_DATA, CAPTURE_DATA_OPEN)
+CAPTURE_FLUSH_SECONDS = 1
+
+capture = None  # CaptureWriter while --capture is on
+
+class CaptureWriter(object):
+    """Appends capture records to one file for every connection thread."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.started = time.monotonic()
+        self.flushed = self.started
+        self.file = open(path, 'xb')  # Never overwrite an earlier capture
+        self.file.write(CAPTURE_MAGIC + CAPTURE_START.pack(time.time()))
+        self.file.flush()
+
+    def open(self, kind=CAPTURE_OPEN, payload=b""):
+        """Records a new connection and returns its id."""
+        connection = next(self.ids)
+        self.record(connection, kind, payload)
+        return connection
+
+    def record(self, connection, kind, payload=b"", length=None):
+        now = time.monotonic()
+        header = CAPTURE_RECORD.pack(int((now - self.started) * 1000000), connection, kind,
+                                     len(payload) if length is None else length)
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(header)
+            self.file.write(payload)
+            if now - self.flushed >= CAPTURE_FLUSH_SECONDS:
+                self.file.flush()
+                self.flushed = now
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def capture_path():
+    """CAPTURE_FILE, or one file per worker process next to it."""
+    if not worker_id:
+        return CAPTURE_FILE
+    root, ext = os.path.splitext(CAPTURE_FILE)
+    return f"{root}.worker{worker_id}{ext}"
+
+def start_capture():
+    global capture
+    if CAPTURE_FILE and capture is None:
+        try:
+            capture = CaptureWriter(capture_path())
+        except OSError as e:
+            print(f"[ERROR] Cannot capture traffic: {e}")
+            return
+        print(f"[CAPTURE] Recording client traffic to {capture.path}")
+
+def capture_open(payload, kind=CAPTURE_OPEN):
+    """Records a new connection when capturing and returns its id (None when not)."""
+    return capture.open(kind, payload) if capture is not None else None
+
+def capture_record(connection, kind, payload=b"", length=None):
+    """Adds a record when capturing; connection is None for connections opened before it started."""
+    if capture is not None and connection is not None:
+        capture.record(connection, kind, payload, length)
+
+def capture_read(connection, data, recorded=0):
+    """Records the bytes of data from index `recorded` on, split at upload bodies,
+    which are recorded by length only (as receive_upload() does for the rest of them)."""
+    if capture is None or connection is None:
+        return
+    start = 0
+    while start < len(data):
+        end = upload_header_end(data[start:]) if data.startswith((b"IMAGE|", b"FILE|"), start) else -1
+        try:
+            header = data[start:start + end]
+            size = int(header[header.rfind(b"|", 0, len(header) - 1) + 1:-1]) if end != -1 else None
+        except ValueError:
+            size = None
+        if size is None:
+            # Text, or an upload header that is not complete: as it is, to the end
+            pieces, start = [(CAPTURE_DATA, start, len(data))], len(data)
+        else:
+            body_end = min(len(data), start + end + size)
+            pieces, start = [(CAPTURE_DATA, start, start + end), (CAPTURE_BODY, start + end, body_end)], body_end
+        for kind, first, last in pieces:
+            first = max(first, recorded)
+            if first < last:
+                if kind == CAPTURE_BODY:
+                    capture.record(connection, kind, length=last - first)
+                else:
+                    capture.record(connection, kind, data[first:last])
+
+def read_capture(path):
+    """Yields (wall-clock time, connection, kind, payload or length) from a capture file."""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+        started, = CAPTURE_START.unpack(f.read(CAPTURE_START.size))
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return  # A capture cut short by a crash ends at its last whole record
+            at, connection, kind, length = CAPTURE_RECORD.unpack(header)
+            payload = length
+            if kind in CAPTURE_PAYLOAD:
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+            yield started + at / 1000000, connection, kind, payload
+
+
+# --- Federation ---
+# Servers in different regions keep TCP links to each other (PEERS). Every
+# chat message gets an ID from its origin server and is flooded to the other
+# links once; IDs already seen are dropped, so any topology works. Files and
+# images are only announced to peers; the body crosses the link when a remote
+# user asks for it with !FETCH <id>, and is cached on each server it passes.
+
+PEER_HEADER = struct.Struct('!II')  # JSON header length, body length
+PEER_RETRY_SECONDS = 5
+SEEN_ID_LIMIT = 50000
+
+peer_links = []               # Live PeerLink objects, inbound and outbound
+seen_message_ids = OrderedDict()
+local_files = {}              # message id -> (kind, filename, path, room) for files saved here
+remote_files = {}             # message id -> offer header plus the link it arrived on
+pending_fetches = {}          # message id -> callbacks waiting for the body
+federation_lock = threading.Lock()
+message_counter = itertools.count(1)
+
+class PeerLink(object):
+    """A framed connection to another chat server."""
+    def __init__(self, sock, peer_id, address):
+        self.sock = sock
+        self.peer_id = peer_id
+        self.address = address
+        self.lock = threading.Lock()
+
+    def send(self, header, body=b""):
+        data = json.dumps(header).encode(FORMAT)
+        try:
+            with self.lock:
+                send_parts(self.sock, [PEER_HEADER.pack(len(data), len(body)), data, body])
+        except OSError as e:
+            print(f"[FEDERATION] Send to {self.peer_id} failed: {e}")
+            self.close()
+
+    def read(self):
+        header = _recv_exact(self.sock, PEER_HEADER.size)
+        if header is None:
+            return None, None
+        header_len, body_len = PEER_HEADER.unpack(header)
+        data = _recv_exact(self.sock, header_len)
+        body = _recv_exact(self.sock, body_len) if body_len else b""
+        if data is None or body is None:
+            return None, None
+        return json.loads(data.decode(FORMAT)), body
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+def server_id():
+    return SERVER_ID or f"{socket.gethostname()}-{PORT}"
+
+def next_message_id():
+    return f"{server_id()}-{next(message_counter)}"
+
+def mark_seen(message_id):
+    """Records a message ID; returns False if it was already seen."""
+    with federation_lock:
+        if message_id in seen_message_ids:
+            return False
+        seen_message_ids[message_id] = True
+        if len(seen_message_ids) > SEEN_ID_LIMIT:
+            seen_message_ids.popitem(last=False)
+        return True
+
+def forward_to_peers(header, body=b"", exclude=None):
+    for link in peer_links[:]:
+        if link is not exclude:
+            link.send(header, body)
+
+def relay_message_to_peers(sender, message, room=DEFAULT_ROOM):
+    """Sends a locally originated chat message to every peer."""
+    if not peer_links:
+        return
+    message_id = next_message_id()
+    mark_seen(message_id)
+    forward_to_peers({'type': 'msg', 'id': message_id, 'origin': server_id(), 'sender': sender, 'room': room}, message)
+
+def offer_file_to_peers(sender, kind, filename, size, path, room=DEFAULT_ROOM):
+    """Announces a locally saved file or image; the body stays here until fetched."""
+    message_id = next_message_id()
+    local_files[message_id] = (kind, filename, path, room)
+    if not peer_links:
+        return
+    mark_seen(message_id)
+    forward_to_peers({'type': 'offer', 'id': message_id, 'origin': server_id(), 'sender': sender,
+                      'kind': kind, 'filename': filename, 'size': size, 'room': room})
 
+def file_room(file_id):
+    """Room a stored or offered file was shared in, or None if it is unknown."""
+    if file_id in local_files:
+        return local_files[file_id][3]
+    offer = remote_files.get(file_id)
+    return offer.get('room', DEFAULT_ROOM) if offer else None
+
+def file_allowed(name, file_id):
+    """Files may only be fetched by users allowed in the room they were shared in."""
+    room = file_room(file_id)
+    return room is not None and room_allowed(name, room)
+
+def request_file(file_id, deliver, stored_only=False):
+    """Calls deliver(kind, filename, body) with a file's body, fetching it over the federation if needed.
+    With stored_only, a file stored here is left on disk and deliver gets no arguments."""
+    stored = local_files.get(file_id)
+    if stored and stored_only:
+        deliver()
+        return
+    if stored:
+        kind, filename, path, _ = stored
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            body = None
+        deliver(kind, filename, body)
+        return
+    
+    offer = remote_files.get(file_id)
+    if offer is None or offer['link'] not in peer_links:
+        deliver(None, None, None)
+        return
+    
+    with federation_lock:
+        waiters = pending_fetches.setdefault(file_id, [])
+        waiters.append(deliver)
+        first_request = len(waiters) == 1
+    if first_request:
+        offer['link'].send({'type': 'fetch', 'id': file_id})
+
+def serve_download(conn, file_id, byte_range=None):
+    """Sends a stored file, or the bytes first-last of it, straight from disk (see StoredFile).
+    A range arrives as FILE|name.bytes-first-last|length| so it is not taken for the whole file."""
+    try:
+        if file_id not in local_files or not file_allowed(conn.name, file_id):
+            conn.sendall("[SERVER] That file is not available.".encode(FORMAT))
+            return
+        kind, filename, path, _ = local_files[file_id]
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            conn.sendall("[SERVER] That file is not available.".encode(FORMAT))
+            return
+        first, last = 0, size - 1
+        if byte_range:
+            match = re.fullmatch(r"(\d+)-(\d*)", byte_range)
+            if match:
+                first, last = int(match.group(1)), min(int(match.group(2) or last), last)
+        if byte_range and (not match or first > last):
+            conn.sendall(f"{ERROR_MESSAGE} bad_range: ask for first-last or first- within the "
+                         f"{size} bytes of {filename}.".encode(FORMAT), PRIORITY_CONTROL)
+            return
+        length = last - first + 1
+        if byte_range:
+            header = f"FILE|{filename}.bytes-{first}-{last}|{length}|"
+        elif kind == "IMAGE":
+            header = f"IMAGE|{size}|"
+        else:
+            header = f"FILE|{filename}|{size}|"
+        try:
+            body = StoredFile(header.encode(FORMAT), path, first, length)
+        except OSError:
+            conn.sendall("[SERVER] That file is not available.".encode(FORMAT))
+            return
+        metrics.inc('chat_downloads_total', kind='range' if byte_range else 'whole')
+        try:
+            conn.send_bulk(body)
+        except OSError:
+            body.close()  # Never queued
+            raise
+    except OSError:
+        pass
+
+def list_stored_files(conn, limit=20):
+    """Answers !FILES with the most recent stored files the caller may fetch and the IDs to fetch them by."""
+    recent = [item for item in list(local_files.items()) if room_allowed(conn.name, item[1][3])][-limit:]
+    lines = []
+    for file_id, (kind, filename, path, _) in recent:
+        try:
+            lines.append(f"  {file_id}  {filename}  ({os.path.getsize(path)} bytes)")
+        except OSError:
+            continue
+    if lines:
+        listing = "\n".join(lines)
+        message = f"[SERVER] Stored files:\n{listing}\nGet one with {FETCH_MESSAGE} <id>, or part of one with {FETCH_MESSAGE} <id> first-last."
+    else:
+        message = "[SERVER] No files are stored yet."
+    try:
+        conn.sendall(message.encode(FORMAT))
+    except OSError:
+        pass
+
+def handle_peer_frame(link, header, body):
+    kind = header.get('type')
+    
+    if kind in ('msg', 'offer') and not ROOM_NAME.fullmatch(str(header.get('room', DEFAULT_ROOM))):
+        print(f"[FEDERATION] Dropped a {kind} from {link.peer_id} for invalid room {header.get('room')!r}")
+        return
+    
+    if kind == 'msg':
+        if mark_seen(header['id']):
+            room = header.get('room', DEFAULT_ROOM)
+            log_message(f"{header['sender']}@{header['origin']}", "PEER RECEIVE", status="PEER", room=room)
+            broadcast(body, room=room)
+            forward_to_peers(header, body, exclude=link)
+    
+    elif kind == 'offer':
+        if mark_seen(header['id']):
+            remote_files[header['id']] = dict(header, link=link)
+            room = header.get('room', DEFAULT_ROOM)
+            log_message(f"{header['sender']}@{header['origin']}", f"PEER OFFER {header['filename']} ({header['size']} bytes)", status="PEER", room=room)
+            utc_time = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+            label = "an image" if header['kind'] == "IMAGE" else header['filename']
+            notice = (f"[{utc_time} {header['sender']}@{header['origin']}]: shared {label} ({header['size']} bytes)"
+                      f" - type {FETCH_MESSAGE} {header['id']} to download")
+            broadcast(notice.encode(FORMAT), room=room)
+            forward_to_peers(header, exclude=link)
+    
+    elif kind == 'fetch':
+        file_id = header['id']
+        def reply(file_kind, filename, file_body):
+            if file_body is None:
+                link.send({'type': 'missing', 'id': file_id})
+            else:
+                link.send({'type': 'body', 'id': file_id, 'kind': file_kind, 'filename': filename}, file_body)
+        request_file(file_id, reply)
+    
+    elif kind in ('body', 'missing'):
+        file_id = header['id']
+        if kind == 'body':
+            remote_dir = os.path.join(FILES_DIR, "remote")
+            if not os.path.exists(remote_dir):
+                os.makedirs(remote_dir)
+            safe_name = "".join(c if c.isalnum() or c in "._-" else "_" for c in f"{file_id}_{header['filename']}")
+            path = os.path.join(remote_dir, safe_name)
+            with open(path, 'wb') as f:
+                f.write(body)
+            room = remote_files.get(file_id, {}).get('room', DEFAULT_ROOM)
+            local_files[file_id] = (header['kind'], header['filename'], path, room)
+            log_message("SERVER", f"PEER FETCHED {header['filename']} from {link.peer_id} - Saved as {path}", status="PEER")
+        with federation_lock:
+            waiters = pending_fetches.pop(file_id, [])
+        for deliver in waiters:
+            deliver(header.get('kind'), header.get('filename'), body if kind == 'body' else None)
+
+def serve_peer_link(link):
+    """Reads frames from a peer until the link closes."""
+    peer_links.append(link)
+    print(f"[FEDERATION] Linked with {link.peer_id} ({link.address})")
+    try:
+        while is_server_running:
+            header, body = link.read()
+            if header is None:
+                break
+            handle_peer_frame(link, header, body)
+    except (OSError, ValueError) as e:
+        print(f"[FEDERATION] Link to {link.peer_id} failed: {e}")
+    finally:
+        if link in peer_links:
+            peer_links.remove(link)
+        link.close()
+        # Anyone still waiting on a body from this link gets a failure
+        for file_id, offer in list(remote_files.items()):
+            if offer['link'] is link:
+                with federation_lock:
+                    waiters = pending_fetches.pop(file_id, [])
+                for deliver in waiters:
+                    deliver(None, None, None)
+        print(f"[FEDERATION] Link with {link.peer_id} closed")
+
+def accept_peer_link(conn, addr, hello):
+    """Handles an inbound "!PEER <id> <secret>" connection from another server."""
+    parts = hello.split()
+    if len(parts) != 3 or not PEER_SECRET or not hmac.compare_digest(parts[2].encode(FORMAT), PEER_SECRET.encode(FORMAT)):
+        print(f"[AUTH FAILED] Peer link from {addr[0]} rejected.")
+        metrics.inc('chat_auth_rejects_total', reason='peer_rejected')
+        conn.close()
+        return
+    link = PeerLink(conn, parts[1], f"{addr[0]}:{addr[1]}")
+    link.send({'type': 'hello', 'id': server_id()})
+    serve_peer_link(link)
+
+def dial_peer(address):
+    """Keeps an outbound link to one peer alive while the server runs."""
+    host, port = address.rsplit(":", 1)
+    while is_server_running:
+        try:
+            sock = socket.create_connection((host, int(port)), timeout=10)
+            configure_keepalive(sock)
+            tune_socket(sock)
+            if tls_context:
+                sock = TLSConnection(peer_tls_context().wrap_socket(sock))
+                sock.settimeout(10)
+            sock.sendall(f"{PEER_MESSAGE} {server_id()} {PEER_SECRET}".encode(FORMAT))
+            link = PeerLink(sock, address, address)
+            header, _ = link.read()
+            if header and header.get('type') == 'hello':
+                sock.settimeout(None)
+                link.peer_id = header['id']
+                serve_peer_link(link)
+            else:
+                link.close()
+        except (OSError, ValueError):
+            pass
+        time.sleep(PEER_RETRY_SECONDS)
+
+def start_peer_dialers():
+    for address in PEERS:
+        threading.Thread(target=dial_peer, args=(address,), name=f"peer-{address}", daemon=True).start()
+
+# --- Multi-Process Workers ---
+# With --workers N the parent process forks N workers that each accept on the
+# same port (SO_REUSEPORT lets the kernel spread connections across them).
+# The parent runs the bus hub: a Unix-domain socket that relays broadcasts
+# between workers, owns the name/IP registry and is the single writer of
+# LOG_FILE, so journal lines keep the order in which the hub received them.
+
+BUS_HEADER = struct.Struct('!BI')  # frame type, payload length
+BUS_BROADCAST = 1
+BUS_LOG = 2
+BUS_CLAIM = 3
+BUS_RELEASE = 4
+BUS_REPLY = 5
+
+bus_lock = threading.Lock()    # Serializes frames written by this worker
+bus_pending = {}               # claim id -> [threading.Event, result]
+bus_next_id = 0
+
+def _recv_exact(sock, size):
+    """Reads exactly size bytes, or returns None if the peer closed."""
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+def bus_read_frame(sock):
+    header = _recv_exact(sock, BUS_HEADER.size)
+    if header is None:
+        return None, None
+    kind, length = BUS_HEADER.unpack(header)
+    payload = _recv_exact(sock, length) if length else b""
+    if payload is None:
+        return None, None
+    return kind, payload
+
+def bus_publish(kind, payload):
+    """Sends one frame from this worker to the hub."""
+    try:
+        with bus_lock:
+            bus_socket.sendall(BUS_HEADER.pack(kind, len(payload)) + payload)
+    except OSError as e:
+        print(f"[ERROR] Bus send failed: {e}")
+
+def bus_claim(name, ip):
+    """Asks the hub whether name may connect from ip across all workers."""
+    global bus_next_id
+    with bus_lock:
+        bus_next_id += 1
+        claim_id = bus_next_id
+    waiter = [threading.Event(), False]
+    bus_pending[claim_id] = waiter
+    bus_publish(BUS_CLAIM, json.dumps({'id': claim_id, 'name': name, 'ip': ip}).encode(FORMAT))
+    waiter[0].wait(5)
+    bus_pending.pop(claim_id, None)
+    return waiter[1]
+
+def bus_release(name, ip):
+    bus_publish(BUS_RELEASE, json.dumps({'name': name, 'ip': ip}).encode(FORMAT))
+
+def receive_bus_messages():
+    """Worker side: delivers relayed broadcasts and claim replies from the hub."""
+    while True:
+        try:
+            kind, payload = bus_read_frame(bus_socket)
+        except OSError:
+            kind = None
+        if kind is None:
+            # The hub is gone, so the parent process has exited
+            print(f"[WORKER {worker_id}] Bus closed, exiting.")
+            os._exit(0)
+        if kind == BUS_BROADCAST:
+            room, _, message = payload.partition(b"\n")
+            broadcast(message, relay=False, room=room.decode(FORMAT) or None)
+        elif kind == BUS_REPLY:
+            reply = json.loads(payload.decode(FORMAT))
+            waiter = bus_pending.get(reply['id'])
+            if waiter:
+                waiter[1] = reply['ok']
+                waiter[0].set()
+
+def run_worker(number, bus_path):
+    """Entry point of a forked worker process; never returns."""
+    global worker_id, bus_socket, REUSE_PORT, METRICS_PORT, is_server_running
+    worker_id = number
+    REUSE_PORT = True
+    METRICS_PORT += number  # Each worker serves its own metrics endpoint
+    bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    bus_socket.connect(bus_path)
+    threading.Thread(target=receive_bus_messages, name="bus-reader", daemon=True).start()
+    install_diagnostic_signals()
+    is_server_running = True
+    start_metrics_endpoint()
+    run_server()
+    os._exit(0)
+
+class BusHub(object):
+    """Parent-process side of the bus: relays frames between workers."""
+    def __init__(self, bus_path):
+        self.bus_path = bus_path
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(bus_path)
+        self.listener.listen()
+        self.workers = []       # [socket, lock] per connected worker
+        self.registry = {}      # name -> [ip, connection count] across all workers
+        self.lock = threading.Lock()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                break
+            entry = [conn, threading.Lock()]
+            with self.lock:
+                self.workers.append(entry)
+            threading.Thread(target=self._serve_worker, args=(entry,), name="bus-hub", daemon=True).start()
+
+    def _send(self, entry, kind, payload):
+        try:
+            with entry[1]:
+                entry[0].sendall(BUS_HEADER.pack(kind, len(payload)) + payload)
+        except OSError:
+            pass
+
+    def _serve_worker(self, entry):
+        while True:
+            try:
+                kind, payload = bus_read_frame(entry[0])
+            except OSError:
+                kind = None
+            if kind is None:
+                break
+            if kind == BUS_BROADCAST:
+                with self.lock:
+                    others = [w for w in self.workers if w is not entry]
+                for other in others:
+                    self._send(other, BUS_BROADCAST, payload)
+            elif kind == BUS_LOG:
+                log_file, _, log_entry = payload.decode(FORMAT).partition("\n")
+                write_journal(log_file, log_entry)
+            elif kind == BUS_CLAIM:
+                request = json.loads(payload.decode(FORMAT))
+                with self.lock:
+                    holder = self.registry.get(request['name'])
+                    ok = holder is None or holder[0] == request['ip']
+                    if ok:
+                        if holder is None:
+                            holder = self.registry[request['name']] = [request['ip'], 0]
+                        holder[1] += 1
+                self._send(entry, BUS_REPLY, json.dumps({'id': request['id'], 'ok': ok}).encode(FORMAT))
+            elif kind == BUS_RELEASE:
+                request = json.loads(payload.decode(FORMAT))
+                with self.lock:
+                    holder = self.registry.get(request['name'])
+                    if holder and holder[0] == request['ip']:
+                        holder[1] -= 1
+                        if holder[1] <= 0:
+                            del self.registry[request['name']]
+        with self.lock:
+            if entry in self.workers:
+                self.workers.remove(entry)
+
+    def close(self):
+        try:
+            self.listener.close()
+        except OSError:
+            pass
+        if os.path.exists(self.bus_path):
+            os.remove(self.bus_path)
+
+def run_workers(count):
+    """Forks count workers sharing the listening port and runs the bus hub."""
+    global tls_context
+    bus_path = os.path.join(tempfile.gettempdir(), f"chat_server_bus_{os.getpid()}.sock")
+    hub = BusHub(bus_path)
+    if TLS_CERT:
+        tls_context = build_tls_context()  # Before forking, so workers share ticket keys
+    sys.stdout.flush()
+    
+    pids = []
+    for number in range(1, count + 1):
+        pid = os.fork()
+        if pid == 0:
+            hub.listener.close()
+            sys.stdin = open(os.devnull)
+            run_worker(number, bus_path)
+        pids.append(pid)
+    print(f"[WORKERS] Started {count} workers on {HOST}:{PORT}: {pids}")
+    
+    threading.Thread(target=hub.serve, name="bus-accept", daemon=True).start()
+    
+    def forward(signum, frame):
+        for pid in pids:
+            os.kill(pid, signum)
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+    
+    print("[WORKERS] Commands: stacks, profile (toggle), quit")
+    try:
+        for line in sys.stdin:
+            command = line.strip().lower()
+            if command == "quit":
+                break
+            elif command == "stacks":
+                forward(signal.SIGUSR1, None)
+            elif command == "profile":
+                forward(signal.SIGUSR2, None)
+            elif command:
+                print(f"[WORKERS] Unknown command: {command}")
+        else:
+            # stdin closed: serve until every worker has exited
+            for pid in pids:
+                os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except (OSError, ChildProcessError):
+            pass
+    hub.close()
+    print("[WORKERS] Stopped.")
 
 # --- GUI Class ---
 
@@ -398,6 +3556,8 @@ class ServerGUI:
         config_menu = Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Configuration", menu=config_menu)
         config_menu.add_command(label="Port and IP", command=self.open_port_ip_config)
+        config_menu.add_command(label="Room Membership", command=self.open_rooms_config)
+        config_menu.add_command(label="Rate Limits", command=self.open_rate_limits_config)
         
         users_menu = Menu(menubar, tearoff=0)
         menubar.add_command(label="Users", command=self.open_users_config)
@@ -406,12 +3566,44 @@ class ServerGUI:
         menubar.add_cascade(label="Connections", menu=conn_menu)
         conn_menu.add_command(label="Connected Clients", command=self.open_connected_clients)
         
+        metrics_menu = Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Metrics", menu=metrics_menu)
+        metrics_menu.add_command(label="Live Metrics", command=self.open_metrics_panel)
+        
+        diag_menu = Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Diagnostics", menu=diag_menu)
+        diag_menu.add_command(label="Start Profiler", command=start_profiler)
+        diag_menu.add_command(label="Stop Profiler", command=stop_profiler)
+        diag_menu.add_separator()
+        diag_menu.add_command(label="Memory Snapshot", command=take_memory_snapshot)
+        diag_menu.add_command(label="Stop Memory Tracing", command=stop_memory_tracing)
+        diag_menu.add_separator()
+        diag_menu.add_command(label="Dump Thread Stacks", command=dump_thread_stacks)
+        
+        evidence_menu = Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Evidence", menu=evidence_menu)
+        evidence_menu.add_command(label="Export Evidence...", command=self.export_evidence)
+        evidence_menu.add_command(label="Verify Export...", command=self.verify_export)
+        
         # About menu
         menubar.add_command(label="About", command=self.open_about)
         
         # Exit menu
         menubar.add_command(label="Exit", command=self.exit_application)
 
+    def export_evidence(self):
+        destination = filedialog.asksaveasfilename(
+            title="Export Evidence", defaultextension=".tar.gz",
+            initialfile=f"evidence_{datetime.datetime.utcnow():%Y%m%d-%H%M%S}.tar.gz",
+            filetypes=[("Compressed tar", "*.tar.gz"), ("All files", "*.*")])
+        if destination:
+            start_evidence_export(destination)
+
+    def verify_export(self):
+        archive = filedialog.askopenfilename(title="Verify Export", filetypes=[("Compressed tar", "*.tar.gz"), ("All files", "*.*")])
+        if archive:
+            threading.Thread(target=verify_export, args=(archive,), name="evidence-verify", daemon=True).start()
+
     def toggle_server(self):
         global is_server_running
         if not is_server_running:
@@ -431,7 +3623,7 @@ class ServerGUI:
     def open_port_ip_config(self):
         config_win = Toplevel(self.root)
         config_win.title("Configuration: Port and IP")
-        config_win.geometry("300x200")
+        config_win.geometry("300x380")
         
         tk.Label(config_win, text="IP Address:").pack(pady=5)
         ip_entry = tk.Entry(config_win)
@@ -443,37 +3635,42 @@ class ServerGUI:
         port_entry.insert(0, str(PORT))
         port_entry.pack(pady=5)
         
-        def save_config():
-            global HOST, PORT, is_server_running
-            new_ip = ip_entry.get()
+        tk.Label(config_win, text="Also listen on (host:port, one per line):").pack(pady=5)
+        txt_area = scrolledtext.ScrolledText(config_win, width=30, height=6)
+        txt_area.pack(pady=5)
+        txt_area.insert(tk.END, "\n".join(LISTEN_ADDRESSES))
+        
+        def save_addresses():
+            # Listeners change in place: connected clients stay connected
+            global HOST, PORT
+            new_ip = ip_entry.get().strip()
             try:
                 new_port = int(port_entry.get())
-                if new_ip != HOST or new_port != PORT:
-                    if is_server_running:
-                        msg = "[SERVER] Server shutting down, new IP and port assigned.".encode(FORMAT)
-                        broadcast(msg)
-                        log_message("SERVER", "CONFIG CHANGE", "Restarting with new IP/Port")
-                        stop_server_logic()
-                        HOST = new_ip
-                        PORT = new_port
-                        start_server_thread()
-                        self.status_label.config(text="Server Status: ON", fg="green")
-                        self.toggle_btn.config(text="Turn Server OFF")
-                    else:
-                        HOST = new_ip
-                        PORT = new_port
-                        
-                    self.update_info_label()
-                    messagebox.showinfo("Success", f"Server configured to {HOST}:{PORT}")
-                    config_win.destroy()
-                else:
-                    config_win.destroy()
+                extra = [line.strip() for line in txt_area.get("1.0", tk.END).split('\n') if line.strip()]
+                extra_ports = [parse_address(address) for address in extra]
             except ValueError:
-                messagebox.showerror("Error", "Port must be an integer.")
+                messagebox.showerror("Error", "Port must be an integer, and other addresses host:port.")
+                return
+            if (new_ip, new_port) != (HOST, PORT) and is_server_running and admission is not None:
+                try:
+                    admission.add_listener((new_ip, new_port))
+                except OSError as e:
+                    messagebox.showerror("Error", f"Cannot listen on {new_ip}:{new_port}: {e}")
+                    return
+                if (HOST, PORT) not in extra_ports:
+                    admission.remove_listener((HOST, PORT))
+            HOST = new_ip
+            PORT = new_port
+            apply_listen_addresses(extra)
+            save_config()
+            log_message("SERVER", f"CONFIG CHANGE listening on {', '.join([f'{HOST}:{PORT}'] + extra)}")
+            self.update_info_label()
+            messagebox.showinfo("Success", f"Server configured to {HOST}:{PORT}" + (f" and {len(extra)} more" if extra else ""))
+            config_win.destroy()
 
         btn_frame = tk.Frame(config_win)
         btn_frame.pack(pady=20)
-        tk.Button(btn_frame, text="Save", command=save_config).pack(side=tk.LEFT, padx=10)
+        tk.Button(btn_frame, text="Save", command=save_addresses).pack(side=tk.LEFT, padx=10)
         tk.Button(btn_frame, text="Cancel", command=config_win.destroy).pack(side=tk.LEFT, padx=10)
 
     def open_users_config(self):
@@ -490,14 +3687,12 @@ class ServerGUI:
         txt_area.insert(tk.END, current_text)
         
         def save_users():
-            global authorizedUsers
             content = txt_area.get("1.0", tk.END).strip()
-            if content:
-                authorizedUsers[:] = [line.strip() for line in content.split('\n') if line.strip()]
-            else:
-                authorizedUsers.clear()
-            
-            messagebox.showinfo("Saved", "Authorized users list updated.")
+            removed = apply_users([line.strip() for line in content.split('\n') if line.strip()])
+            save_config()
+            log_message("SERVER", f"CONFIG CHANGE users: {len(authorizedUsers)} users"
+                                  + (f", removed {', '.join(removed)}" if removed else ""))
+            messagebox.showinfo("Saved", f"Authorized users list updated and saved to {CONFIG_FILE}.")
             user_win.destroy()
 
         btn_frame = tk.Frame(user_win)
@@ -505,6 +3700,99 @@ class ServerGUI:
         tk.Button(btn_frame, text="Save", command=save_users).pack(side=tk.LEFT, padx=10)
         tk.Button(btn_frame, text="Cancel", command=user_win.destroy).pack(side=tk.LEFT, padx=10)
 
+    def open_rooms_config(self):
+        room_win = Toplevel(self.root)
+        room_win.title("Room Membership")
+        room_win.geometry("400x400")
+        
+        tk.Label(room_win, text="One room per line as  room: user1, user2\nRooms not listed are open to every authorized user.").pack(pady=5)
+        
+        txt_area = scrolledtext.ScrolledText(room_win, width=45, height=15)
+        txt_area.pack(pady=5)
+        
+        current_text = "\n".join(f"{room}: {', '.join(members)}" for room, members in sorted(roomMembers.items()))
+        txt_area.insert(tk.END, current_text)
+        
+        def save_rooms():
+            new_members = {}
+            for line in txt_area.get("1.0", tk.END).strip().split('\n'):
+                if not line.strip():
+                    continue
+                room, _, users = line.partition(':')
+                room = room.strip().lstrip('#')
+                if not ROOM_NAME.fullmatch(room):
+                    messagebox.showerror("Error", f"Invalid room name: {room}")
+                    return
+                new_members[room] = [user.strip() for user in users.split(',') if user.strip()]
+            changed = {room for room in set(roomMembers) | set(new_members)
+                       if roomMembers.get(room) != new_members.get(room)}
+            roomMembers.clear()
+            roomMembers.update(new_members)
+            enforce_room_members(changed)
+            messagebox.showinfo("Saved", "Room membership updated.")
+            room_win.destroy()
+
+        btn_frame = tk.Frame(room_win)
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="Save", command=save_rooms).pack(side=tk.LEFT, padx=10)
+        tk.Button(btn_frame, text="Cancel", command=room_win.destroy).pack(side=tk.LEFT, padx=10)
+
+    def open_rate_limits_config(self):
+        limits_win = Toplevel(self.root)
+        limits_win.title("Rate Limits")
+        limits_win.geometry("420x480")
+        
+        tk.Label(limits_win, text="Limits for every user (0 = no limit):").pack(pady=5)
+        form = tk.Frame(limits_win)
+        form.pack()
+        labels = [('messages_per_second', "Messages per second"), ('message_burst', "Message burst"),
+                  ('bytes_per_second', "Bytes per second"), ('byte_burst', "Byte burst"),
+                  ('max_delay', "Max delay before rejecting (s)")]
+        entries = {}
+        for row, (key, label) in enumerate(labels):
+            tk.Label(form, text=label).grid(row=row, column=0, sticky='w', padx=5, pady=2)
+            entry = tk.Entry(form, width=14)
+            entry.insert(0, str(rateLimits[key]))
+            entry.grid(row=row, column=1, padx=5, pady=2)
+            entries[key] = entry
+        
+        tk.Label(limits_win, text="Per-user overrides, one per line:\nuser: messages_per_second=50, bytes_per_second=10000000").pack(pady=5)
+        txt_area = scrolledtext.ScrolledText(limits_win, width=48, height=8)
+        txt_area.pack(pady=5)
+        txt_area.insert(tk.END, "\n".join(f"{user}: " + ", ".join(f"{k}={v}" for k, v in overrides.items())
+                                         for user, overrides in sorted(userRateLimits.items())))
+        
+        def save_limits():
+            try:
+                defaults = {key: float(entry.get()) for key, entry in entries.items()}
+                per_user = {}
+                for line in txt_area.get("1.0", tk.END).strip().split('\n'):
+                    if not line.strip():
+                        continue
+                    user, _, settings = line.partition(':')
+                    overrides = {}
+                    for setting in settings.split(','):
+                        if not setting.strip():
+                            continue
+                        key, _, value = setting.partition('=')
+                        if key.strip() not in RATE_LIMIT_DEFAULTS:
+                            raise ValueError(f"unknown limit '{key.strip()}'")
+                        overrides[key.strip()] = float(value)
+                    per_user[user.strip()] = overrides
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid rate limit: {e}")
+                return
+            changed = apply_rate_limits(defaults, per_user)
+            save_config()
+            log_message("SERVER", f"CONFIG CHANGE rate_limits: buckets reset for {', '.join(changed) or 'nobody'}")
+            messagebox.showinfo("Saved", f"Rate limits updated and saved to {CONFIG_FILE}.")
+            limits_win.destroy()
+
+        btn_frame = tk.Frame(limits_win)
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="Save", command=save_limits).pack(side=tk.LEFT, padx=10)
+        tk.Button(btn_frame, text="Cancel", command=limits_win.destroy).pack(side=tk.LEFT, padx=10)
+
     def open_connected_clients(self):
         client_win = Toplevel(self.root)
         client_win.title("Connected Clients")
@@ -557,6 +3845,70 @@ class ServerGUI:
         tk.Button(btn_frame, text="Save", command=save_connections).pack(side=tk.LEFT, padx=10)
         tk.Button(btn_frame, text="Cancel", command=client_win.destroy).pack(side=tk.LEFT, padx=10)
 
+    def open_metrics_panel(self):
+        """Opens a window showing live throughput and latency figures."""
+        metrics_win = Toplevel(self.root)
+        metrics_win.title("Live Metrics")
+        metrics_win.geometry("620x420")
+        
+        tk.Label(metrics_win, text=f"Prometheus endpoint: http://{METRICS_HOST}:{METRICS_PORT}/metrics").pack(anchor="w", padx=10, pady=5)
+        
+        text_area = scrolledtext.ScrolledText(metrics_win, state='disabled', font=("Courier", 9))
+        text_area.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        
+        def refresh():
+            if not metrics_win.winfo_exists():
+                return
+            text_area.configure(state='normal')
+            text_area.delete("1.0", tk.END)
+            text_area.insert(tk.END, self.format_metrics_summary())
+            text_area.configure(state='disabled')
+            metrics_win.after(1000, refresh)
+        
+        refresh()
+
+    def format_metrics_summary(self):
+        """Builds the plain-text body of the live metrics panel."""
+        counters, histograms, gauges = metrics.snapshot()
+        
+        per_user = {}
+        auth_rejects = 0
+        for (name, labels), value in counters.items():
+            label_map = dict(labels)
+            if name == 'chat_auth_rejects_total':
+                auth_rejects += value
+            elif 'user' in label_map:
+                per_user.setdefault(label_map['user'] or "(server)", {})[name] = value
+        
+        lines = [
+            f"Connected clients: {gauges.get('chat_connected_clients', 0)}    "
+            f"Open connections: {gauges.get('chat_open_connections', 0)}    "
+            f"Threads: {gauges.get('chat_threads', 0)}",
+            f"Auth rejects: {auth_rejects}",
+            "",
+            f"{'User':<16}{'Msgs in':>10}{'Bytes in':>14}{'Msgs out':>10}{'Bytes out':>14}",
+        ]
+        for user in sorted(per_user):
+            row = per_user[user]
+            lines.append(
+                f"{user[:15]:<16}{row.get('chat_messages_in_total', 0):>10}{row.get('chat_bytes_in_total', 0):>14}"
+                f"{row.get('chat_messages_out_total', 0):>10}{row.get('chat_bytes_out_total', 0):>14}"
+            )
+        
+        lines.append("")
+        lines.append(f"{'Latency (ms)':<30}{'count':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+        for (name, labels), hist in sorted(histograms.items()):
+            label_text = ",".join(str(v) for _, v in labels)
+            title = name.replace('chat_', '').replace('_seconds', '') + (f" [{label_text}]" if label_text else "")
+            lines.append(
+                f"{title[:29]:<30}{hist.count:>8}{hist.quantile(0.5) * 1000:>9.1f}"
+                f"{hist.quantile(0.95) * 1000:>9.1f}{hist.quantile(0.99) * 1000:>9.1f}"
+            )
+        for name, value in sorted(gauges.items()):
+            if name not in ('chat_connected_clients', 'chat_open_connections', 'chat_threads'):
+                lines.append(f"{name}: {value}")
+        return "\n".join(lines) + "\n"
+
     def open_about(self):
         """Opens the About window with author and license information."""
         about_win = Toplevel(self.root)
@@ -615,7 +3967,155 @@ SOFTWARE.
         self.root.destroy()
         os._exit(0)
 
+# --- Headless Mode ---
+
+HEADLESS_COMMANDS = {
+    "profile start": start_profiler,
+    "profile stop": stop_profiler,
+    "snapshot": take_memory_snapshot,
+    "snapshot stop": stop_memory_tracing,
+    "stacks": dump_thread_stacks,
+    "export": start_evidence_export,
+    "reload": reload_config,
+}
+
+def install_diagnostic_signals():
+    """SIGUSR1 dumps thread stacks and SIGUSR2 toggles the profiler (POSIX only)."""
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump_thread_stacks())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: toggle_profiler())
+
+def run_headless():
+    """Runs the server without the GUI, taking diagnostics commands from stdin."""
+    install_diagnostic_signals()
+    start_server_thread()
+    print(f"[HEADLESS] Commands: {', '.join(HEADLESS_COMMANDS)}, quit")
+    try:
+        for line in sys.stdin:
+            command = line.strip().lower()
+            if command == "quit":
+                break
+            if command in HEADLESS_COMMANDS:
+                HEADLESS_COMMANDS[command]()
+            elif command:
+                print(f"[HEADLESS] Unknown command: {command}")
+        else:
+            # stdin closed (e.g. running as a service): keep serving until stopped
+            while is_server_running:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    if is_server_running:
+        stop_server_logic()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Incident Recorder chat server")
+    parser.add_argument("--headless", action="store_true", help="run without the GUI")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--users", default=None, help="comma separated list of authorized users (replaces the config file's)")
+    parser.add_argument("--listen", action="append", default=None, metavar="HOST:PORT",
+                        help="another address to listen on (repeatable; replaces the config file's)")
+    parser.add_argument("--config", default=CONFIG_FILE,
+                        help="settings file (users, rate limits, listen addresses); reloaded when it changes")
+    parser.add_argument("--log-max-mb", type=float, default=LOG_ROTATE_BYTES / (1024 * 1024),
+                        help="start a new journal segment past this size (0: only rotate daily)")
+    parser.add_argument("--no-daily-log", action="store_true", help="do not start a new journal segment each UTC day")
+    parser.add_argument("--upload-digest", choices=("sha256", "blake2b"), default=UPLOAD_DIGEST,
+                        help="hash recorded for every received file and image")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="headless only: fork this many worker processes sharing the port (POSIX)")
+    parser.add_argument("--room", action="append", default=[], metavar="ROOM:USER1,USER2",
+                        help="restrict a room to the listed users (repeatable)")
+    parser.add_argument("--tls-cert", default=None, help="PEM certificate; enables TLS on the listener")
+    parser.add_argument("--tls-key", default=None, help="PEM private key for --tls-cert")
+    parser.add_argument("--tls-ca", default=None, help="CA or pinned certificate that peer servers must present")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="local port of the metrics endpoint")
+    parser.add_argument("--server-id", default=None, help="name of this server in a federation")
+    parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORT",
+                        help="another server to federate with (repeatable)")
+    parser.add_argument("--peer-secret", default="", help="shared secret for server-to-server links")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds between client heartbeats and TCP keepalive idle time")
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT,
+                        help="close connections silent for this many seconds")
+    parser.add_argument("--listen-backlog", type=int, default=LISTEN_BACKLOG, help="kernel accept queue length")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING,
+                        help="connections allowed to be authenticating at once")
+    parser.add_argument("--max-pending-per-ip", type=int, default=MAX_PENDING_PER_IP,
+                        help="connections one address may have authenticating at once")
+    parser.add_argument("--auth-timeout", type=float, default=AUTH_TIMEOUT,
+                        help="seconds a new connection has to finish TLS and send its name")
+    parser.add_argument("--no-nodelay", action="store_true", help="leave Nagle's algorithm on for client connections")
+    parser.add_argument("--no-cork", action="store_true", help="do not use TCP_CORK around header and file body writes")
+    parser.add_argument("--sndbuf-kb", type=int, default=SEND_BUFFER_BYTES // 1024,
+                        help="socket send buffer of client connections in KB (0: kernel default)")
+    parser.add_argument("--rcvbuf-kb", type=int, default=RECEIVE_BUFFER_BYTES // 1024,
+                        help="socket receive buffer in KB (0: kernel default)")
+    parser.add_argument("--coalesce-kb", type=int, default=COALESCE_BYTES // 1024,
+                        help="data connection: gather queued frames into sends of up to this many KB (0: one frame per send)")
+    parser.add_argument("--coalesce-ms", type=float, default=COALESCE_DELAY * 1000,
+                        help="data connection: wait this long for more frames before sending")
+    parser.add_argument("--capture", metavar="FILE", default=None,
+                        help="record client traffic to FILE for chatBenchmark.py replay (contains message text)")
+    parser.add_argument("--export", metavar="ARCHIVE", default=None,
+                        help="write the journal and stored files to ARCHIVE (.tar.gz) with a signed manifest, then exit")
+    parser.add_argument("--verify-export", metavar="ARCHIVE", default=None,
+                        help="check an export against its manifest and signature, then exit")
+    parser.add_argument("--export-key", default=EXPORT_KEY_FILE, help="secret used to sign and verify export manifests")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    args = parse_args()
+    load_config(args.config)
+    HOST = args.host
+    PORT = args.port
+    if args.users is not None:
+        authorizedUsers[:] = [user.strip() for user in args.users.split(",") if user.strip()]
+    if args.listen is not None:
+        LISTEN_ADDRESSES[:] = args.listen
+    METRICS_PORT = args.metrics_port
+    LOG_ROTATE_BYTES = int(args.log_max_mb * 1024 * 1024)
+    LOG_ROTATE_DAILY = not args.no_daily_log
+    UPLOAD_DIGEST = args.upload_digest
+    TLS_CERT = args.tls_cert
+    TLS_KEY = args.tls_key
+    TLS_CA = args.tls_ca
+    for room_spec in args.room:
+        room, _, users = room_spec.partition(":")
+        roomMembers[room.strip().lstrip("#")] = [user.strip() for user in users.split(",") if user.strip()]
+    SERVER_ID = args.server_id
+    PEERS[:] = args.peer
+    PEER_SECRET = args.peer_secret
+    HEARTBEAT_INTERVAL = args.heartbeat_interval
+    HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+    LISTEN_BACKLOG = args.listen_backlog
+    MAX_PENDING = args.max_pending
+    MAX_PENDING_PER_IP = args.max_pending_per_ip
+    TCP_NODELAY_ON = not args.no_nodelay
+    TCP_CORK_ON = not args.no_cork
+    SEND_BUFFER_BYTES = args.sndbuf_kb * 1024
+    RECEIVE_BUFFER_BYTES = args.rcvbuf_kb * 1024
+    COALESCE_BYTES = args.coalesce_kb * 1024
+    COALESCE_DELAY = args.coalesce_ms / 1000
+    AUTH_TIMEOUT = args.auth_timeout
+    EXPORT_KEY_FILE = args.export_key
+    CAPTURE_FILE = args.capture
+    
+    if args.export:
+        export_evidence(args.export)
+        sys.exit(0)
+    if args.verify_export:
+        sys.exit(0 if verify_export(args.verify_export) else 1)
+    if args.headless and args.workers > 0:
+        print(f"[STARTING] Headless server with {args.workers} workers...")
+        run_workers(args.workers)
+        sys.exit(0)
+    if args.headless:
+        print("[STARTING] Headless server...")
+        run_headless()
+        sys.exit(0)
+    
     print("[STARTING] GUI...")
     root = tk.Tk()
     app = ServerGUI(root)